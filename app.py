@@ -11,23 +11,29 @@ import uuid
 import html as html_escape
 from pathlib import Path        
 from datetime import datetime
-import concurrent.futures
+import threading
 from utils.database import (
     SCHEMA_VERSION,
     DatabaseStartupError,
+    WriteBehindFlusher,
+    connection_pool_stats,
+    current_versions,
     database_config_from_secrets,
     database_health_check,
     format_database_startup_diagnostics,
     initialize_database_from_config,
     log_database_startup_diagnostics,
+    refresh_write_behind_replica,
     secret_presence_from_secrets,
+    write_behind_remote_config,
 )
 from utils.sheet_import import (
     ImportAbortedError,
     SHEET_KEY_COLUMNS,
     import_sheet_values,
+    cached_worksheet,
     missing_inventory_sync_id_updates,
-    read_worksheet_values_with_retry,
+    read_worksheets_values,
 )
 from utils.color_powder_repository import (
     ColorPowderAlreadyExists,
@@ -58,24 +64,34 @@ from utils.recipe_repository import (
     RecipeAlreadyExists,
     RecipeError,
     create_recipe,
+    find_recipes_containing_powders,
     list_recipes,
+    list_recipes_changed_since,
     set_recipe_active,
     update_recipe,
 )
 from utils.inventory_repository import (
     InventoryError,
     create_inventory_movement,
+    create_inventory_movements_bulk,
     list_inventory_movements,
+    list_inventory_movements_changed_since,
     reverse_inventory_movement,
     update_inventory_movement,
 )
 from utils.production_order_repository import (
     ProductionOrderError,
     list_production_orders,
+    list_production_orders_changed_since,
+    next_production_order_id,
     set_production_order_cancelled,
     update_production_order,
     upsert_production_order,
 )
+from utils.frame_patch import apply_changes
+from utils.search_repository import search_production_orders, search_recipes
+from utils.stock_engine import parse_datetime_series, stock_summary as compute_stock_summary
+from utils.stock_repository import complete_stock_upgrades, list_powder_stock_balances, list_powder_usage
 
 st.set_page_config(
     page_title="配方管理系統",
@@ -98,6 +114,10 @@ def _initialize_database_once(config, secret_presence, schema_version):
             f"main_tables_present={health.main_tables_exist}, "
             f"missing_required_columns={health.missing_required_columns}."
         )
+    # 升級排入的一次性回填／重建在啟動時跑完，之後讀庫存不再寫入；
+    # write-behind 模式在 Turso 上跑，再把結果拉回本機 replica。
+    if complete_stock_upgrades(write_behind_remote_config(config)) and config.write_behind_path is not None:
+        refresh_write_behind_replica(config)
     return initialized, health
 
 # ======== 🎛️ 全站 Toggle 統一美化（只需注入一次，全站套用） ========
@@ -270,6 +290,16 @@ except Exception as exc:
     st.exception(exc)
     raise
 
+@st.cache_resource(show_spinner=False)
+def _start_write_behind_flusher(config):
+    """write-behind 模式下每個 process 只啟動一個背景 flusher，依序把本機 journal 送到 Turso。"""
+    flusher = WriteBehindFlusher(config)
+    flusher.start()
+    return flusher
+
+if DATABASE_CONFIG.write_behind_path is not None:
+    _start_write_behind_flusher(DATABASE_CONFIG)
+
 # Backward-compatible name for legacy code paths that still expect a local path.
 SQLITE_DB_PATH = DATABASE_INITIALIZED
     
@@ -794,7 +824,8 @@ def get_cached_worksheet(sheet_name):
     cache = st.session_state.setdefault("_ws_cache", {})
     if sheet_name in cache:
         return cache[sheet_name]
-    ws = spreadsheet.worksheet(sheet_name)
+    # 工作表 metadata 在整個程序共用一份（一次 worksheets() 請求），不必每個 session 各查一次
+    ws = cached_worksheet(spreadsheet, sheet_name)
     cache[sheet_name] = ws
     return ws
 
@@ -810,8 +841,8 @@ def _load_sheet_values_with_cache(sheet_name, force_reload=False, ttl_seconds=SH
     ):
         return [row[:] for row in cached["values"]]
 
-    ws = get_cached_worksheet(sheet_name)
-    values = read_worksheet_values_with_retry(ws)
+    # 單張表也走批次讀取：metadata 用程序共用快取，只剩一次 values 請求
+    values = read_worksheets_values(spreadsheet, [sheet_name])[sheet_name]
     cache[sheet_name] = {"timestamp": now, "values": [row[:] for row in values]}
     return values
 
@@ -1015,22 +1046,14 @@ PRELOAD_SHEETS = {
 }
 
 
-def _fetch_sheet_raw_values(sheet_name):
-    """在背景執行緒執行：只負責打 API 抓資料，完全不觸碰 st.session_state
-    （st.session_state 不保證多執行緒安全，所以寫入快取一律留到主執行緒做）。"""
-    ws = spreadsheet.worksheet(sheet_name)
-    return read_worksheet_values_with_retry(ws)
-
-
 def preload_all_data(force=False):
     """
     一次性把所有常用 Sheet 載入 session_state。
     force=False（預設）：session_state 已有非空資料就跳過，不打 API。
     force=True：強制重讀（寫入後才用）。
 
-    需要重新讀取的表，改用多執行緒同時發出 API 請求（原本是 6 張表依序讀取，
-    等於 6 次網路來回時間加總；平行後大約只要「最慢那一張表」的時間）。
-    等全部請求都回來，才回到主執行緒把結果寫進 st.session_state 快取。
+    需要重新讀取的表，用一次 values_batch_get 批次請求全部抓回（原本每張表要
+    worksheet() + get_all_values() 兩次請求，很快就吃光每分鐘讀取配額）。
     """
     sheets_to_fetch = []
     for sheet_name, state_key in PRELOAD_SHEETS.items():
@@ -1042,23 +1065,17 @@ def preload_all_data(force=False):
 
     if sheets_to_fetch:
         now = datetime.now().timestamp()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sheets_to_fetch)) as executor:
-            future_to_sheet = {
-                executor.submit(_fetch_sheet_raw_values, name): name
-                for name in sheets_to_fetch
-            }
-            for future in concurrent.futures.as_completed(future_to_sheet):
-                sheet_name = future_to_sheet[future]
-                try:
-                    values = future.result()
-                except Exception:
-                    continue  # 這張表抓失敗，下面組 DataFrame 時會走原本的例外處理，回傳空表
+        try:
+            fetched = read_worksheets_values(spreadsheet, sheets_to_fetch)
+        except Exception:
+            fetched = {}  # 批次讀取失敗，下面組 DataFrame 時會走原本的逐表讀取與例外處理
 
-                st.session_state.setdefault("_sheet_values_cache", {})[sheet_name] = {
-                    "timestamp": now,
-                    "values": [row[:] for row in values],
-                }
-                st.session_state.get("_sheet_df_cache", {}).pop(sheet_name, None)
+        for sheet_name, values in fetched.items():
+            st.session_state.setdefault("_sheet_values_cache", {})[sheet_name] = {
+                "timestamp": now,
+                "values": [row[:] for row in values],
+            }
+            st.session_state.get("_sheet_df_cache", {}).pop(sheet_name, None)
 
     for sheet_name, state_key in PRELOAD_SHEETS.items():
         if not force:
@@ -1067,7 +1084,7 @@ def preload_all_data(force=False):
                 continue
 
         try:
-            # 上面平行請求已經把最新資料寫進快取了，這裡一律 force_reload=False
+            # 上面批次請求已經把最新資料寫進快取了，這裡一律 force_reload=False
             # 直接吃快取，避免重複打第二次 API。
             df = get_cached_sheet_df(sheet_name, force_reload=False)
         except Exception:
@@ -1648,6 +1665,58 @@ def filter_df_by_keywords(df, keywords, searchable_cols):
             break
     return filtered_df
 
+def filter_df_by_search_index(df, keywords, id_col, search_fn, fallback_cols, **search_kwargs):
+    """以 Turso FTS5 索引（utils/search_repository.py）多條件搜尋；索引不可用時退回逐欄比對。"""
+    if df is None or df.empty or not keywords or id_col not in df.columns:
+        return filter_df_by_keywords(df, keywords, fallback_cols)
+    try:
+        hits = search_fn(DATABASE_CONFIG, " ".join(keywords), len(df), **search_kwargs)
+    except Exception:
+        return filter_df_by_keywords(df, keywords, fallback_cols)
+    hit_ids = {str(hit[id_col]) for hit in hits}
+    return df[df[id_col].astype(str).str.strip().isin(hit_ids)]
+
+@st.cache_resource(show_spinner=False)
+def _shared_frame_store():
+    """跨 session 共用的 DataFrame 快取；以 data_versions 版本號判斷資料表是否異動。"""
+    return {"lock": threading.Lock(), "frames": {}}
+
+def read_data_versions():
+    """一次讀回各資料表的異動計數器；讀不到時回傳空 dict，快取改走 change_seq 增量查詢。"""
+    try:
+        return current_versions(DATABASE_CONFIG)
+    except Exception:
+        return {}
+
+def refresh_cached_frame(cache_key, key_column, changes_fn, *, tables, versions=None, **kwargs):
+    """所有 session 共用同一份 DataFrame：tables 的版本號沒變就直接重用，
+    有異動才依 change_seq 水位只讀取異動列修補；第一次才整表載入。"""
+    # 先讀版本號再讀資料：期間若有寫入，只會讓新資料掛在舊版本號下、下次重讀，不會留下過期資料
+    versions = read_data_versions() if versions is None else versions
+    version_key = tuple(versions.get(table) for table in tables)
+    store = _shared_frame_store()
+    key = (cache_key, tuple(sorted(kwargs.items())))
+    with store["lock"]:
+        cached = store["frames"].get(key) or {}
+    if cached and None not in version_key and cached.get("versions") == version_key:
+        return cached["frame"].copy()
+    watermark = cached.get("watermark")
+    frame = cached.get("frame") if watermark is not None else None
+    changes = changes_fn(DATABASE_CONFIG, watermark if frame is not None else None, **kwargs)
+    if frame is not None and not changes.upserted and not changes.tombstoned:
+        # 版本號變了卻沒有異動列（例如整列刪除），增量補不回來，改為整表重讀
+        changes = changes_fn(DATABASE_CONFIG, None, **kwargs)
+        frame = None
+    # apply_changes 會在副本上修補，其他 session 正在讀的共用 frame 不會被改到；
+    # 修補完成後才在鎖內換上新 frame，若別的 session 已換上更新的版本就保留它
+    frame = apply_changes(frame, key_column, changes)
+    with store["lock"]:
+        current = store["frames"].get(key) or {}
+        newer = current.get("watermark")
+        if newer is None or changes.watermark is None or newer <= changes.watermark:
+            store["frames"][key] = {"frame": frame, "watermark": changes.watermark, "versions": version_key}
+    return frame.copy()
+
 def safe_float_convert(value, default=0.0):
     """安全地將值轉換為浮點數"""
     if pd.isna(value) or value == '' or value is None:
@@ -2824,7 +2893,10 @@ elif menu == "配方管理":
                     "名稱": row.get("name", ""), "色粉類別": row.get("category", ""),
                     "包裝": row.get("package", ""), "備註": row.get("notes", ""),
                 }
-                for row in list_color_powders(DATABASE_CONFIG)
+                for row in list_color_powders(
+                    DATABASE_CONFIG,
+                    columns=["colorpowder_id", "international_code", "name", "category", "package", "notes"],
+                )
             ])
             if "色粉編號" not in df_p.columns:
                 df_p = pd.DataFrame(columns=["色粉編號", "國際色號", "名稱", "色粉類別", "包裝", "備註"])
@@ -3181,10 +3253,13 @@ elif menu == "配方管理":
             if "last_search_signature_tab2" not in st.session_state:
                 st.session_state.last_search_signature_tab2 = search_signature
 
-            df_filtered = filter_df_by_keywords(
+            df_filtered = filter_df_by_search_index(
                 df,
                 search_keywords,
-                ["配方編號", "客戶名稱", "客戶編號", "Pantone色號"]
+                "配方編號",
+                search_recipes,
+                ["配方編號", "客戶名稱", "客戶編號", "Pantone色號"],
+                include_inactive=True,
             ).copy()
             if not df_filtered.empty:
                 if "建檔時間" in df_filtered.columns:
@@ -4222,14 +4297,21 @@ elif menu == "生產單管理":
 
     # 生產單與配方都直接讀 Turso；Sheet 由 outbox PUSH 更新。
     try:
-        df_order = pd.DataFrame(list_production_orders(DATABASE_CONFIG, include_cancelled=True))
+        # 只讀取上次之後異動的生產單並修補快取，不再每次 rerun 整表重讀
+        df_order = refresh_cached_frame(
+            "_order_page_orders", "生產單號", list_production_orders_changed_since,
+            tables=("production_orders",), include_cancelled=True,
+        )
     except Exception as e:
         st.error(f"❌ 無法從 Turso 載入生產單：{e}")
         st.stop()
     
     # 載入配方管理表
     try:
-        df_recipe = pd.DataFrame(list_recipes(DATABASE_CONFIG))
+        df_recipe = refresh_cached_frame(
+            "_order_page_recipes", "配方編號", list_recipes_changed_since,
+            tables=("recipes", "recipe_components"),
+        )
         df_recipe.columns = df_recipe.columns.str.strip()
         df_recipe.fillna("", inplace=True)
     
@@ -4256,208 +4338,15 @@ elif menu == "生產單管理":
     # ===== 庫存計算函式 =====
     def calculate_current_stock():
         """
-        計算截至「今天」的實際庫存
-        邏輯：與庫存區 calc_usage_for_stock() 完全一致
+        讀取截至「今天」的實際庫存
+        邏輯：初始 + 進貨 - 已用，由 powder_stock_balances 在每次寫入時同步維護
         """
-        stock_dict = {}
-        
         try:
-            df_stock = pd.DataFrame(list_inventory_movements(DATABASE_CONFIG))
+            balances = list_powder_stock_balances(DATABASE_CONFIG)
         except Exception as e:
-            st.warning(f"⚠️ 無法讀取庫存記錄：{e}")
-            return stock_dict
-        
-        if df_stock.empty:
-            return stock_dict
-        
-        # ⚠️ 定義「今天」作為結束日
-        today = pd.Timestamp.today().normalize()
-        
-        # 清理資料
-        df_stock["類型"] = df_stock["類型"].astype(str).str.strip()
-        df_stock["色粉編號"] = df_stock["色粉編號"].astype(str).str.strip()
-        if "日期" in df_stock.columns:
-            df_stock["日期"] = pd.to_datetime(df_stock["日期"], errors="coerce")
-        
-        # === 步驟 1：找出每個色粉的「最新初始庫存」及其日期 ===
-        initial_stocks = {}
-        
-        for idx, row in df_stock.iterrows():
-            if row["類型"] != "初始":
-                continue
-            
-            pid = row.get("色粉編號", "")
-            if not pid:
-                continue
-            
-            try:
-                qty = float(row.get("數量", 0))
-            except:
-                qty = 0.0
-            
-            if str(row.get("單位", "g")).lower() == "kg":
-                qty *= 1000
-            
-            row_date = row.get("日期")
-            if pd.isna(row_date):
-                row_date = pd.Timestamp('2000-01-01')
-            
-            if pid not in initial_stocks:
-                initial_stocks[pid] = {"qty": qty, "date": row_date}
-            elif row_date > initial_stocks[pid]["date"]:
-                initial_stocks[pid] = {"qty": qty, "date": row_date}
-        
-        for pid, data in initial_stocks.items():
-            stock_dict[pid] = data["qty"]
-        
-        # === 步驟 2：累加「起算點 ~ 今天」的進貨 ===
-        # 先取得所有進貨記錄的色粉，建立起算點
-        df_in = df_stock[df_stock["類型"].astype(str).str.strip() == "進貨"].copy()
-        for pid in df_in["色粉編號"].unique():
-            if pid not in initial_stocks:
-                # ✅ 找到該色粉最早的進貨日期作為起算點
-                pid_in = df_in[df_in["色粉編號"] == pid]
-                min_in_date = pid_in["日期"].min() if not pid_in.empty else pd.Timestamp('2000-01-01')
-                initial_stocks[pid] = {"qty": 0.0, "date": min_in_date}
-                stock_dict[pid] = 0.0
-        
-        for idx, row in df_stock.iterrows():
-            if row["類型"] != "進貨":
-                continue
-            
-            pid = row.get("色粉編號", "")
-            if not pid:
-                continue
-            
-            row_date = row.get("日期")
-            
-            # 檢查進貨日期是否在「起算點 ~ 今天」之間
-            if pd.isna(row_date):
-                should_add = True
-            else:
-                should_add = (
-                    row_date >= initial_stocks[pid]["date"] and
-                    row_date <= today
-                )
-            
-            if should_add:
-                try:
-                    qty = float(row.get("數量", 0))
-                except:
-                    qty = 0.0
-                
-                if str(row.get("單位", "g")).lower() == "kg":
-                    qty *= 1000
-                
-                stock_dict[pid] += qty
-        
-        # === 步驟 3：扣除「起算點 ~ 今天」的生產單用量 ===
-        df_order_hist = st.session_state.get("df_order", pd.DataFrame()).copy()
-        if df_order_hist.empty:
-            return stock_dict
-
-        # ✅ 防止同一張生產單因重複寫入而被多次計算（保留最新一筆）
-        if "生產單號" in df_order_hist.columns:
-            if "建立時間" in df_order_hist.columns:
-                df_order_hist["建立時間"] = pd.to_datetime(df_order_hist["建立時間"], errors="coerce")
-                df_order_hist = df_order_hist.sort_values("建立時間").drop_duplicates(
-                    subset="生產單號", keep="last"
-                )
-            else:
-                df_order_hist = df_order_hist.drop_duplicates(subset="生產單號", keep="last")
-
-        if "生產日期" in df_order_hist.columns:
-            df_order_hist["生產日期"] = pd.to_datetime(df_order_hist["生產日期"], errors="coerce")
-        
-        df_recipe_hist = st.session_state.get("df_recipe", pd.DataFrame()).copy()
-        
-        # ✅ 確保必要欄位存在
-        powder_cols = [f"色粉編號{i}" for i in range(1, 9)]
-        for c in powder_cols + ["配方編號", "配方類別", "原始配方"]:
-            if c not in df_recipe_hist.columns:
-                df_recipe_hist[c] = ""
-        
-        for _, order_hist in df_order_hist.iterrows():
-            order_date = order_hist.get("生產日期")
-            
-            # ✅ 沒有日期的訂單直接跳過
-            if pd.isna(order_date):
-                continue
-            
-            recipe_id = str(order_hist.get("配方編號", "")).strip()
-            if not recipe_id:
-                continue
-            
-            # ✅ 關鍵修正：只處理「這張訂單的配方」，避免重複計算
-            # 取得主配方與附加配方
-            recipe_rows = []
-            main_df = df_recipe_hist[df_recipe_hist["配方編號"].astype(str).str.strip() == recipe_id]
-            if not main_df.empty:
-                recipe_rows.append(main_df.iloc[0].to_dict())
-            
-            add_df = df_recipe_hist[
-                (df_recipe_hist["配方類別"].astype(str).str.strip() == "附加配方") &
-                (df_recipe_hist["原始配方"].astype(str).str.strip() == recipe_id)
-            ]
-            if not add_df.empty:
-                recipe_rows.extend(add_df.to_dict("records"))
-            
-            # 計算包裝總量（kg）
-            packs_total_kg = calc_packs_total_kg(order_hist)
-            
-            if packs_total_kg <= 0:
-                continue
-            
-            # ✅ 建立這張訂單已處理的色粉集合（避免重複扣除）
-            processed_powders = set()
-            
-            # 逐配方計算用量
-            for rec in recipe_rows:
-                pvals = [str(rec.get(f"色粉編號{i}", "")).strip() for i in range(1, 9)]
-                
-                for i, pid in enumerate(pvals, 1):
-                    if not pid or pid.endswith(("01", "001", "0001")):
-                        continue
-                    
-                    # ✅ 避免同一色粉在同一張訂單中重複扣除
-                    if pid in processed_powders:
-                        continue
-                    
-                    # ✅ 只處理有庫存記錄的色粉
-                    if pid not in stock_dict:
-                        continue
-                    
-                    # ✅ 檢查日期範圍（使用起算日期）
-                    order_date_norm = order_date.normalize()
-                    
-                    # 取得起算日期
-                    if pid in initial_stocks:
-                        init_start_date = initial_stocks[pid]["date"].normalize()
-                    else:
-                        # 沒有初始庫存的色粉，使用最早的日期
-                        init_start_date = pd.Timestamp('2000-01-01').normalize()
-                    
-                    if order_date_norm < init_start_date:
-                        continue
-                    if order_date_norm > today:
-                        continue
-                    
-                    try:
-                        ratio_g = float(rec.get(f"色粉重量{i}", 0) or 0)
-                    except:
-                        ratio_g = 0.0
-                    
-                    if ratio_g <= 0:
-                        continue
-                    
-                    # ✅ 計算用量（g） = 色粉重量 * 包裝總量
-                    total_used_g = ratio_g * packs_total_kg
-                    
-                    if pid in stock_dict:
-                        stock_dict[pid] -= total_used_g
-                        processed_powders.add(pid)  # ✅ 標記已處理
-        
-        return stock_dict
+            st.warning(f"⚠️ 無法讀取庫存餘額：{e}")
+            return {}
+        return {row["colorpowder_id"]: float(row["balance_g"]) for row in balances}
     
     # ⚡ 生產單頁：庫存重算節流（預設 3 分鐘）
     now = datetime.now()
@@ -4472,8 +4361,6 @@ elif menu == "生產單管理":
     )
 
     if should_recalc_stock:
-        # 讓既有 sheet TTL 快取先判斷是否需要打 API
-        load_recipe(force_reload=False)
         st.session_state["last_final_stock"] = calculate_current_stock()
         st.session_state["stock_calc_time"] = now
     
@@ -4494,29 +4381,27 @@ elif menu == "生產單管理":
         return base
 
     def generate_next_production_order_id():
-        """依「當日最大流水號 + 1」產生生產單號，避免刪單後重複編號。"""
+        """由 sequences 表原子取號（當日流水號 + 1），多個 session 同時開單也不會重號。
+        同一張尚未存檔的草稿沿用已取得的單號，rerun 不會再取新號；取號失敗時顯示錯誤並中止，不建立草稿。"""
         today_str = datetime.now().strftime("%Y%m%d")
-        id_pattern = re.compile(rf"^{today_str}-(\d+)$")
-
-        max_seq = 0
+        reserved = st.session_state.get("reserved_production_order_id", "")
+        prev_order = st.session_state.get("new_order") or {}
+        reserved_saved = (
+            st.session_state.get("new_order_saved", False)
+            and str(prev_order.get("生產單號", "")).strip() == reserved
+        )
+        if reserved.startswith(f"{today_str}-") and not reserved_saved:
+            return reserved
 
-        # 優先從最新 Sheet 讀取（避免 session_state 舊資料導致重號）
         try:
-            latest_df = pd.DataFrame(list_production_orders(DATABASE_CONFIG, include_cancelled=True))
-        except Exception:
-            latest_df = st.session_state.get("df_order", pd.DataFrame()).copy()
-
-        if "生產單號" in latest_df.columns:
-            for raw_id in latest_df["生產單號"].astype(str).tolist():
-                m = id_pattern.match(raw_id.strip())
-                if not m:
-                    continue
-                try:
-                    max_seq = max(max_seq, int(m.group(1)))
-                except Exception:
-                    continue
-
-        return f"{today_str}-{max_seq + 1:03d}"
+            new_id = next_production_order_id(DATABASE_CONFIG)
+        except Exception as exc:
+            # 取號失敗就不建立草稿：以畫面上的生產單推算會和其他 session 重號，
+            # 且推算的號碼不會記入 sequences
+            st.error(f"❌ 無法從 Turso 取得生產單號，請稍後再試：{exc}")
+            st.stop()
+        st.session_state["reserved_production_order_id"] = new_id
+        return new_id
 
     def find_active_oem_duplicate(recipe_code):
         """色母生產單新增前檢查：「代工進度表」（代工管理工作表）裡是否已有同配方編號、
@@ -4555,22 +4440,17 @@ elif menu == "生產單管理":
         recipe_code = str(recipe_code or "").strip()
         if not recipe_code:
             return None
+        today_str = datetime.now().strftime("%Y-%m-%d")
         try:
-            df_order_check = pd.DataFrame(list_production_orders(DATABASE_CONFIG, include_cancelled=True))
+            # 只取同配方、今天的生產單（SQL 端過濾），不再載入整張生產單表
+            df_order_check = pd.DataFrame(list_production_orders(
+                DATABASE_CONFIG, include_cancelled=True,
+                recipe_id=recipe_code, start=today_str, end=today_str,
+            ))
         except Exception:
             return None
-        if df_order_check.empty or "配方編號" not in df_order_check.columns:
-            return None
-
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        df_order_check = df_order_check.copy()
-        df_order_check["配方編號"] = df_order_check["配方編號"].astype(str).str.strip()
-        df_order_check["生產日期"] = df_order_check.get("生產日期", "").astype(str).str.strip()
-
-        matches = df_order_check[
-            (df_order_check["配方編號"] == recipe_code) &
-            (df_order_check["生產日期"] == today_str)
-        ]
+        # 生產日期已由 SQL 依正規化的 production_day 比對（2026/9/1 與 2026-09-01 視為同一天）
+        matches = df_order_check
         if matches.empty:
             return None
 
@@ -5770,10 +5650,13 @@ elif menu == "生產單管理":
             st.session_state.order_page_tab2 = 1
     
         order_keywords_tab2 = split_search_keywords(search_order)
-        df_filtered = filter_df_by_keywords(
+        df_filtered = filter_df_by_search_index(
             df_order,
             order_keywords_tab2,
-            ["生產單號", "配方編號", "客戶名稱", "顏色"]
+            "生產單號",
+            search_production_orders,
+            ["生產單號", "配方編號", "客戶名稱", "顏色"],
+            include_cancelled=True,
         ).copy()
         if "取消狀態" in df_filtered.columns:
             df_filtered = df_filtered[df_filtered["取消狀態"] != "已取消"].copy()
@@ -7672,17 +7555,13 @@ elif menu == "採購管理":
     
         # 🔒 舊庫存補時間
         if "日期" in df_stock.columns:
-            def fix_stock_datetime(x):
-                try:
-                    dt = pd.to_datetime(x, errors="coerce")
-                    if pd.isna(dt):
-                        return x
-                    if dt.hour == 0 and dt.minute == 0 and dt.second == 0:
-                        return dt + pd.Timedelta(hours=9)
-                    return dt
-                except:
-                    return x
-            df_stock["日期"] = df_stock["日期"].apply(fix_stock_datetime)
+            def fix_stock_datetime(series):
+                # 整欄一次解析（utils/stock_engine.py）；無法解析的保留原值，午夜補 09:00
+                dt = parse_datetime_series(series)
+                at_midnight = dt.notna() & (dt == dt.dt.normalize())
+                fixed = dt.where(~at_midnight, dt + pd.Timedelta(hours=9))
+                return fixed.astype(object).where(dt.notna(), series)
+            df_stock["日期"] = fix_stock_datetime(df_stock["日期"])
     
         # 初始化 form_in_stock session_state
         if "form_in_stock" not in st.session_state:
@@ -7805,6 +7684,79 @@ elif menu == "採購管理":
                     )
     
                                
+        # ===== 批次匯入進貨（CSV / XLSX），整批一次驗證並寫入 Turso =====
+        with st.expander("📤 批次匯入進貨（CSV / XLSX）", expanded=False):
+            st.caption(
+                "欄位：色粉編號、數量（必填）、單位（g/kg，預設 g）、日期（空白為今天）、"
+                "廠商編號、廠商名稱（空白時依廠商編號帶入）、備註。"
+            )
+            bulk_file = st.file_uploader("上傳進貨明細", type=["csv", "xlsx"], key="bulk_stock_upload")
+            df_bulk = None
+            if bulk_file is not None:
+                try:
+                    if bulk_file.name.lower().endswith(".csv"):
+                        df_bulk = pd.read_csv(bulk_file, dtype=str)
+                    else:
+                        df_bulk = pd.read_excel(bulk_file, dtype=str)
+                except Exception as exc:
+                    st.error(f"❌ 無法讀取檔案：{exc}")
+            if df_bulk is not None:
+                df_bulk.columns = [str(c).strip() for c in df_bulk.columns]
+                df_bulk = df_bulk.fillna("")
+                bulk_columns = ["色粉編號", "數量", "單位", "日期", "廠商編號", "廠商名稱", "備註"]
+                if "色粉編號" not in df_bulk.columns or "數量" not in df_bulk.columns:
+                    st.error("❌ 檔案需包含「色粉編號」與「數量」欄位")
+                else:
+                    for col in bulk_columns:
+                        if col not in df_bulk.columns:
+                            df_bulk[col] = ""
+                        df_bulk[col] = df_bulk[col].astype(str).str.strip()
+                    df_bulk["_檔案列"] = range(2, len(df_bulk) + 2)
+                    df_bulk = df_bulk[df_bulk["色粉編號"] != ""].reset_index(drop=True)
+                    # 日期統一成 YYYY/MM/DD；無法解析的保留原字串
+                    bulk_dates = parse_datetime_series(df_bulk["日期"])
+                    df_bulk["日期"] = bulk_dates.dt.strftime("%Y/%m/%d").where(bulk_dates.notna(), df_bulk["日期"])
+                    df_bulk.loc[df_bulk["日期"] == "", "日期"] = datetime.today().strftime("%Y/%m/%d")
+                    df_bulk["數量"] = df_bulk["數量"].str.replace(",", "", regex=False)
+                    df_bulk["單位"] = df_bulk["單位"].str.lower().replace("", "g")
+                    blank_supplier_name = df_bulk["廠商名稱"] == ""
+                    df_bulk.loc[blank_supplier_name, "廠商名稱"] = (
+                        df_bulk.loc[blank_supplier_name, "廠商編號"].map(supplier_name_map).fillna("")
+                    )
+                    st.dataframe(df_bulk[bulk_columns], use_container_width=True, hide_index=True)
+
+                    # 同一個檔案沿用同一組 _sync_id，重複按匯入只會回報「已存在」而不會重複進貨
+                    bulk_key = f"{bulk_file.name}:{bulk_file.size}:{len(df_bulk)}"
+                    bulk_sync_ids = st.session_state.setdefault("bulk_stock_sync_ids", {}).setdefault(
+                        bulk_key, [uuid.uuid4().hex for _ in range(len(df_bulk))]
+                    )
+                    if st.button(f"匯入 {len(df_bulk)} 筆進貨", key="bulk_stock_submit", type="primary",
+                                 disabled=df_bulk.empty):
+                        bulk_rows = [
+                            {"類型": "進貨", **{col: record[col] for col in bulk_columns}, "_sync_id": sync_id}
+                            for record, sync_id in zip(df_bulk.to_dict("records"), bulk_sync_ids)
+                        ]
+                        try:
+                            bulk_results = create_inventory_movements_bulk(DATABASE_CONFIG, bulk_rows)
+                        except Exception as exc:
+                            st.error(f"❌ 批次匯入失敗，未寫入任何資料：{exc}")
+                            bulk_results = []
+                        bulk_ok = sum(result.ok for result in bulk_results)
+                        bulk_failed = [
+                            {
+                                "檔案列": int(df_bulk.at[result.index, "_檔案列"]),
+                                "色粉編號": bulk_rows[result.index]["色粉編號"],
+                                "原因": result.error,
+                            }
+                            for result in bulk_results if not result.ok
+                        ]
+                        if bulk_ok:
+                            st.session_state.stock_need_reload = True
+                            st.success(f"✅ 已新增 {bulk_ok} 筆進貨紀錄")
+                        if bulk_failed:
+                            st.warning(f"⚠️ {len(bulk_failed)} 筆未匯入，請修正後重新上傳")
+                            st.dataframe(pd.DataFrame(bulk_failed), use_container_width=True, hide_index=True)
+
         st.markdown("---")
         if st.button("📥 重新載入庫存資料", key="reload_stock_tab1_bottom", use_container_width=True):
             try:
@@ -8270,58 +8222,20 @@ elif menu == "查詢區":
             if not inputs:
                 st.warning("⚠️ 請至少輸入一個色粉編號")
             else:
-                # 篩選符合的配方
-                mask = df_recipe.apply(
-                    lambda row: all(
-                        inp in row[[f"色粉編號{i}" for i in range(1, 9)]].astype(str).tolist() 
-                        for inp in inputs
-                    ),
-                    axis=1
-                )
-                matched = df_recipe[mask].copy()
-    
-                if matched.empty:
+                # recipe_components 色粉索引取交集，最後生產時間解析成日期後排序（由近到遠），顯示為 YYYY-MM-DD
+                try:
+                    results = find_recipes_containing_powders(DATABASE_CONFIG, inputs)
+                except Exception as e:
+                    results = []
+                    st.error(f"❌ 查詢配方失敗：{e}")
+
+                if not results:
                     st.warning("⚠️ 找不到符合的配方")
                     st.toast("查詢完成：沒有符合的配方", icon="⚠️")
                 else:
-                    results = []
-                    for _, recipe in matched.iterrows():
-                        # 找最近的生產日期
-                        orders = df_order[df_order["配方編號"].astype(str) == str(recipe["配方編號"])]
-                        last_date = pd.NaT
-                        if not orders.empty and "生產日期" in orders.columns:
-                            orders["生產日期"] = pd.to_datetime(orders["生產日期"], errors="coerce")
-                            last_date = orders["生產日期"].max()
-    
-                        # 色粉組成
-                        powders = [
-                            str(recipe[f"色粉編號{i}"]).strip()
-                            for i in range(1, 9)
-                            if str(recipe[f"色粉編號{i}"]).strip()
-                        ]
-                        powder_str = "、".join(powders)
-    
-                        results.append({
-                            "最後生產時間": last_date,
-                            "配方編號": recipe["配方編號"],
-                            "顏色": recipe["顏色"],
-                            "客戶名稱": recipe["客戶名稱"],
-                            "色粉組成": powder_str
-                        })
-    
                     df_result = pd.DataFrame(results)
-    
-                    if not df_result.empty:
-                        # 按最後生產時間排序（由近到遠）
-                        df_result = df_result.sort_values(by="最後生產時間", ascending=False)
-    
-                        # 格式化最後生產時間（避免 NaT 顯示成 NaT）
-                        df_result["最後生產時間"] = df_result["最後生產時間"].apply(
-                            lambda x: x.strftime("%Y-%m-%d") if pd.notnull(x) else ""
-                        )
-    
-                        st.dataframe(df_result, use_container_width=True)
-                        st.toast(f"查詢完成：找到 {len(df_result)} 筆配方", icon="✅")
+                    st.dataframe(df_result, use_container_width=True)
+                    st.toast(f"查詢完成：找到 {len(df_result)} 筆配方", icon="✅")
 
     # ========== Tab 2：色粉用量查詢 ==========
     with tab2:
@@ -8983,13 +8897,18 @@ elif menu == "庫存區":
 
     force_reload_stock = st.session_state.pop("stock_need_reload", False)
 
+    # 版本號只讀一次，庫存記錄與庫存摘要快取共用同一組鍵
+    stock_versions = read_data_versions()
     try:
-        records = list_inventory_movements(DATABASE_CONFIG)
-        df_stock = pd.DataFrame(records) if records else pd.DataFrame(
-            columns=["類型", "色粉編號", "日期", "數量", "單位", "備註"]
+        df_stock = refresh_cached_frame(
+            "_stock_page_movements", "_sync_id", list_inventory_movements_changed_since,
+            tables=("inventory_movements",), versions=stock_versions,
         )
+        if df_stock.empty:
+            df_stock = pd.DataFrame(columns=["類型", "色粉編號", "日期", "數量", "單位", "備註"])
     except Exception:
         df_stock = pd.DataFrame(columns=["類型", "色粉編號", "日期", "數量", "單位", "備註"])
+        stock_versions = {}
 
     st.session_state.df_stock = df_stock
 
@@ -9015,232 +8934,8 @@ elif menu == "庫存區":
             return f"{_trim_num(val / 1000)} kg"
         return f"{_trim_num(val)} g"
 
-    def calc_usage_for_stock(powder_id, df_order, df_recipe, start_dt, end_dt):
-        """計算指定色粉在 (start_dt, end_dt] 區間的生產用量（g）
-        
-        修正：除了搜尋色粉編號欄位外，也處理「合計類別」== powder_id 的情況
-        合計類別用量 = (淨重 - 所有色粉重量合計) × 包裝總量
-        """
-        total_usage_g = 0.0
-        df_order_local = df_order.copy()
-
-        def normalize_recipe_id(raw_val):
-            return fix_leading_zero(clean_powder_id(str(raw_val or "")))
-    
-        if "生產時間" not in df_order_local.columns:
-            return 0.0
-    
-        df_order_local["生產時間"] = pd.to_datetime(df_order_local["生產時間"], errors="coerce")
-    
-        powder_cols = [f"色粉編號{i}" for i in range(1, 9)]
-        powder_weight_cols = [f"色粉重量{i}" for i in range(1, 9)]
-    
-        for c in powder_cols + powder_weight_cols:
-            if c not in df_order_local.columns:
-                df_order_local[c] = ""
-    
-        candidate_ids = set()
-        candidate_total_ids = set()  # 合計類別為 powder_id 的配方
-    
-        if not df_recipe.empty:
-            recipe_df_copy = df_recipe.copy()
-            for c in powder_cols:
-                if c not in recipe_df_copy.columns:
-                    recipe_df_copy[c] = ""
-    
-            # 一般色粉欄位搜尋
-            mask = recipe_df_copy[powder_cols].astype(str).apply(
-                lambda row: powder_id in [s.strip() for s in row.values], axis=1
-            )
-            candidate_ids = set(
-                recipe_df_copy[mask]["配方編號"].map(normalize_recipe_id).tolist()
-            )
-    
-            # 合計類別搜尋（LA/T9/料 等）
-            if "合計類別" in recipe_df_copy.columns and "淨重" in recipe_df_copy.columns:
-                mask_total = recipe_df_copy["合計類別"].astype(str).str.strip().str.upper() == powder_id.upper()
-                candidate_total_ids = set(
-                    recipe_df_copy[mask_total]["配方編號"].map(normalize_recipe_id).tolist()
-                )
-    
-        if not candidate_ids and not candidate_total_ids:
-            return 0.0
-    
-        s_dt = pd.to_datetime(start_dt, errors="coerce")
-        e_dt = pd.to_datetime(end_dt,   errors="coerce")
-    
-        orders_in_range = df_order_local[
-            df_order_local["生產時間"].notna() &
-            (df_order_local["生產時間"] > s_dt) &
-            (df_order_local["生產時間"] <= e_dt)
-        ]
-    
-        # 先建一次「主配方 + 附加配方」查找表，避免每筆訂單都重複篩選 DataFrame
-        recipe_rows_map = {}
-        if not df_recipe.empty and "配方編號" in df_recipe.columns:
-            recipe_df_local = df_recipe.copy()
-            recipe_df_local["_rid_norm"] = recipe_df_local["配方編號"].map(normalize_recipe_id)
-
-            add_by_base = {}
-            if "配方類別" in recipe_df_local.columns and "原始配方" in recipe_df_local.columns:
-                add_df = recipe_df_local[
-                    recipe_df_local["配方類別"].astype(str).str.strip() == "附加配方"
-                ].copy()
-                if not add_df.empty:
-                    add_df["_base_norm"] = add_df["原始配方"].map(normalize_recipe_id)
-                    for base_id, grp in add_df.groupby("_base_norm", dropna=False):
-                        add_by_base[base_id] = grp.to_dict("records")
-
-            for rid, grp in recipe_df_local.groupby("_rid_norm", dropna=False):
-                if not rid:
-                    continue
-                rows = [grp.iloc[0].to_dict()]
-                rows.extend(add_by_base.get(rid, []))
-                recipe_rows_map[rid] = rows
-
-        for _, order in orders_in_range.iterrows():
-            packs_total_kg = calc_packs_total_kg(order)
-
-            if packs_total_kg <= 0:
-                continue
-
-            order_recipe_id = normalize_recipe_id(order.get("配方編號", ""))
-            if not order_recipe_id:
-                continue
-
-            recipe_rows = recipe_rows_map.get(order_recipe_id, [])
-
-            for rec in recipe_rows:
-                rec_id = normalize_recipe_id(rec.get("配方編號", ""))
-    
-                # ── 一般色粉欄位命中 ──
-                if rec_id in candidate_ids:
-                    pvals = [str(rec.get(f"色粉編號{i}", "")).strip() for i in range(1, 9)]
-                    if powder_id in pvals:
-                        idx = pvals.index(powder_id) + 1
-                        try:
-                            pw = float(rec.get(f"色粉重量{idx}", 0) or 0)
-                        except Exception:
-                            pw = 0.0
-                        if pw > 0:
-                            total_usage_g += pw * packs_total_kg
-    
-                # ── 合計類別命中：用量 = (淨重 - 色粉合計) × 包裝 ──
-                if rec_id in candidate_total_ids:
-                    rec_total_type = str(rec.get("合計類別", "")).strip()
-                    if rec_total_type.upper() == powder_id.upper():
-                        try:
-                            net_weight = float(rec.get("淨重", 0) or 0)
-                        except Exception:
-                            net_weight = 0.0
-                        powder_sum = 0.0
-                        for i in range(1, 9):
-                            try:
-                                powder_sum += float(rec.get(f"色粉重量{i}", 0) or 0)
-                            except Exception:
-                                pass
-                        remainder = net_weight - powder_sum
-                        if remainder > 0:
-                            total_usage_g += remainder * packs_total_kg
-    
-        return total_usage_g
-
-    def safe_calc_usage(pid, df_order, df_recipe, start_dt, end_dt):
-        try:
-            if pd.isna(start_dt) or pd.isna(end_dt) or start_dt > end_dt:
-                return 0.0
-            if df_order.empty or df_recipe.empty:
-                return 0.0
-            return calc_usage_for_stock(pid, df_order, df_recipe, start_dt, end_dt)
-        except Exception:
-            return 0.0
-
     def build_stock_summary(stock_powder="", match_mode="部分匹配", query_start=None, query_end=None, category_filter=None):
         """依條件計算庫存摘要（單位 g），可依色粉類別過濾。"""
-        df_stock_copy = df_stock.copy()
-
-        def parse_stock_datetime_series(series):
-            if series is None:
-                return pd.Series(pd.NaT, index=df_stock_copy.index)
-
-            def parse_one(val):
-                if pd.isna(val):
-                    return pd.NaT
-
-                if isinstance(val, (datetime, pd.Timestamp)):
-                    return pd.to_datetime(val, errors="coerce")
-                if isinstance(val, date):
-                    return pd.Timestamp(val)
-
-                text = str(val).strip()
-                if not text:
-                    return pd.NaT
-
-                parsed = pd.to_datetime(text, errors="coerce")
-                if pd.notna(parsed):
-                    return parsed
-
-                numeric_serial = pd.to_numeric(text, errors="coerce")
-                if pd.notna(numeric_serial):
-                    return pd.to_datetime("1899-12-30") + pd.to_timedelta(numeric_serial, unit="D")
-
-                for fmt in (
-                    "%Y/%m/%d %H:%M:%S",
-                    "%Y/%m/%d %H:%M",
-                    "%Y-%m-%d %H:%M:%S",
-                    "%Y-%m-%d %H:%M",
-                    "%Y/%m/%d",
-                    "%Y-%m-%d",
-                ):
-                    try:
-                        return pd.to_datetime(datetime.strptime(text, fmt))
-                    except Exception:
-                        continue
-
-                return pd.NaT
-
-            return series.apply(parse_one)
-
-        raw_date_source = df_stock_copy["日期"] if "日期" in df_stock_copy.columns else None
-        raw_datetime_source = df_stock_copy["日期時間"] if "日期時間" in df_stock_copy.columns else None
-
-        # 保留原始輸入，避免後續僅靠 Timestamp(00:00:00) 無法判斷是否有「明確填寫時間」
-        if raw_date_source is not None:
-            df_stock_copy["_raw_日期"] = raw_date_source
-        else:
-            df_stock_copy["_raw_日期"] = ""
-
-        if raw_datetime_source is not None:
-            df_stock_copy["_raw_日期時間"] = raw_datetime_source
-        else:
-            df_stock_copy["_raw_日期時間"] = ""
-
-        raw_date_dt = parse_stock_datetime_series(raw_date_source)
-        raw_datetime_dt = parse_stock_datetime_series(raw_datetime_source)
-        df_stock_copy["日期時間"] = raw_datetime_dt.combine_first(raw_date_dt)
-        df_stock_copy["日期"] = raw_date_dt.dt.normalize()
-        df_stock_copy["數量_g"] = df_stock_copy.apply(lambda r: to_grams(r["數量"], r["單位"]), axis=1)
-        df_stock_copy["色粉編號"] = df_stock_copy["色粉編號"].astype(str).str.strip()
-
-        df_order_copy = df_order.copy()
-
-        def get_order_datetime(row):
-            # 優先用「生產日期」，其次才是生產時間/建立時間
-            if "生產日期" in row and pd.notna(row["生產日期"]):
-                dt = pd.to_datetime(row["生產日期"], errors="coerce")
-                if pd.notna(dt):
-                    return dt + pd.Timedelta(hours=12)
-
-            for col_name in ["生產時間", "建立時間"]:
-                if col_name in row and pd.notna(row[col_name]):
-                    dt = pd.to_datetime(row[col_name], errors="coerce")
-                    if pd.notna(dt):
-                        return dt
-            return pd.NaT
-
-        if not df_order_copy.empty:
-            df_order_copy["生產時間"] = df_order_copy.apply(get_order_datetime, axis=1)
-
         allowed_ids = None
         if category_filter:
             df_color_local = st.session_state.get("df_color", pd.DataFrame()).copy()
@@ -9256,8 +8951,8 @@ elif menu == "庫存區":
             all_pids = [stock_powder]
         else:
             pids_from_stock = (
-                df_stock_copy["色粉編號"].dropna().unique().tolist()
-                if not df_stock_copy.empty else []
+                df_stock["色粉編號"].astype(str).str.strip().unique().tolist()
+                if not df_stock.empty else []
             )
             pids_from_recipe = []
             if not df_recipe.empty:
@@ -9291,56 +8986,50 @@ elif menu == "庫存區":
         if "last_final_stock" not in st.session_state:
             st.session_state["last_final_stock"] = {}
 
-        stock_summary = []
-        for pid in all_pids:
-            df_pid = df_stock_copy[df_stock_copy["色粉編號"] == pid]
-
-            df_ini = df_pid[df_pid["類型"].astype(str).str.strip() == "初始"]
-            if not df_ini.empty:
-                latest_ini = df_ini.sort_values("日期時間", ascending=False).iloc[0]
-                ini_value = latest_ini["數量_g"]
-                ini_dt = latest_ini["日期時間"]
-                if pd.isna(ini_dt) and "日期" in latest_ini and pd.notna(latest_ini["日期"]):
-                    ini_dt = pd.to_datetime(latest_ini["日期"], errors="coerce")
-                if pd.notna(ini_dt):
-                    # ✅ 業務規則：期初庫存採「日期」語意，不採時間點語意
-                    # 代表該日清點結束後的期初基準，扣料自次日開始
-                    ini_note = f"期初來源：{ini_dt.strftime('%Y/%m/%d')}"
-                else:
-                    ini_note = "期初來源：未提供日期"
-            else:
-                ini_value = 0.0
-                ini_dt = pd.NaT
-                ini_note = "—"
+        # 生產單用量改讀 order_powder_consumption ledger：一次 SUM ... GROUP BY 取回每日用量，
+        # 生產單時間仍以「生產日期 12:00」計，與期初「當日結束後起算」的規則一致。
+        try:
+            usage_rows = list_powder_usage(
+                DATABASE_CONFIG,
+                start_dt.date() if query_start else None,
+                end_dt.date(),
+                powder_ids=all_pids if stock_powder or allowed_ids is not None else None,
+                by_date=True,
+            )
+        except Exception as e:
+            usage_rows = []
+            st.warning(f"⚠️ 無法讀取生產單用量：{e}")
+        usage_df = pd.DataFrame({
+            "色粉編號": [row["colorpowder_id"] for row in usage_rows],
+            "生產時間": pd.to_datetime([row["production_date"] for row in usage_rows]) + pd.Timedelta(hours=12),
+            "用量_g": [float(row["grams"] or 0) for row in usage_rows],
+        })
 
-            if pd.notna(ini_dt):
-                ini_effective_start_dt = ini_dt.normalize() + pd.Timedelta(hours=23, minutes=59, seconds=59)
-            else:
-                ini_effective_start_dt = ini_dt
+        # 全部色粉一次以 groupby 計算（utils/stock_engine.py），不再逐色粉篩選 DataFrame；
+        # 結果以庫存與生產單的 data_versions 版本號快取在模組層，所有 session 共用同一份，
+        # 版本號讀不到時才退回內容指紋
+        version_key = tuple(
+            stock_versions.get(table)
+            for table in ("inventory_movements", "production_orders", "recipe_components", "order_powder_consumption")
+        )
+        summary_df = compute_stock_summary(
+            df_stock, usage_df, all_pids,
+            start=start_dt if query_start else None, end=end_dt,
+            version_key=None if None in version_key else version_key,
+        )
 
-            if pd.notna(ini_effective_start_dt):
-                calc_start_dt = max(start_dt, ini_effective_start_dt)
+        stock_summary = []
+        for row in summary_df.itertuples(index=False):
+            pid, ini_value, ini_dt, has_initial, in_qty, usage_qty, final_g = row
+            if pd.notna(ini_dt):
+                # ✅ 業務規則：期初庫存採「日期」語意，不採時間點語意
+                # 代表該日清點結束後的期初基準，扣料自次日開始
+                ini_note = f"期初來源：{ini_dt.strftime('%Y/%m/%d')}"
+            elif has_initial:
+                ini_note = "期初來源：未提供日期"
             else:
-                # 沒有期初時，至少從該色粉最早庫存紀錄日開始，避免從 Timestamp.min 掃描全歷史
-                earliest_stock_dt = pd.to_datetime(df_pid["日期時間"], errors="coerce").min()
-                if pd.notna(earliest_stock_dt):
-                    calc_start_dt = max(start_dt, earliest_stock_dt.normalize())
-                else:
-                    calc_start_dt = start_dt
-
-            purchase_types = {"進貨", "新增庫存"}
-            in_qty = df_pid[
-                (df_pid["類型"].astype(str).str.strip().isin(purchase_types)) &
-                (df_pid["日期時間"] > calc_start_dt) &
-                (df_pid["日期時間"] <= end_dt)
-            ]["數量_g"].sum()
-
-            usage_qty = (
-                safe_calc_usage(pid, df_order_copy, df_recipe, calc_start_dt, end_dt)
-                if not df_order.empty and not df_recipe.empty else 0.0
-            )
+                ini_note = "—"
 
-            final_g = ini_value + in_qty - usage_qty
             st.session_state["last_final_stock"][pid] = final_g
 
             stock_summary.append({
@@ -10533,7 +10222,7 @@ elif menu == "庫存區":
     # Tab 4：色粉用量排行榜
     # ====================================================================
     # ✅ 優化重點：
-    #   1. 全程使用 session_state 的 df_order / df_recipe，不重讀 Sheet
+    #   1. 用量由 order_powder_consumption ledger 以 SQL 彙總，不再逐張展開配方
     #   2. 排行結果快取到 session_state["rank_result"]，相同條件不重算
     # ====================================================================
     with tab4:
@@ -10550,59 +10239,16 @@ elif menu == "庫存區":
                 # 相同條件 → 直接跳到顯示（不重算）
                 pass
             else:
-                # ── 純記憶體計算，不打 API ──
-                df_order_copy  = df_order.copy()
-                df_recipe_copy = df_recipe.copy()
-
-                powder_cols = [f"色粉編號{i}" for i in range(1, 9)]
-                weight_cols = [f"色粉重量{i}" for i in range(1, 9)]
-                for c in powder_cols + weight_cols + ["配方編號", "配方類別", "原始配方"]:
-                    if c not in df_recipe_copy.columns:
-                        df_recipe_copy[c] = ""
-
-                if "生產日期" in df_order_copy.columns:
-                    df_order_copy["生產日期"] = pd.to_datetime(df_order_copy["生產日期"], errors="coerce")
-                else:
-                    df_order_copy["生產日期"] = pd.NaT
-
-                orders_in_range = df_order_copy[
-                    df_order_copy["生產日期"].notna() &
-                    (df_order_copy["生產日期"] >= pd.to_datetime(rank_start)) &
-                    (df_order_copy["生產日期"] <= pd.to_datetime(rank_end))
-                ]
-
-                pigment_usage = {}
-
-                for _, order in orders_in_range.iterrows():
-                    order_recipe_id = str(order.get("配方編號", "")).strip()
-                    if not order_recipe_id:
-                        continue
-
-                    recipe_rows = []
-                    main_df = df_recipe_copy[df_recipe_copy["配方編號"].astype(str) == order_recipe_id]
-                    if not main_df.empty:
-                        recipe_rows.append(main_df.iloc[0].to_dict())
-                    add_df = df_recipe_copy[
-                        (df_recipe_copy["配方類別"] == "附加配方") &
-                        (df_recipe_copy["原始配方"].astype(str) == order_recipe_id)
-                    ]
-                    if not add_df.empty:
-                        recipe_rows.extend(add_df.to_dict("records"))
-
-                    packs_total = calc_packs_total_kg(order)
-
-                    if packs_total <= 0:
-                        continue
-
-                    for rec in recipe_rows:
-                        for i in range(1, 9):
-                            pid = str(rec.get(f"色粉編號{i}", "")).strip()
-                            try:
-                                pw = float(rec.get(f"色粉重量{i}", 0) or 0)
-                            except Exception:
-                                pw = 0.0
-                            if pid and pw > 0:
-                                pigment_usage[pid] = pigment_usage.get(pid, 0.0) + pw * packs_total
+                # ── 讀 order_powder_consumption ledger，一次 SUM ... GROUP BY ──
+                # 排行榜沿用原本的算法：每個色粉欄位都加總，不含合計類別餘量
+                try:
+                    pigment_usage = {
+                        row["colorpowder_id"]: float(row["grams"] or 0)
+                        for row in list_powder_usage(DATABASE_CONFIG, rank_start, rank_end, basis="ranking")
+                    }
+                except Exception as e:
+                    st.warning(f"⚠️ 無法讀取生產單用量：{e}")
+                    pigment_usage = {}
 
                 df_rank = pd.DataFrame([
                     {"色粉編號": k, "總用量_g": v} for k, v in pigment_usage.items()
@@ -11747,7 +11393,7 @@ if menu == "試色記錄分析":
         keyword = selected_q_customer.split(" - ",1)[0].strip() if selected_q_customer else ""
         dfv_seed = get_cached_sheet_df("試色登錄")
         if not dfv_seed.empty and "試色日期" in dfv_seed.columns:
-            seed_dates = pd.to_datetime(dfv_seed["試色日期"], errors="coerce").dropna()
+            seed_dates = parse_datetime_series(dfv_seed["試色日期"]).dropna()
             if len(seed_dates) > 0:
                 default_start = seed_dates.min().date()
                 default_end = datetime.now().date()
@@ -11773,7 +11419,7 @@ if menu == "試色記錄分析":
         elif start_d > end_d:
             st.warning("起日不可晚於迄日"); st.toast("請調整日期區間", icon="⚠️")
         elif not dfv.empty:
-            dfv["試色日期"] = pd.to_datetime(dfv["試色日期"], errors="coerce")
+            dfv["試色日期"] = parse_datetime_series(dfv["試色日期"])
             dfv = dfv[(dfv["試色日期"] >= pd.to_datetime(start_d)) & (dfv["試色日期"] <= pd.to_datetime(end_d))]
             if keyword:
                 m = dfv["客戶名稱"].astype(str).str.contains(keyword, case=False, na=False) | dfv["客戶編號"].astype(str).str.contains(keyword, case=False, na=False)
@@ -11859,12 +11505,12 @@ if menu == "試色記錄分析":
                         track_df = track_df[track_df["日期精度"].astype(str) == "精確"]
                 pending_df = track_df.copy()
                 if not pending_df.empty and "試色日期" in pending_df.columns:
-                    pending_df["天數"] = (pd.Timestamp.now().normalize() - pd.to_datetime(pending_df["試色日期"], errors="coerce")).dt.days
+                    pending_df["天數"] = (pd.Timestamp.now().normalize() - parse_datetime_series(pending_df["試色日期"])).dt.days
                     pending_df = pending_df[pending_df["天數"].fillna(0) >= pending_days_default]
                 for col in ["日期精度", "歷史補登", "採購日期", "客戶名稱", "原料", "主配方編號", "已採購"]:
                     if col not in pending_df.columns:
                         pending_df[col] = ""
-                pending_df["試色日期"] = pd.to_datetime(pending_df["試色日期"], errors="coerce").dt.strftime("%Y-%m-%d")
+                pending_df["試色日期"] = parse_datetime_series(pending_df["試色日期"]).dt.strftime("%Y-%m-%d")
                 pending_df.loc[pending_df["已採購"].astype(str) != "是", "採購日期"] = ""
 
                 if pending_df.empty:
@@ -11875,7 +11521,7 @@ if menu == "試色記錄分析":
 
             with st.expander("客戶月趨勢（近12月）", expanded=False):
                 trend_df = dfv.copy()
-                trend_df["月份"] = pd.to_datetime(trend_df["試色日期"], errors="coerce").dt.to_period("M").astype(str)
+                trend_df["月份"] = parse_datetime_series(trend_df["試色日期"]).dt.to_period("M").astype(str)
                 monthly = trend_df.groupby("月份").agg(
                     試色配方數=("主配方編號", lambda x: x.astype(str).replace("", pd.NA).dropna().nunique()),
                     試色次數=("配方編號", "count"),
@@ -11959,7 +11605,7 @@ if menu == "試色記錄分析":
             for col in ["日期精度", "歷史補登", "採購日期", "客戶名稱", "原料", "主配方編號", "已採購"]:
                 if col not in show.columns:
                     show[col] = ""
-            show["試色日期"] = pd.to_datetime(show["試色日期"], errors="coerce").dt.strftime("%Y-%m-%d")
+            show["試色日期"] = parse_datetime_series(show["試色日期"]).dt.strftime("%Y-%m-%d")
             show.loc[show["已採購"].astype(str) != "是", "採購日期"] = ""
             csv = show.to_csv(index=False).encode("utf-8-sig")
             pending_csv = pending_df.to_csv(index=False).encode("utf-8-sig") if not pending_df.empty else "".encode("utf-8-sig")
@@ -12033,6 +11679,11 @@ if st.session_state.menu == "同步檢查":
         "OK" if DATABASE_HEALTH.select_1_ok and DATABASE_HEALTH.main_tables_exist else "FAILED",
     )
     schema_col.metric("Schema version", DATABASE_HEALTH.schema_version or "—")
+    pool_stats = connection_pool_stats(DATABASE_CONFIG)
+    pool_hit_col, pool_miss_col, pool_idle_col = st.columns(3)
+    pool_hit_col.metric("連線池重用（省下 handshake）", pool_stats.hits)
+    pool_miss_col.metric("新建連線", pool_stats.misses)
+    pool_idle_col.metric("閒置連線", f"{pool_stats.idle}/{pool_stats.max_size}")
 
     if DATABASE_BACKEND != "turso":
         st.error("目前 backend 不是 Turso。請先確認 TURSO_DATABASE_URL 與 TURSO_AUTH_TOKEN secrets。")
@@ -12823,12 +12474,12 @@ if st.session_state.menu == "同步檢查":
                     f"請輸入 {required_apply_confirmation}",
                     key=f"sync_apply_confirmation_{audit_sheet}",
                 )
-                apply_changes = st.button(
+                apply_sheet_changes = st.button(
                     "套用新增／修改到 Turso",
                     type="primary",
                     disabled=apply_confirmation.strip() != required_apply_confirmation,
                 )
-                if apply_changes:
+                if apply_sheet_changes:
                     apply_committed = False
                     try:
                         with st.spinner(f"重新檢查並套用「{audit_sheet}」增量變更..."):
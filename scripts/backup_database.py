@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Create compressed, checksummed database backups or verify (and restore) one."""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.backup import BACKUP_KEEP_LAST, DEFAULT_BACKUP_DIR, create_backup, verify_backup
+from utils.database import DatabaseConfig, database_config_from_secrets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="Snapshot the database into the backup directory.")
+    create.add_argument(
+        "--db",
+        help="Force a local SQLite database path. If omitted, TURSO_DATABASE_URL and TURSO_AUTH_TOKEN select Turso.",
+    )
+    create.add_argument("--backup-dir", default=str(DEFAULT_BACKUP_DIR))
+    create.add_argument("--compression", choices=("gzip", "lzma", "none"), default="gzip")
+    create.add_argument("--keep-last", type=int, default=BACKUP_KEEP_LAST, help="Always keep this many newest backups.")
+    create.add_argument("--keep-days", type=int, help="Also keep every backup younger than this many days.")
+
+    verify = commands.add_parser("verify", help="Check a backup's checksum and run PRAGMA quick_check.")
+    verify.add_argument("path")
+    verify.add_argument("--restore-to", help="Write the verified database to this new path.")
+
+    args = parser.parse_args()
+    if args.command == "create":
+        config = (
+            DatabaseConfig(backend="sqlite", path=Path(args.db))
+            if args.db
+            else database_config_from_secrets()
+        )
+        print(f"Database backend: {config.backend}")
+        result = create_backup(
+            config, args.backup_dir,
+            compression=args.compression, keep_last=args.keep_last, keep_days=args.keep_days,
+        )
+        print(f"Backup written: {result.path} ({result.size_bytes} bytes, sha256 {result.sha256})")
+        print(f"Tables: {sum(result.tables.values())} rows in {len(result.tables)} tables")
+        for path in result.removed:
+            print(f"Rotated out: {path}")
+        return
+
+    result = verify_backup(args.path, restore_to=args.restore_to)
+    checksum = {True: "ok", False: "MISMATCH", None: "no manifest"}[result.checksum_ok]
+    print(f"Checksum: {checksum}")
+    print(f"quick_check: {'; '.join(result.quick_check)}")
+    if result.restored_to:
+        print(f"Restored to: {result.restored_to}")
+    if not result.ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Benchmark the columnar Sheet diff against the per-row preflight it replaces."""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.sheet_import import INVENTORY_COLUMNS, _records_from_values, _row_hash, _row_key, diff_sheet_values
+
+SHEET_NAME = "庫存記錄"
+
+
+def synthetic_inventory(rows: int, seed: int = 7) -> list[list[str]]:
+    rng = random.Random(seed)
+    values = [list(INVENTORY_COLUMNS)]
+    for index in range(rows):
+        values.append([
+            rng.choice(["初始", "進貨"]),
+            f"P{rng.randrange(2000):04d}",
+            f"2026/{rng.randint(1, 12)}/{rng.randint(1, 28)}",
+            str(rng.randint(1, 5000)),
+            rng.choice(["g", "kg"]),
+            rng.choice(["", "補貨", '含"引號"', "換行\n備註"]),
+            f"S{rng.randrange(50):03d}",
+            "供應商",
+            f"sync-{index:07d}",
+        ])
+    return values
+
+
+def per_row_plan(values: list[list[str]], baselines: dict[str, str]) -> tuple[int, int, int]:
+    inserts = updates = unchanged = 0
+    seen: set[str] = set()
+    for index, row in enumerate(_records_from_values(values)):
+        row_key = _row_key(SHEET_NAME, row, index)
+        if not row_key or row_key in seen:
+            continue
+        seen.add(row_key)
+        row_hash = _row_hash(row)
+        if row_key not in baselines:
+            inserts += 1
+        elif baselines[row_key] != row_hash:
+            updates += 1
+        else:
+            unchanged += 1
+    return inserts, updates, unchanged
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 50_000, 200_000])
+    args = parser.parse_args()
+    print(f"{'rows':>8} {'per-row s':>10} {'columnar s':>11} {'speedup':>8}  insert/update/unchanged")
+    for rows in args.rows:
+        values = synthetic_inventory(rows)
+        records = _records_from_values(values)
+        # 80% of rows have a baseline; every tenth of those is stale.
+        baselines = {
+            record["_sync_id"]: ("stale" if index % 10 == 0 else _row_hash(record))
+            for index, record in enumerate(records[: rows * 4 // 5])
+        }
+        started = time.perf_counter()
+        expected = per_row_plan(values, baselines)
+        per_row_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        diff = diff_sheet_values(SHEET_NAME, values, baselines)
+        columnar_seconds = time.perf_counter() - started
+        actual = (len(diff.inserts), len(diff.updates), diff.unchanged)
+        if actual != expected:
+            raise SystemExit(f"mismatch at {rows} rows: columnar {actual} != per-row {expected}")
+        print(
+            f"{rows:>8} {per_row_seconds:>10.3f} {columnar_seconds:>11.3f} "
+            f"{per_row_seconds / columnar_seconds:>7.1f}x  {'/'.join(map(str, actual))}"
+        )
+
+
+if __name__ == "__main__":
+    main()
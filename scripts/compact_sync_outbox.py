@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Collapse superseded outbox events and archive finished ones past the retention window."""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.database import DatabaseConfig, database_config_from_secrets, initialize_database_from_config
+from utils.sync_worker import OUTBOX_RETENTION_DAYS, compact_outbox
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--db",
+        help="Force a local SQLite database path. If omitted, TURSO_DATABASE_URL and TURSO_AUTH_TOKEN select Turso.",
+    )
+    parser.add_argument(
+        "--retention-days", type=int, default=OUTBOX_RETENTION_DAYS,
+        help="Keep completed and conflict events in sync_outbox for this many days.",
+    )
+    args = parser.parse_args()
+    config = (
+        DatabaseConfig(backend="sqlite", path=Path(args.db))
+        if args.db
+        else database_config_from_secrets()
+    )
+    print(f"Database backend: {config.backend}")
+    initialize_database_from_config(config)
+    result = compact_outbox(config, retention_days=args.retention_days)
+    print(f"Archived {result.superseded} superseded and {result.archived} finished outbox events")
+
+
+if __name__ == "__main__":
+    main()
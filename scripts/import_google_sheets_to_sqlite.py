@@ -37,6 +37,11 @@ def main():
         action="store_true",
         help="Validate and count changes without writing imported rows to the selected database.",
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="Commit every N planned rows with a resumable checkpoint; rerun the same command to resume.",
+    )
     args = parser.parse_args()
 
     config = (
@@ -51,6 +56,7 @@ def main():
         sheet_names=args.sheets,
         db_config=config,
         dry_run=args.dry_run,
+        chunk_size=args.chunk_size,
     )
     for result in results:
         status = "OK" if result.ok else "CHECK"
@@ -60,6 +66,8 @@ def main():
             print(f"  error: {error}")
         for duplicate in result.duplicate_ids[:10]:
             print(f"  duplicate: {duplicate}")
+        if result.chunks_committed:
+            print(f"  chunks committed: {result.chunks_committed}")
         for warning in result.warnings[:10]:
             print(f"  warning: {warning}")
 
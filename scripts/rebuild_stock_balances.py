@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Backfill the order consumption ledger and rebuild or verify powder_stock_balances."""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.database import DatabaseConfig, database_config_from_secrets, initialize_database_from_config
+from utils.stock_repository import (
+    backfill_order_powder_consumption,
+    check_powder_stock_balances,
+    complete_stock_upgrades,
+    rebuild_powder_stock_balances,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--db",
+        help="Force a local SQLite database path. If omitted, TURSO_DATABASE_URL and TURSO_AUTH_TOKEN select Turso.",
+    )
+    parser.add_argument(
+        "--backfill-consumption", action="store_true",
+        help="Rewrite order_powder_consumption for every active order before rebuilding balances.",
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help="Only compare stored balances with a from-scratch recompute; exits 1 on drift.",
+    )
+    args = parser.parse_args()
+    config = (
+        DatabaseConfig(backend="sqlite", path=Path(args.db))
+        if args.db
+        else database_config_from_secrets()
+    )
+    print(f"Database backend: {config.backend}")
+    initialize_database_from_config(config)
+    for completed in complete_stock_upgrades(config):
+        print(f"Completed queued upgrade: {completed}")
+    if args.backfill_consumption:
+        print(f"Backfilled consumption for {backfill_order_powder_consumption(config)} orders")
+    if not args.check:
+        print(f"Rebuilt balances for {rebuild_powder_stock_balances(config)} powders")
+    mismatches = check_powder_stock_balances(config)
+    for mismatch in mismatches[:20]:
+        stored = mismatch.stored["balance_g"] if mismatch.stored else None
+        expected = mismatch.expected["balance_g"] if mismatch.expected else None
+        print(f"  drift: {mismatch.colorpowder_id} stored={stored} expected={expected}")
+    print(f"Consistency check: {len(mismatches)} mismatched powders")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
 import sys
 from pathlib import Path
 
+import pytest
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
+
+from utils.database import close_connection_pools  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _close_pooled_connections():
+    yield
+    close_connection_pools()
@@ -1,3 +1,7 @@
+import random
+
+import pytest
+
 from utils.color_powder_repository import ColorPowderInput, create_color_powder
 from utils.database import DatabaseConfig, connect, initialize_database
 from utils.inbound_worker import run_controlled_inbound_worker
@@ -41,6 +45,166 @@ def test_import_preflight_bulk_loads_baselines_instead_of_querying_each_row(tmp_
     assert result.to_insert == result.to_update == 0
 
 
+def test_import_prefetches_changed_entities_in_chunks(tmp_path, monkeypatch):
+    db = tmp_path / "prefetch.db"
+    powders = [["色粉編號", "名稱"]] + [[f"P{index:03d}", "Powder"] for index in range(20)]
+    import_sheet_values("色粉管理", powders, db_path=db, abort_on_issues=True)
+    recipes = [["配方編號", "色粉編號1", "色粉重量1", "色粉編號2", "色粉重量2"]] + [
+        [f"R{index:03d}", f"P{index:03d}", "10", f"P{(index + 1) % 20:03d}", "5"] for index in range(20)
+    ]
+    recipes.append(["R999", "P404", "1", "", ""])
+    config = DatabaseConfig(backend="sqlite", path=db)
+    with connect(db) as conn:
+        conn.execute(
+            "INSERT INTO recipes(recipe_id, created_at, updated_at) VALUES ('R005', 'x', 'x')"
+        )
+    monkeypatch.setattr(sheet_import_module, "PREFETCH_CHUNK_SIZE", 8)
+
+    preflight = import_sheet_values("配方管理", recipes, db_config=config, dry_run=True)
+
+    # baseline + 3 recipe chunks + 3 powder chunks + final count, whatever the row count.
+    assert preflight.round_trips == 8
+    assert set(preflight.phase_seconds) == {"plan", "prefetch", "apply", "commit"}
+    assert preflight.to_insert == 21 and preflight.conflicts == 1
+    assert preflight.errors == ["row 22: unknown 色粉編號1 P404; import 色粉管理 first"]
+
+    applied = import_sheet_values("配方管理", recipes, db_config=config)
+    assert applied.inserted_or_updated == 19 and applied.conflicts == 1
+    with connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM recipe_components").fetchone()[0] == 38
+
+
+def _legacy_row_plan(sheet_name, values, baselines):
+    plan = {"missing": [], "duplicates": [], "inserts": [], "updates": [], "unchanged": 0, "hashes": {}}
+    seen = set()
+    for index, row in enumerate(sheet_import_module._records_from_values(values)):
+        row_key = sheet_import_module._row_key(sheet_name, row, index)
+        if not row_key:
+            plan["missing"].append(index)
+            continue
+        if row_key in seen:
+            plan["duplicates"].append(row_key)
+            continue
+        seen.add(row_key)
+        row_hash = sheet_import_module._row_hash(row)
+        plan["hashes"][index] = (row_key, row_hash, row)
+        if row_key not in baselines:
+            plan["inserts"].append(index)
+        elif baselines[row_key] != row_hash:
+            plan["updates"].append(index)
+        else:
+            plan["unchanged"] += 1
+    return plan
+
+
+@pytest.mark.parametrize("sheet_name", ["色粉管理", "供應商管理", "庫存記錄"])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_columnar_diff_matches_per_row_records(sheet_name, seed):
+    rng = random.Random(seed)
+    headers = {
+        "色粉管理": ["色粉編號", "名稱", "", "備註", "名稱"],
+        "供應商管理": ["supplier_id", "供應商編號", "供應商名稱", 'a"b'],
+        "庫存記錄": [" _sync_id ", "色粉編號", "數量", "更新時間"],
+    }[sheet_name]
+    cells = ["", " ", "P001", "P002", 'say "hi"', "back\\slash", "tab\tnew\nline", "\x01", "紅色", 12, 1.5, None]
+    values = [headers] + [
+        [rng.choice(cells) for _ in range(rng.randint(0, len(headers) + 1))] for _ in range(300)
+    ]
+    legacy = _legacy_row_plan(sheet_name, values, {})
+    baselines = {}
+    for index, (row_key, row_hash, _row) in legacy["hashes"].items():
+        if index % 3 == 0:
+            baselines[row_key] = row_hash
+        elif index % 3 == 1:
+            baselines[row_key] = "stale"
+    legacy = _legacy_row_plan(sheet_name, values, baselines)
+
+    diff = sheet_import_module.diff_sheet_values(sheet_name, values, baselines)
+
+    assert diff.missing_keys == legacy["missing"]
+    assert diff.duplicate_ids == legacy["duplicates"]
+    assert (diff.inserts, diff.updates, diff.unchanged) == (legacy["inserts"], legacy["updates"], legacy["unchanged"])
+    for index, row in zip(diff.changed, diff.records(diff.changed)):
+        assert (diff.row_keys[index], diff.row_hashes[index], row) == legacy["hashes"][index]
+        assert list(row) == list(legacy["hashes"][index][2])
+
+
+def test_chunked_import_resumes_after_checkpoint(tmp_path, monkeypatch):
+    db = tmp_path / "chunked.db"
+    import_sheet_values("色粉管理", [["色粉編號", "名稱"], ["P001", "Red"]], db_path=db)
+    values = [["類型", "色粉編號", "日期", "數量", "單位", "_sync_id"]] + [
+        ["進貨", "P404" if index == 1 else "P001", "2026/1/1", str(index + 1), "g", f"m{index}"]
+        for index in range(7)
+    ]
+    upsert = sheet_import_module.upsert_sheet_row
+
+    def fail_on_m5(conn, sheet_name, row_key, *args):
+        if row_key == "m5":
+            raise RuntimeError("connection lost")
+        return upsert(conn, sheet_name, row_key, *args)
+
+    monkeypatch.setattr(sheet_import_module, "upsert_sheet_row", fail_on_m5)
+    with pytest.raises(RuntimeError, match="connection lost"):
+        import_sheet_values("庫存記錄", values, db_path=db, chunk_size=2)
+    with connect(db) as conn:
+        committed = [row[0] for row in conn.execute("SELECT sheet_row_key FROM inventory_movements ORDER BY sheet_row_key")]
+        checkpoint = conn.execute(
+            "SELECT status, high_watermark FROM sync_state WHERE sync_name='import_checkpoint:庫存記錄'"
+        ).fetchone()
+    assert committed == ["m0", "m2", "m3"]
+    assert tuple(checkpoint) == ("in_progress", "3")
+
+    monkeypatch.setattr(sheet_import_module, "upsert_sheet_row", upsert)
+    resumed = import_sheet_values("庫存記錄", values, db_path=db, chunk_size=2)
+
+    assert resumed.resumed_after_row == 3
+    assert resumed.inserted_or_updated == 3 and resumed.errors == []
+    assert resumed.chunks_committed == 2
+    with connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM inventory_movements").fetchone()[0] == 6
+        assert conn.execute(
+            "SELECT status FROM sync_state WHERE sync_name='import_checkpoint:庫存記錄'"
+        ).fetchone()[0] == "completed"
+    with pytest.raises(ValueError):
+        import_sheet_values("庫存記錄", values, db_path=db, chunk_size=2, abort_on_issues=True)
+
+
+def test_import_order_follows_sheet_dependencies():
+    names = ["生產單", "庫存記錄", "配方管理", "供應商管理", "色粉管理"]
+
+    assert sheet_import_module.import_order(names) == ["供應商管理", "色粉管理", "庫存記錄", "配方管理", "生產單"]
+    assert sheet_import_module.import_order(["生產單", "配方管理"]) == ["配方管理", "生產單"]
+
+
+def test_import_worksheets_reads_concurrently_and_applies_in_dependency_order(tmp_path):
+    import threading
+
+    barrier = threading.Barrier(3, timeout=5)
+
+    class BarrierWorksheet(Worksheet):
+        def get_all_values(self):
+            # Sequential reads would leave the barrier waiting and break it.
+            barrier.wait()
+            return self.values
+
+    spreadsheet = Spreadsheet({})
+    spreadsheet.sheets = {
+        "配方管理": BarrierWorksheet([["配方編號", "色粉編號1", "色粉重量1"], ["R001", "P001", "10"]]),
+        "色粉管理": BarrierWorksheet([["色粉編號", "名稱"], ["P001", "Red"]]),
+        "供應商管理": BarrierWorksheet([["供應商編號", "供應商名稱"], ["S001", "Acme"]]),
+    }
+    db = tmp_path / "parallel.db"
+
+    results = sheet_import_module.import_worksheets(
+        spreadsheet, ["配方管理", "色粉管理", "供應商管理"], db_path=db
+    )
+
+    assert [result.sheet_name for result in results] == ["配方管理", "色粉管理", "供應商管理"]
+    assert all(result.ok and result.inserted_or_updated == 1 for result in results)
+    with connect(db) as conn:
+        assert conn.execute("SELECT colorpowder_id FROM recipe_components").fetchone()[0] == "P001"
+
+
 def test_controlled_inbound_preflights_then_applies_sheet_update(tmp_path):
     db = tmp_path / "inbound.db"
     baseline = [["色粉編號", "名稱", "備註"], ["P001", "Red", "old"]]
@@ -8,15 +8,23 @@ import utils.sheet_export as sheet_export_module
 
 from utils.database import (
     DatabaseConfig,
+    ConnectionPool,
     DatabaseStartupError,
+    close_connection_pools,
     connect,
     connect_from_config,
+    connection_pool_stats,
+    current_versions,
     database_config_from_secrets,
     database_health_check,
     enqueue_sheet_sync,
+    execute_batch,
+    flush_write_behind,
     format_database_startup_diagnostics,
     initialize_database,
+    initialize_database_from_config,
     log_database_startup_diagnostics,
+    missing_keys,
 )
 from utils.sheet_export import (
     sync_color_powder_outbox,
@@ -30,6 +38,7 @@ from utils.color_powder_repository import (
     ColorPowderInput,
     create_color_powder,
     list_color_powders,
+    list_color_powders_changed_since,
     update_color_powder,
     set_color_powder_active,
 )
@@ -41,11 +50,21 @@ from utils.supplier_repository import (
     update_supplier,
     set_supplier_active,
 )
-from utils.recipe_repository import create_recipe, list_recipes, set_recipe_active, update_recipe
+from utils.recipe_repository import (
+    RecipeError,
+    create_recipe,
+    find_recipes_containing_powders,
+    list_recipes,
+    list_recipes_changed_since,
+    set_recipe_active,
+    update_recipe,
+)
 from utils.inventory_repository import (
     InventoryError,
     create_inventory_movement,
+    create_inventory_movements_bulk,
     list_inventory_movements,
+    list_inventory_movements_changed_since,
     reverse_inventory_movement,
     update_inventory_movement,
 )
@@ -53,17 +72,33 @@ from utils.production_order_repository import (
     ProductionOrderError,
     create_production_order,
     list_production_orders,
+    list_production_orders_changed_since,
+    next_production_order_id,
     set_production_order_cancelled,
     update_production_order,
 )
 from utils.sheet_import import (
     ImportAbortedError,
+    SharedBackoff,
     SheetReadError,
     import_sheet_values,
     missing_inventory_sync_id_updates,
     read_worksheet_values_with_retry,
+    read_worksheets_values,
+)
+from utils.backup import BackupError, copy_database_by_pages, create_backup, verify_backup
+from utils.frame_patch import apply_changes
+from utils.search_repository import search_production_orders, search_recipes
+from utils.stock_repository import (
+    backfill_order_powder_consumption,
+    check_powder_stock_balances,
+    complete_stock_upgrades,
+    get_powder_stock_balance,
+    list_powder_stock_balances,
+    list_powder_usage,
+    rebuild_powder_stock_balances,
 )
-from utils.sync_worker import acquire_worker_lock, release_worker_lock, run_safe_worker
+from utils.sync_worker import acquire_worker_lock, compact_outbox, release_worker_lock, run_safe_worker
 
 
 class FakeGoogleApiError(Exception):
@@ -127,6 +162,64 @@ def test_sheet_read_does_not_retry_permanent_google_errors():
     assert delays == []
 
 
+def test_sheet_reads_share_one_backoff():
+    backoff = SharedBackoff(clock=lambda: 0.0)
+    throttled = SequencedWorksheet([FakeGoogleApiError(429, "rate limited"), [["色粉編號"]]])
+    other = SequencedWorksheet([[["配方編號"]]])
+    delays = []
+
+    read_worksheet_values_with_retry(throttled, sleep=delays.append, backoff=backoff)
+    read_worksheet_values_with_retry(other, sleep=delays.append, backoff=backoff)
+
+    # The rate-limited read's delay also holds back the next reader.
+    assert delays == [1.0, 1.0]
+    assert (throttled.calls, other.calls) == (2, 1)
+
+
+def test_batched_sheet_read_uses_one_request_and_cached_metadata():
+    class BatchSpreadsheet:
+        id = "batch-read-test"
+
+        def __init__(self):
+            self.metadata_calls = 0
+            self.batches = []
+            self.outcomes = iter([
+                FakeGoogleApiError(429, "rate limited"),
+                {"valueRanges": [
+                    {"values": [["色粉編號", "名稱"], ["P001"]]},
+                    {"values": [["it's"]]},
+                    {},
+                ]},
+                {"valueRanges": [{"values": [["色粉編號"]]}]},
+            ])
+
+        def worksheets(self):
+            self.metadata_calls += 1
+            return [type("Worksheet", (), {"title": title})() for title in ("色粉管理", "it's", "空白")]
+
+        def worksheet(self, name):
+            raise AssertionError(f"per-sheet metadata request for {name}")
+
+        def values_batch_get(self, ranges):
+            self.batches.append(ranges)
+            outcome = next(self.outcomes)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+    spreadsheet = BatchSpreadsheet()
+    delays = []
+
+    values = read_worksheets_values(spreadsheet, ["色粉管理", "it's", "空白"], sleep=delays.append)
+    again = read_worksheets_values(spreadsheet, ["色粉管理"], sleep=delays.append)
+
+    assert values == {"色粉管理": [["色粉編號", "名稱"], ["P001", ""]], "it's": [["it's"]], "空白": []}
+    assert again == {"色粉管理": [["色粉編號"]]}
+    assert spreadsheet.batches[0] == ["'色粉管理'", "'it''s'", "'空白'"]
+    assert len(spreadsheet.batches) == 3 and delays == [1.0]
+    assert spreadsheet.metadata_calls == 1
+
+
 def test_sheet_read_hides_google_html_after_retry_exhaustion():
     html = "<!DOCTYPE html><html>very long Google error page</html>"
     worksheet = SequencedWorksheet([FakeGoogleApiError(502, html) for _ in range(4)])
@@ -266,6 +359,34 @@ def test_schema_v6_backfills_recipe_oem_multiplier_from_sheet_baseline(tmp_path)
     assert multiplier == 2.5
 
 
+def test_current_schema_skips_migrations_after_one_version_read(tmp_path):
+    from utils.database import MIGRATIONS, SCHEMA_VERSION, _initialize_schema
+
+    db = tmp_path / "current.db"
+    initialize_database(db)
+    statements = []
+
+    class RecordingConnection:
+        def __init__(self, conn):
+            self._conn = conn
+
+        def execute(self, sql, parameters=()):
+            statements.append(sql)
+            return self._conn.execute(sql, parameters)
+
+    with connect(db) as conn:
+        applied = _initialize_schema(RecordingConnection(conn))
+        conn.execute("DELETE FROM schema_migrations WHERE version=8")
+        reapplied = _initialize_schema(conn)
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_migrations ORDER BY version")]
+
+    assert applied == []
+    assert statements == ["SELECT version FROM schema_migrations"]
+    assert reapplied == [8]
+    assert versions == [migration.version for migration in MIGRATIONS]
+    assert MIGRATIONS[-1].version == SCHEMA_VERSION
+
+
 def test_import_color_powders_validates_duplicates(tmp_path):
     values = [
         ["色粉編號", "國際色號", "名稱", "色粉類別", "包裝", "備註"],
@@ -868,6 +989,1028 @@ def test_production_order_cancel_restore_preserves_history_and_queues_updates(tm
     assert tuple(entity) == ("draft", None, None)
 
 
+def test_stock_balances_follow_inventory_and_order_writes(tmp_path):
+    from datetime import date
+
+    db = tmp_path / "stock-balances.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    today = date.today().isoformat()
+    for powder_id in ("P100", "P200"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    create_recipe(config, {"配方編號": "R001", "色粉編號1": "P100", "色粉重量1": "2"})
+    create_recipe(config, {
+        "配方編號": "R001A", "配方類別": "附加配方", "原始配方": "R001",
+        "色粉編號1": "P100", "色粉重量1": "9", "色粉編號2": "P200", "色粉重量2": "3",
+    })
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P100", "日期": "2026-01-01", "數量": "5", "單位": "kg",
+    }, sync_id="init-1")
+    create_inventory_movement(config, {
+        "類型": "進貨", "色粉編號": "P100", "日期": "2026-01-02", "數量": "1000", "單位": "g",
+    }, sync_id="in-1")
+    create_inventory_movement(config, {
+        "類型": "進貨", "色粉編號": "P200", "日期": "2026-01-03", "數量": "2", "單位": "kg",
+    }, sync_id="in-2")
+    create_production_order(config, {
+        "生產單號": "O001", "生產日期": today, "配方編號": "R001",
+        "包裝重量1": "25K", "包裝份數1": "2",
+    })
+
+    p100 = get_powder_stock_balance(config, "P100")
+    assert (p100["initial_quantity_g"], p100["purchased_g"]) == (5000, 1000)
+    # The main recipe's 2 g/kg shadows the add-on's P100 weight; 50 kg packed.
+    assert p100["consumed_g"] == 100
+    assert p100["balance_g"] == 5900
+    assert get_powder_stock_balance(config, "P200")["balance_g"] == 2000 - 150
+
+    update_inventory_movement(config, "in-1", {
+        "類型": "進貨", "色粉編號": "P100", "日期": "2026-01-02", "數量": "2", "單位": "kg",
+    })
+    assert get_powder_stock_balance(config, "P100")["balance_g"] == 6900
+    reverse_inventory_movement(config, "in-1", reason="退貨")
+    assert get_powder_stock_balance(config, "P100")["balance_g"] == 4900
+
+    set_production_order_cancelled(config, "O001", cancelled=True, reason="客戶取消")
+    assert [
+        (row["colorpowder_id"], row["balance_g"]) for row in list_powder_stock_balances(config)
+    ] == [("P100", 5000), ("P200", 2000)]
+    assert check_powder_stock_balances(config) == []
+
+    # Every touched powder is recomputed from one grouped query per table.
+    from utils.stock_repository import refresh_powder_stock_balances
+
+    with connect(db) as conn:
+        selects = []
+        conn.set_trace_callback(lambda sql: selects.append(sql) if sql.lstrip().startswith("SELECT") else None)
+        refresh_powder_stock_balances(conn, ["P100", "P200", "P300"])
+        conn.set_trace_callback(None)
+    assert len(selects) == 2
+    assert check_powder_stock_balances(config) == []
+
+
+def test_order_consumption_ledger_uses_snapshot_and_follows_cancel(tmp_path):
+    from datetime import date
+
+    db = tmp_path / "consumption-ledger.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P100", "P200", "LA"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    create_recipe(config, {
+        "配方編號": "R001", "色粉編號1": "P100", "色粉重量1": "2", "色粉編號2": "P100", "色粉重量2": "7",
+        "淨重": "20", "合計類別": "LA",
+    })
+    create_recipe(config, {
+        "配方編號": "R001A", "配方類別": "附加配方", "原始配方": "R001",
+        "色粉編號1": "P200", "色粉重量1": "3",
+    })
+    create_production_order(config, {
+        "生產單號": "O001", "生產日期": "2026/05/02", "配方編號": "R001",
+        "包裝重量1": "10", "包裝份數1": "2",
+    })
+    # Non Y-M-D Sheet dates are dated the way the 生產單 page parses them.
+    create_production_order(config, {
+        "生產單號": "O002", "生產日期": "05/20/2026 08:30", "配方編號": "R001",
+        "包裝重量1": "1", "包裝份數1": "1",
+    })
+    # Later recipe edits do not rewrite the usage frozen on existing orders.
+    update_recipe(config, {"配方編號": "R001", "色粉編號1": "P100", "色粉重量1": "100"})
+
+    usage = list_powder_usage(config, date(2026, 5, 1), date(2026, 5, 31))
+    # First slot only (2 g/kg), add-on 3 g/kg, 合計類別 remainder 20 - 9 = 11 g/kg.
+    assert [(row["colorpowder_id"], row["grams"]) for row in usage] == [
+        ("LA", 231), ("P100", 42), ("P200", 63),
+    ]
+    # The 生產單 balance counts P100 once per order; the ranking adds both slots and skips 合計類別.
+    assert [
+        (row["colorpowder_id"], row["grams"])
+        for row in list_powder_usage(config, date(2026, 5, 1), date(2026, 5, 31), basis="balance")
+    ] == [("P100", 42), ("P200", 63)]
+    assert [
+        (row["colorpowder_id"], row["grams"])
+        for row in list_powder_usage(config, date(2026, 5, 1), date(2026, 5, 31), basis="ranking")
+    ] == [("P100", 189), ("P200", 63)]
+    daily = list_powder_usage(config, date(2026, 5, 1), date(2026, 5, 10), powder_ids=["P100"], by_date=True)
+    assert [(row["production_date"], row["grams"]) for row in daily] == [("2026-05-02", 40)]
+
+    set_production_order_cancelled(config, "O001", cancelled=True, reason="客戶取消")
+    assert list_powder_usage(config, powder_ids=["P100"]) == [{"colorpowder_id": "P100", "grams": 2}]
+    set_production_order_cancelled(config, "O001", cancelled=False)
+    assert list_powder_usage(config, powder_ids=["P100"])[0]["grams"] == 42
+
+    with connect(db) as conn:
+        conn.execute("DELETE FROM order_powder_consumption")
+    assert backfill_order_powder_consumption(config) == 2
+    assert list_powder_usage(config, powder_ids=["P100"])[0]["grams"] == 42
+
+
+def test_recipe_usage_vectors_fold_add_ons_and_total_category(tmp_path):
+    db = tmp_path / "usage-vectors.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P100", "P200", "LA"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+
+    def vectors():
+        with connect(db) as conn:
+            rows = conn.execute(
+                "SELECT recipe_id, colorpowder_id, grams_per_kg FROM recipe_usage_vectors ORDER BY 1, 2"
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    create_recipe(config, {
+        "配方編號": "R001", "色粉編號1": "P100", "色粉重量1": "2", "淨重": "10", "合計類別": "LA",
+    })
+    create_recipe(config, {
+        "配方編號": "R001A", "配方類別": "附加配方", "原始配方": "R001",
+        "色粉編號1": "P100", "色粉重量1": "1", "色粉編號2": "P200", "色粉重量2": "3",
+    })
+    assert vectors() == [
+        ("R001", "LA", 8.0), ("R001", "P100", 3.0), ("R001", "P200", 3.0),
+        ("R001A", "P100", 1.0), ("R001A", "P200", 3.0),
+    ]
+    with connect(db) as conn:
+        assert [tuple(row) for row in conn.execute(
+            """SELECT colorpowder_id, balance_grams_per_kg, ranking_grams_per_kg FROM recipe_usage_vectors
+               WHERE recipe_id='R001' ORDER BY 1"""
+        )] == [("LA", 0.0, 0.0), ("P100", 2.0, 3.0), ("P200", 3.0, 3.0)]
+
+    update_recipe(config, {
+        "配方編號": "R001A", "配方類別": "附加配方", "原始配方": "R001",
+        "色粉編號1": "P200", "色粉重量1": "4",
+    })
+    assert [row for row in vectors() if row[0] == "R001"] == [
+        ("R001", "LA", 8.0), ("R001", "P100", 2.0), ("R001", "P200", 4.0),
+    ]
+    set_recipe_active(config, "R001A", active=False, reason="停用")
+    assert vectors() == [("R001", "LA", 8.0), ("R001", "P100", 2.0)]
+    set_recipe_active(config, "R001", active=False, reason="停用")
+    assert vectors() == []
+    set_recipe_active(config, "R001", active=True)
+    set_recipe_active(config, "R001A", active=True)
+    assert [row for row in vectors() if row[0] == "R001"][-1] == ("R001", "P200", 4.0)
+
+    # Imported orders carry no recipe snapshot and are priced through the vectors.
+    with connect(db) as conn:
+        conn.execute(
+            """INSERT INTO production_orders(production_order_id, production_date, recipe_id, payload_json,
+                   source, created_at, updated_at)
+               VALUES ('O900', '2026-05-02', 'R001', '{"包裝重量1": "10", "包裝份數1": "1"}',
+                   'google_sheets_import', 'now', 'now')"""
+        )
+        conn.execute("DELETE FROM recipe_usage_vectors")
+        conn.execute("UPDATE sync_state SET status='rebuild_required' WHERE sync_name='recipe_usage_vectors'")
+    assert backfill_order_powder_consumption(config) == 1
+    assert [(row["colorpowder_id"], row["grams"]) for row in list_powder_usage(config)] == [
+        ("LA", 80), ("P100", 20), ("P200", 40),
+    ]
+
+
+def test_stock_balance_rebuild_and_checker_detect_drift(tmp_path):
+    from datetime import date
+
+    db = tmp_path / "stock-rebuild.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P100"))
+    create_recipe(config, {"配方編號": "R001", "色粉編號1": "P100", "色粉重量1": "1"})
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P100", "日期": "2026-01-01", "數量": "100", "單位": "g",
+    }, sync_id="init-1")
+    create_production_order(config, {
+        "生產單號": "O001", "生產日期": "2026-03-01", "配方編號": "R001",
+        "包裝重量1": "10", "包裝份數1": "1",
+    })
+
+    # Startup on 2026-02-01 runs the rebuild the fresh schema queued.
+    assert complete_stock_upgrades(config, today=date(2026, 2, 1)) == [
+        "record_days", "recipe_usage_vectors", "order_powder_consumption", "powder_stock_balances",
+    ]
+    before = get_powder_stock_balance(config, "P100", today=date(2026, 2, 1))
+    assert (before["balance_g"], before["pending_from"]) == (100, "2026-03-01")
+    # A read after the future-dated order comes due serves the rolled-forward balance without writing it.
+    assert get_powder_stock_balance(config, "P100", today=date(2026, 3, 1))["balance_g"] == 90
+    with connect(db) as conn:
+        assert conn.execute("SELECT balance_g FROM powder_stock_balances").fetchone()[0] == 100
+    assert complete_stock_upgrades(config, today=date(2026, 3, 1)) == []
+    with connect(db) as conn:
+        assert conn.execute("SELECT balance_g, pending_from FROM powder_stock_balances").fetchone()[:] == (90, None)
+
+    with connect(db) as conn:
+        conn.execute("UPDATE powder_stock_balances SET balance_g=0 WHERE colorpowder_id='P100'")
+    drift = check_powder_stock_balances(config, today=date(2026, 3, 1))
+    assert [(item.colorpowder_id, item.expected["balance_g"]) for item in drift] == [("P100", 90)]
+    assert rebuild_powder_stock_balances(config, today=date(2026, 3, 1)) == 1
+    assert check_powder_stock_balances(config, today=date(2026, 3, 1)) == []
+
+    with connect(db) as conn:
+        conn.execute("DELETE FROM powder_stock_balances")
+        conn.execute("UPDATE sync_state SET status='rebuild_required' WHERE sync_name='powder_stock_balances'")
+    assert list_powder_stock_balances(config, today=date(2026, 3, 1)) == []
+    assert complete_stock_upgrades(config, today=date(2026, 3, 1)) == ["powder_stock_balances"]
+    assert list_powder_stock_balances(config, today=date(2026, 3, 1))[0]["balance_g"] == 90
+
+
+def test_search_indexes_follow_recipe_and_order_writes(tmp_path):
+    db = tmp_path / "colorpowder.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_recipe(config, {
+        "配方編號": "R001", "顏色": "Ocean Blue", "客戶編號": "C01", "客戶名稱": "大同塑膠",
+        "Pantone色號": "PMS-286C", "色粉編號1": "P001", "色粉重量1": "2",
+    })
+    create_recipe(config, {
+        "配方編號": "R002", "顏色": "Blue", "客戶編號": "C02", "客戶名稱": "Acme",
+        "備註": "ocean blue tone", "色粉編號1": "P001", "色粉重量1": "2",
+    })
+    create_production_order(config, {
+        "生產單號": "O20260817-001", "生產日期": "2026-08-17", "配方編號": "R001",
+        "顏色": "Ocean Blue", "客戶名稱": "大同塑膠", "包裝重量1": "1", "包裝份數1": "1",
+    })
+
+    assert sorted(hit["配方編號"] for hit in search_recipes(config, "ocean")) == ["R001", "R002"]
+    assert [hit["配方編號"] for hit in search_recipes(config, "286c")] == ["R001"]
+    assert [hit["配方編號"] for hit in search_recipes(config, "大同, blue")] == ["R001"]
+    ranked = [hit["配方編號"] for hit in search_recipes(config, "blue")]
+    pages = search_recipes(config, "blue", 1) + search_recipes(config, "blue", 1, offset=1)
+    assert sorted(ranked) == ["R001", "R002"]
+    assert [hit["配方編號"] for hit in pages] == ranked
+    assert search_recipes(config, "  ") == []
+
+    update_recipe(config, {
+        "配方編號": "R001", "顏色": "Red", "客戶編號": "C01", "客戶名稱": "大同塑膠",
+        "色粉編號1": "P001", "色粉重量1": "2",
+    })
+    assert [hit["配方編號"] for hit in search_recipes(config, "ocean")] == ["R002"]
+    set_recipe_active(config, "R002", active=False, reason="停產")
+    assert search_recipes(config, "ocean") == []
+    assert [hit["配方編號"] for hit in search_recipes(config, "ocean", include_inactive=True)] == ["R002"]
+
+    assert [hit["生產單號"] for hit in search_production_orders(config, "0817 大同")] == ["O20260817-001"]
+    set_production_order_cancelled(config, "O20260817-001", cancelled=True, reason="重複")
+    assert search_production_orders(config, "0817") == []
+
+
+def test_find_recipes_containing_powders_intersects_and_sorts_by_last_production(tmp_path):
+    db = tmp_path / "colorpowder.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P001", "P002", "P003"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    for recipe_id, powders in (("R001", ["P001", "P002"]), ("R002", ["P002", "P001", "P003"]),
+                               ("R003", ["P001"]), ("R004", ["P001", "P002"])):
+        row = {"配方編號": recipe_id, "顏色": f"{recipe_id} color", "客戶名稱": "Customer"}
+        for position, powder_id in enumerate(powders, start=1):
+            row.update({f"色粉編號{position}": powder_id, f"色粉重量{position}": "1"})
+        create_recipe(config, row)
+    # Unpadded Sheet dates compare as dates: 2026-9-1 is before 2026/10/01.
+    for order_id, recipe_id, day in (("O1", "R001", "2026/10/01"), ("O2", "R002", "2026-9-1"),
+                                     ("O3", "R002", "2026-12-01"), ("O4", "R002", "2026.7.15")):
+        create_production_order(config, {
+            "生產單號": order_id, "生產日期": day, "配方編號": recipe_id,
+            "包裝重量1": "1", "包裝份數1": "1",
+        })
+    set_production_order_cancelled(config, "O3", cancelled=True, reason="重複")
+    set_recipe_active(config, "R004", active=False, reason="停產")
+
+    hits = find_recipes_containing_powders(config, [" P002", "P001", ""])
+
+    assert [(hit["配方編號"], hit["最後生產時間"]) for hit in hits] == [
+        ("R001", "2026-10-01"), ("R002", "2026-09-01"),
+    ]
+    assert hits[1]["色粉組成"] == "P002、P001、P003"
+    assert [hit["配方編號"] for hit in find_recipes_containing_powders(config, ["P001"], limit=2)] == ["R001", "R002"]
+    assert find_recipes_containing_powders(config, ["P001", "P404"]) == []
+    assert find_recipes_containing_powders(config, []) == []
+
+
+def test_production_order_numbers_come_from_seeded_atomic_sequence(tmp_path):
+    from datetime import date
+
+    db = tmp_path / "colorpowder.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_recipe(config, {"配方編號": "R001", "色粉編號1": "P001", "色粉重量1": "2"})
+    for order_id in ("20260817-004", "20260817-012X", "20260818-002"):
+        create_production_order(config, {"生產單號": order_id, "生產日期": "2026-08-17", "配方編號": "R001"})
+    with connect(db) as conn:
+        conn.execute("DROP TABLE sequences")
+        conn.execute("DELETE FROM schema_migrations WHERE version=14")
+    initialize_database(db)
+
+    with connect(db) as conn:
+        seeded = conn.execute("SELECT period, value FROM sequences ORDER BY period").fetchall()
+    assert [tuple(row) for row in seeded] == [("20260817", 4), ("20260818", 2)]
+
+    day = date(2026, 8, 17)
+    assert next_production_order_id(config, day) == "20260817-005"
+    assert next_production_order_id(config, day) == "20260817-006"
+    # An order that bypassed the sequence (e.g. a Sheet import) is skipped over.
+    create_production_order(config, {"生產單號": "20260817-020", "生產日期": "2026-08-17", "配方編號": "R001"})
+    assert next_production_order_id(config, day) == "20260817-021"
+    assert next_production_order_id(config, date(2026, 8, 19)) == "20260819-001"
+
+
+def test_list_apis_push_filters_projection_and_keyset_pages_into_sql(tmp_path):
+    db = tmp_path / "colorpowder.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id, category in (("P001", "色粉"), ("P002", "色母"), ("P003", "色粉")):
+        create_color_powder(config, ColorPowderInput(powder_id, category=category))
+    create_supplier(config, SupplierInput("S001", "First"))
+    create_supplier(config, SupplierInput("S002", "Second"))
+    for recipe_id, customer, powder_id in (("R001", "C01", "P001"), ("R002", "C02", "P002"), ("R003", "C01", "P002")):
+        create_recipe(config, {
+            "配方編號": recipe_id, "客戶編號": customer, "色粉編號1": powder_id, "色粉重量1": "1",
+        })
+    for sync_id, powder_id, day in (("m1", "P001", "2026/08/02"), ("m2", "P001", ""), ("m3", "P002", "2026-08-01"),
+                                    ("m4", "P001", "2026-08-01")):
+        create_inventory_movement(config, {
+            "類型": "進貨", "色粉編號": powder_id, "日期": day, "數量": "1", "單位": "g",
+        }, sync_id=sync_id)
+    for order_id, recipe_id, day in (("O1", "R001", "2026-08-02"), ("O2", "R003", "2026/08/01"),
+                                     ("O3", "R001", "2026-08-01"), ("O4", "R001", "")):
+        create_production_order(config, {"生產單號": order_id, "生產日期": day, "配方編號": recipe_id})
+
+    assert list_color_powders(config, category="色粉", columns=["colorpowder_id"]) == [
+        {"colorpowder_id": "P001"}, {"colorpowder_id": "P003"},
+    ]
+    assert [row["colorpowder_id"] for row in list_color_powders(config, after="P001", limit=1)] == ["P002"]
+    assert [row["supplier_id"] for row in list_suppliers(config, after="S001")] == ["S002"]
+
+    assert [row["配方編號"] for row in list_recipes(config, customer="C01")] == ["R001", "R003"]
+    assert [row["配方編號"] for row in list_recipes(config, powder_id="P002", after="R002")] == ["R003"]
+    assert list_recipes(config, customer="C01", columns=["配方編號", "色粉編號1"], limit=1) == [
+        {"配方編號": "R001", "色粉編號1": "P001"},
+    ]
+    assert list_recipes(config, recipe_id="R002", columns=["配方編號"]) == [{"配方編號": "R002"}]
+
+    all_moves = [row["_sync_id"] for row in list_inventory_movements(config)]
+    assert all_moves == ["m2", "m3", "m4", "m1"]
+    pages, after = [], None
+    while True:
+        page = list_inventory_movements(config, after=after, limit=2)
+        if not page:
+            break
+        pages.extend(row["_sync_id"] for row in page)
+        after = page[-1]["_sync_id"]
+    assert pages == all_moves
+    assert [row["_sync_id"] for row in list_inventory_movements(
+        config, powder_id="P001", start="2026-08-01", end="2026-08-02",
+    )] == ["m4", "m1"]
+
+    # Sort order stays the stored text order; the date filters normalise / separators.
+    assert [row["生產單號"] for row in list_production_orders(config)] == ["O4", "O3", "O1", "O2"]
+    assert [row["生產單號"] for row in list_production_orders(config, after="O3", limit=1)] == ["O1"]
+    assert [row["生產單號"] for row in list_production_orders(
+        config, recipe_id="R001", start="2026-08-01", end="2026-08-31", columns=["生產單號"],
+    )] == ["O3", "O1"]
+    assert [row["生產單號"] for row in list_production_orders(config, start="2026/08/01", end="2026-08-01")] == ["O3", "O2"]
+
+    # Days are compared on the stored ISO day, so unpadded Sheet dates fall in the right month.
+    create_production_order(config, {"生產單號": "O5", "生產日期": "2026/9/1", "配方編號": "R001"})
+    create_inventory_movement(config, {
+        "類型": "進貨", "色粉編號": "P001", "日期": "2026/9/1", "數量": "1", "單位": "g",
+    }, sync_id="m5")
+    assert [row["生產單號"] for row in list_production_orders(config, start="2026-09-01", end="2026-09-30")] == ["O5"]
+    assert "O5" not in {row["生產單號"] for row in list_production_orders(config, start="2026-08-01", end="2026-08-31")}
+    assert [row["_sync_id"] for row in list_inventory_movements(config, start="2026/09/01", end="2026-09-30")] == ["m5"]
+    assert list_inventory_movements(config, start="2026-09-01", columns=["_sync_id", "日期"]) == [
+        {"_sync_id": "m5", "日期": "2026/9/1"},
+    ]
+    assert list_production_orders(config, start="2026-09-01", columns=["生產單號", "取消狀態"]) == [
+        {"生產單號": "O5", "取消狀態": "有效"},
+    ]
+    with pytest.raises(RecipeError, match="不支援的欄位"):
+        list_recipes(config, columns=["配方編號", "不存在"])
+    with pytest.raises(InventoryError, match="無法辨識的日期"):
+        list_inventory_movements(config, start="not a date")
+
+
+def test_changed_since_feeds_patch_cached_frames_by_primary_key(tmp_path):
+    import pandas as pd
+
+    db = tmp_path / "colorpowder.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P001", "P002"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    for recipe_id in ("R001", "R002"):
+        create_recipe(config, {"配方編號": recipe_id, "顏色": "Red", "色粉編號1": "P001", "色粉重量1": "1"})
+    create_production_order(config, {"生產單號": "O1", "生產日期": "2026-08-01", "配方編號": "R001"})
+
+    initial = list_recipes_changed_since(config, None)
+    assert [row["配方編號"] for row in initial.upserted] == ["R001", "R002"]
+    frame = pd.DataFrame(initial.upserted)
+    quiet = list_recipes_changed_since(config, initial.watermark)
+    assert quiet.upserted == [] and quiet.watermark == initial.watermark
+    # Sheet imports store the Sheet's own 更新時間 text; the cursor ignores it.
+    with connect(db) as conn:
+        conn.execute("UPDATE recipes SET updated_at='2026/01/03 10:00' WHERE recipe_id='R001'")
+    sheet_dated = list_recipes_changed_since(config, initial.watermark)
+    assert [row["配方編號"] for row in sheet_dated.upserted] == ["R001"]
+    update_recipe(config, {"配方編號": "R001", "顏色": "Red", "色粉編號1": "P001", "色粉重量1": "1"})
+    assert [row["配方編號"] for row in list_recipes_changed_since(config, sheet_dated.watermark).upserted] == ["R001"]
+
+    update_recipe(config, {"配方編號": "R002", "顏色": "Blue", "色粉編號1": "P002", "色粉重量1": "2"})
+    create_recipe(config, {"配方編號": "R003", "顏色": "Green", "色粉編號1": "P001", "色粉重量1": "1"})
+    set_recipe_active(config, "R001", active=False, reason="停產")
+    changes = list_recipes_changed_since(config, initial.watermark)
+    assert changes.tombstoned == ["R001"]
+    assert changes.watermark >= initial.watermark
+    shared = frame.copy()
+    patched = apply_changes(frame, "配方編號", changes)
+    assert patched[["配方編號", "顏色", "色粉編號1"]].values.tolist() == [
+        ["R002", "Blue", "P002"], ["R003", "Green", "P001"],
+    ]
+    # Other sessions may be reading the cached frame; it is patched on a copy.
+    pd.testing.assert_frame_equal(frame, shared)
+    pd.testing.assert_frame_equal(
+        patched[["配方編號", "顏色"]], pd.DataFrame(list_recipes(config))[["配方編號", "顏色"]],
+    )
+
+    orders = list_production_orders_changed_since(config, None)
+    set_production_order_cancelled(config, "O1", cancelled=True, reason="重複")
+    assert list_production_orders_changed_since(config, orders.watermark).tombstoned == ["O1"]
+    assert [row["取消狀態"] for row in list_production_orders_changed_since(
+        config, orders.watermark, include_cancelled=True,
+    ).upserted] == ["已取消"]
+
+    powders = list_color_powders_changed_since(config, None)
+    assert [row["colorpowder_id"] for row in powders.upserted] == ["P001", "P002"]
+    create_inventory_movement(config, {"類型": "進貨", "色粉編號": "P001", "日期": "2026-08-01", "數量": "1", "單位": "g"})
+    moves = list_inventory_movements_changed_since(config, None)
+    assert len(moves.upserted) == 1 and moves.tombstoned == [] and moves.watermark
+
+
+@pytest.mark.parametrize("legacy_rows", [3, 40])
+def test_tombstone_backfill_uses_constant_round_trips(tmp_path, legacy_rows):
+    db = tmp_path / "tombstone-backfill.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for index in range(legacy_rows):
+        create_color_powder(config, ColorPowderInput(f"P{index:03d}"))
+    set_color_powder_active(config, "P000", active=False, reason="停用")
+    with connect(db) as conn:
+        # Rows disabled before tombstones existed have no delete event.
+        conn.execute("UPDATE color_powders SET lifecycle_status='inactive', version=version+1")
+
+    def backfill():
+        statements = []
+        with connect(db) as conn:
+            conn.set_trace_callback(statements.append)
+            sheet_export_module._ensure_tombstone_outbox(conn, "色粉管理")
+            conn.set_trace_callback(None)
+        return [sql for sql in statements if sql.lstrip().upper().startswith(("SELECT", "INSERT"))]
+
+    # The per-row loop issued 1 + 3 * N statements; the set-based pass is constant.
+    assert len(backfill()) == 3
+    assert len(backfill()) == 2
+    with connect(db) as conn:
+        deletes = conn.execute(
+            """SELECT row_key, entity_version FROM sync_outbox
+               WHERE sheet_name='色粉管理' AND operation='delete' ORDER BY row_key"""
+        ).fetchall()
+        assert len(deletes) == legacy_rows
+        # P000 keeps its own delete event; legacy rows get one above their history.
+        assert [tuple(row) for row in deletes[:2]] == [("P000", 2), ("P001", 2)]
+        conn.execute("UPDATE sync_outbox SET status='conflict' WHERE row_key='P001' AND operation='delete'")
+
+    backfill()
+    with connect(db) as conn:
+        requeued = conn.execute(
+            """SELECT entity_version, status FROM sync_outbox
+               WHERE row_key='P001' AND operation='delete' ORDER BY id DESC LIMIT 1"""
+        ).fetchone()
+    assert tuple(requeued) == (3, "pending")
+
+
+def test_tombstone_backfill_cursor_ignores_sheet_formatted_updated_at(tmp_path):
+    db = tmp_path / "tombstone-cursor.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_color_powder(config, ColorPowderInput("P002"))
+    with connect(db) as conn:
+        # Sheet imports keep the Sheet's own timestamp text.
+        conn.execute("UPDATE color_powders SET updated_at='2026/10/01 09:00' WHERE colorpowder_id='P001'")
+        sheet_export_module._ensure_tombstone_outbox(conn, "色粉管理")
+    with connect(db) as conn:
+        # '2026-10-18T…' sorts below '2026/10/01 …' as text; the cursor must still see it.
+        conn.execute(
+            """UPDATE color_powders SET lifecycle_status='inactive', updated_at='2026-10-18T08:00:00+00:00'
+               WHERE colorpowder_id='P002'"""
+        )
+        sheet_export_module._ensure_tombstone_outbox(conn, "色粉管理")
+        deletes = conn.execute(
+            "SELECT row_key FROM sync_outbox WHERE sheet_name='色粉管理' AND operation='delete'"
+        ).fetchall()
+    assert [row[0] for row in deletes] == ["P002"]
+
+
+def test_outbox_compaction_archives_superseded_and_finished_events(tmp_path):
+    from datetime import datetime, timezone
+
+    db = tmp_path / "outbox-compaction.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001", name="First"))
+    update_color_powder(config, ColorPowderInput("P001", name="Second"))
+    update_color_powder(config, ColorPowderInput("P001", name="Latest"))
+    create_color_powder(config, ColorPowderInput("P002"))
+    set_color_powder_active(config, "P002", active=False, reason="停用")
+    with connect(db) as conn:
+        conn.execute(
+            """UPDATE sync_outbox SET status='completed', processed_at='2026-01-01T00:00:00+00:00'
+               WHERE row_key='P002'"""
+        )
+
+    result = compact_outbox(config, now=datetime(2026, 3, 1, tzinfo=timezone.utc))
+    preflight = sync_color_powder_outbox(
+        WritableWorksheet(), [["色粉編號", "名稱"]], db_config=config, dry_run=True,
+    )
+
+    assert (result.superseded, result.archived) == (2, 2)
+    assert preflight.queued == 1 and preflight.to_insert == 1
+    with connect(db) as conn:
+        live = conn.execute("SELECT row_key, entity_version, status FROM sync_outbox").fetchall()
+        archived = conn.execute(
+            "SELECT row_key, entity_version, status FROM sync_outbox_archive ORDER BY row_key, entity_version"
+        ).fetchall()
+    # The archived P002 tombstone is not backfilled again.
+    assert [tuple(row) for row in live] == [("P001", 3, "pending")]
+    assert [tuple(row) for row in archived] == [
+        ("P001", 1, "superseded"), ("P001", 2, "superseded"),
+        ("P002", 1, "completed"), ("P002", 2, "completed"),
+    ]
+    assert compact_outbox(config, now=datetime(2026, 3, 1, tzinfo=timezone.utc)).archived == 0
+
+
+class ScriptRequestConnection:
+    """Stands in for a remote libsql client: every call is one network request."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.requests = []
+
+    @property
+    def in_transaction(self):
+        return self.conn.in_transaction
+
+    def execute(self, sql, parameters=()):
+        self.requests.append(sql)
+        return self.conn.execute(sql, parameters)
+
+    def executescript(self, script):
+        self.requests.append(script)
+        return self.conn.executescript(script)
+
+
+def test_execute_batch_sends_remote_writes_as_one_request(tmp_path):
+    db = tmp_path / "batch.db"
+    initialize_database(db)
+    insert = """INSERT INTO color_powders(colorpowder_id, name, notes, version, created_at, updated_at)
+                VALUES (?, ?, ?, ?, '2026-01-01', '2026-01-01')"""
+    statements = [
+        (insert, ("P001", "O'Brien; ?", None, 1)),
+        (insert, ("P002", "藍", "x'y", 2)),
+        ("UPDATE color_powders SET version=version+? WHERE colorpowder_id=?", (0.5, "P002")),
+    ]
+    remote = ScriptRequestConnection(sqlite3.connect(db))
+
+    execute_batch(remote, statements)
+    assert len(remote.requests) == 1
+    # The batch joins the caller's transaction instead of committing on its own.
+    remote.conn.rollback()
+    assert remote.conn.execute("SELECT COUNT(*) FROM color_powders").fetchone()[0] == 0
+
+    execute_batch(remote, statements)
+    remote.conn.commit()
+    rows = remote.conn.execute(
+        "SELECT colorpowder_id, name, notes, version FROM color_powders ORDER BY colorpowder_id"
+    ).fetchall()
+    remote.conn.close()
+    assert rows == [("P001", "O'Brien; ?", None, 1), ("P002", "藍", "x'y", 2.5)]
+
+    with connect(db) as conn:
+        execute_batch(conn, [(insert, ("P003", "", "", 1)), (insert, ("P004", "", "", 1))])
+        assert missing_keys(conn, "color_powders", "colorpowder_id", ["P009", "P003", "", "P008", "P009"]) == [
+            "P009", "P008",
+        ]
+
+
+def test_bulk_inventory_create_reports_each_row(tmp_path):
+    db = tmp_path / "inventory-bulk.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_color_powder(config, ColorPowderInput("P002"))
+    create_supplier(config, SupplierInput("S001", "Supplier"))
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P001", "日期": "2026/01/01", "數量": 1, "單位": "kg", "_sync_id": "OLD",
+    })
+    rows = [
+        {"類型": "進貨", "色粉編號": "P001", "日期": "2026/01/02", "數量": "2", "單位": "kg",
+         "廠商編號": "S001", "廠商名稱": "Supplier", "_sync_id": "B1"},
+        {"類型": "進貨", "色粉編號": "P404", "日期": "2026/01/02", "數量": 1, "單位": "g"},
+        {"類型": "進貨", "色粉編號": "P002", "日期": "2026/01/02", "數量": 1, "廠商編號": "S404"},
+        {"類型": "進貨", "色粉編號": "P002", "日期": "2026/01/02", "數量": "abc"},
+        {"類型": "進貨", "色粉編號": "P002", "數量": 1, "_sync_id": "OLD"},
+        {"類型": "進貨", "色粉編號": "P002", "日期": "2026/01/03", "數量": 500, "單位": "g", "_sync_id": "B1"},
+        {"類型": "進貨", "色粉編號": " P002 ", "日期": "2026/01/03", "數量": 250, "單位": "g", "_sync_id": "B2"},
+    ]
+
+    results = create_inventory_movements_bulk(config, rows)
+
+    assert [result.ok for result in results] == [True, False, False, False, False, False, True]
+    assert [result.error for result in results[1:6]] == [
+        "找不到色粉編號 P404", "找不到供應商編號 S404", "數量 abc 不是數字",
+        "庫存 _sync_id OLD 已存在", "庫存 _sync_id B1 已存在",
+    ]
+    assert results[0].payload["數量"] == "2.0" and results[6].payload["色粉編號"] == "P002"
+    assert {row["_sync_id"] for row in list_inventory_movements(config)} == {"OLD", "B1", "B2"}
+    assert get_powder_stock_balance(config, "P001")["balance_g"] == 3000
+    with connect(db) as conn:
+        events = conn.execute(
+            "SELECT row_key FROM sync_outbox WHERE sheet_name='庫存記錄' AND operation='insert' ORDER BY id"
+        ).fetchall()
+    assert [row[0] for row in events] == ["OLD", "B1", "B2"]
+
+
+def test_data_versions_count_mutations_per_table(tmp_path):
+    db = tmp_path / "versions.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    assert current_versions(config) == {
+        "recipes": 0, "recipe_components": 0, "color_powders": 0, "suppliers": 0,
+        "inventory_movements": 0, "production_orders": 0, "order_powder_consumption": 0,
+    }
+
+    create_color_powder(config, ColorPowderInput("P001"))
+    after_powder = current_versions(config)
+    assert after_powder["color_powders"] == 1 and after_powder["inventory_movements"] == 0
+
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P001", "日期": "2026/01/01", "數量": 1, "單位": "kg", "_sync_id": "M1",
+    })
+    after_movement = current_versions(config)
+    assert after_movement["inventory_movements"] > 0
+    assert after_movement["color_powders"] == after_powder["color_powders"]
+
+    with connect(db) as conn:
+        conn.execute("DELETE FROM inventory_movements")
+    assert current_versions(config)["inventory_movements"] > after_movement["inventory_movements"]
+
+    create_recipe(config, {"配方編號": "R001", "色粉編號1": "P001", "色粉重量1": "10"})
+    create_production_order(config, {"生產單號": "O1", "生產日期": "2026-08-01", "配方編號": "R001",
+                                     "包裝重量1": "1", "包裝份數1": "1"})
+    before_rebuild = current_versions(config)
+    assert before_rebuild["order_powder_consumption"] > 0
+    # A ledger rewrite alone (backfill or rebuild) must still move the stock cache key.
+    with connect(db) as conn:
+        conn.execute("UPDATE order_powder_consumption SET grams = grams")
+    assert current_versions(config)["order_powder_consumption"] > before_rebuild["order_powder_consumption"]
+
+
+def test_backup_is_consistent_compressed_verified_and_rotated(tmp_path):
+    from datetime import datetime, timedelta, timezone
+
+    db = tmp_path / "live.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    create_color_powder(config, ColorPowderInput("P001"))
+    writer = sqlite3.connect(db)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("INSERT INTO color_powders(colorpowder_id, created_at, updated_at) VALUES ('P999', 'x', 'x')")
+    backup_dir = tmp_path / "backups"
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    first = create_backup(config, backup_dir, now=start)
+    writer.rollback()
+    writer.close()
+
+    manifest = json.loads(first.manifest_path.read_text(encoding="utf-8"))
+    assert first.path.name == "colorpowder-20260101T000000Z.db.gz"
+    assert manifest["sha256"] == first.sha256 and manifest["schema_version"] == 22
+    assert manifest["tables"]["color_powders"] == 1
+    restored = tmp_path / "restored.db"
+    verification = verify_backup(first.path, restore_to=restored)
+    assert verification.ok and verification.quick_check == ["ok"] and verification.restored_to == restored
+    with connect(restored) as conn:
+        assert [row[0] for row in conn.execute("SELECT colorpowder_id FROM color_powders")] == ["P001"]
+    with pytest.raises(BackupError):
+        verify_backup(first.path, restore_to=restored)
+
+    create_backup(config, backup_dir, compression="lzma", now=start + timedelta(days=1))
+    third = create_backup(config, backup_dir, compression="none", keep_last=2, now=start + timedelta(days=2))
+    assert third.removed == [first.path]
+    assert not first.manifest_path.exists()
+    assert sorted(path.name for path in backup_dir.iterdir()) == [
+        "colorpowder-20260102T000000Z.db.xz",
+        "colorpowder-20260102T000000Z.db.xz.manifest.json",
+        "colorpowder-20260103T000000Z.db",
+        "colorpowder-20260103T000000Z.db.manifest.json",
+    ]
+    with open(third.path, "r+b") as handle:
+        handle.seek(200)
+        handle.write(b"corrupt")
+    assert verify_backup(third.path).checksum_ok is False
+
+
+def test_turso_backup_reads_the_remote_not_the_write_behind_replica(tmp_path, monkeypatch):
+    import utils.backup as backup_module
+
+    db = tmp_path / "remote.db"
+    initialize_database(db)
+    create_color_powder(DatabaseConfig(backend="sqlite", path=db), ColorPowderInput("P001"))
+    opened = []
+
+    @contextmanager
+    def fake_connect(config):
+        opened.append(config)
+        with connect(db) as conn:
+            yield conn
+
+    monkeypatch.setattr(backup_module, "connect_from_config", fake_connect)
+    config = DatabaseConfig(
+        backend="turso", turso_database_url="libsql://example.turso.io", turso_auth_token="token",
+        write_behind_path=tmp_path / "journal.db",
+    )
+    result = create_backup(config, tmp_path / "backups")
+    assert [item.write_behind_path for item in opened] == [None]
+    assert result.tables["color_powders"] == 1
+
+
+def test_copy_database_by_pages_rebuilds_indexes_without_firing_triggers(tmp_path):
+    db = tmp_path / "remote.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P001", "P002", "P003"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P001", "日期": "2026/01/01", "數量": 1, "單位": "kg", "_sync_id": "M1",
+    })
+    target = tmp_path / "copy.db"
+
+    with connect(db) as conn:
+        copy_database_by_pages(conn, target, page_rows=2)
+        source_versions = conn.execute("SELECT * FROM data_versions ORDER BY table_name").fetchall()
+
+    with connect(target) as copy:
+        assert copy.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+        assert copy.execute("SELECT * FROM data_versions ORDER BY table_name").fetchall() == source_versions
+        assert [row[0] for row in copy.execute("SELECT colorpowder_id FROM color_powders ORDER BY rowid")] == [
+            "P001", "P002", "P003",
+        ]
+        assert copy.execute("SELECT COUNT(*) FROM sqlite_schema WHERE type='trigger'").fetchone()[0] > 0
+        assert copy.execute("SELECT MAX(version) FROM schema_migrations").fetchone()[0] == 22
+
+
+def test_copy_database_by_pages_reads_one_snapshot_while_others_write(tmp_path):
+    import sqlite3
+
+    db = tmp_path / "remote.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+    for powder_id in ("P001", "P002", "P003"):
+        create_color_powder(config, ColorPowderInput(powder_id))
+    writer = sqlite3.connect(db, isolation_level=None)
+    writer.execute("PRAGMA journal_mode=WAL")
+
+    class WritingMidCopy:
+        """Commits a new order right after the first data page is read."""
+
+        def __init__(self, conn):
+            self.conn, self.in_transaction, self.pages = conn, False, 0
+
+        def execute(self, sql, parameters=()):
+            cursor = self.conn.execute(sql, parameters)
+            if sql.startswith("SELECT rowid") and self.pages == 0:
+                self.pages = 1
+                writer.execute(
+                    "INSERT INTO production_orders(production_order_id, payload_json, created_at, updated_at) VALUES ('O9', '{}', 'x', 'x')"
+                )
+            return cursor
+
+    target = tmp_path / "copy.db"
+    source = sqlite3.connect(db, isolation_level=None)
+    try:
+        copy_database_by_pages(WritingMidCopy(source), target, page_rows=1)
+    finally:
+        source.close()
+        writer.close()
+
+    with connect(target) as copy:
+        assert copy.execute("SELECT COUNT(*) FROM production_orders").fetchone()[0] == 0
+    with connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM production_orders").fetchone()[0] == 1
+
+
+def test_write_behind_journal_serves_reads_and_flushes_in_order(tmp_path):
+    from dataclasses import replace
+    from datetime import date
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    create_color_powder(remote, ColorPowderInput("P001"))
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+
+    create_color_powder(config, ColorPowderInput("P002"))
+    create_inventory_movement(config, {
+        "類型": "初始", "色粉編號": "P002", "日期": "2026/01/01", "數量": 1, "單位": "kg", "_sync_id": "M1",
+    })
+    order_id = next_production_order_id(config, date(2026, 8, 17))
+    create_production_order(config, {"生產單號": order_id, "生產日期": "2026-08-17"})
+
+    assert [row["colorpowder_id"] for row in list_color_powders(config)] == ["P001", "P002"]
+    assert [row["colorpowder_id"] for row in list_color_powders(remote)] == ["P001"]
+
+    result = flush_write_behind(config)
+    assert (result.flushed, result.pending, result.ok) == (4, 0, True)
+    assert [row["colorpowder_id"] for row in list_color_powders(remote)] == ["P001", "P002"]
+    assert [row["_sync_id"] for row in list_inventory_movements(remote)] == ["M1"]
+    assert [row["生產單號"] for row in list_production_orders(remote)] == ["20260817-001"]
+    assert next_production_order_id(remote, date(2026, 8, 17)) == "20260817-002"
+    with connect(remote_db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM write_journal_applied").fetchone()[0] == 4
+        assert conn.execute("SELECT COUNT(*) FROM write_journal").fetchone()[0] == 0
+    assert flush_write_behind(config).flushed == 0
+
+
+def test_write_behind_flush_is_idempotent_and_reports_conflicts(tmp_path):
+    from dataclasses import replace
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_color_powder(config, ColorPowderInput("P002"))
+    create_color_powder(config, ColorPowderInput("P003"))
+    with connect(tmp_path / "journal.db") as journal:
+        first_txn, second_txn, third_txn = [row[0] for row in journal.execute(
+            "SELECT txn_id FROM write_journal GROUP BY txn_id ORDER BY MIN(id)"
+        )]
+    with connect(remote_db) as conn:
+        # The first transaction reached the remote but the journal never heard back.
+        conn.execute("INSERT INTO write_journal_applied VALUES (?, 'x')", (first_txn,))
+        conn.execute("INSERT INTO color_powders(colorpowder_id, created_at, updated_at) VALUES ('P001', 'x', 'x')")
+        # Someone else created P002 on the remote in the meantime.
+        conn.execute("INSERT INTO color_powders(colorpowder_id, created_at, updated_at) VALUES ('P002', 'y', 'y')")
+
+    result = flush_write_behind(config)
+
+    assert (result.flushed, result.already_applied, result.conflicts) == (1, 1, [second_txn])
+    assert not result.ok and result.pending == 0
+    assert [row["colorpowder_id"] for row in list_color_powders(remote)] == ["P001", "P002", "P003"]
+    with connect(tmp_path / "journal.db") as journal:
+        parked = journal.execute("SELECT DISTINCT txn_id, status FROM write_journal").fetchall()
+        conflict = journal.execute("SELECT entity_type, entity_id, reason FROM sync_conflicts").fetchone()
+    assert [tuple(row) for row in parked] == [(second_txn, "conflict")]
+    assert conflict[0] == "write_journal" and conflict[1] == second_txn and "UNIQUE" in conflict[2]
+    assert third_txn not in {row[0] for row in parked}
+    # The parked transaction is undone locally: the replica holds the remote's P002 again.
+    assert result.pulled > 0
+    rows_sql = "SELECT colorpowder_id, created_at FROM color_powders ORDER BY colorpowder_id"
+    with connect(tmp_path / "journal.db") as journal, connect(remote_db) as conn:
+        local_rows = [tuple(row) for row in journal.execute(rows_sql)]
+        assert local_rows == [tuple(row) for row in conn.execute(rows_sql)]
+    assert local_rows[1] == ("P002", "y")
+
+
+def test_write_behind_replica_pulls_writes_made_directly_on_the_remote(tmp_path):
+    from dataclasses import replace
+
+    from utils.database import refresh_write_behind_replica
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    create_color_powder(remote, ColorPowderInput("P001"))
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+    assert refresh_write_behind_replica(config) == 0
+
+    # A CLI worker or the inbound Sheet import writes straight to Turso.
+    create_color_powder(remote, ColorPowderInput("P900", name="remote"))
+    update_color_powder(remote, ColorPowderInput("P001", name="renamed"))
+    create_color_powder(config, ColorPowderInput("P002"))
+
+    # Nothing is pulled over a local write the remote has not seen yet.
+    assert refresh_write_behind_replica(config) == 0
+    result = flush_write_behind(config)
+    assert (result.flushed, result.pending, result.ok) == (1, 0, True)
+    assert result.pulled == 3
+    assert [(row["colorpowder_id"], row["name"]) for row in list_color_powders(config)] == [
+        ("P001", "renamed"), ("P002", ""), ("P900", "remote"),
+    ]
+    before = list_color_powders_changed_since(config, None)
+    assert refresh_write_behind_replica(config) == 0
+    assert list_color_powders_changed_since(config, before.watermark).upserted == []
+
+
+def test_write_behind_journal_refuses_writes_keyed_on_local_ids(tmp_path):
+    from dataclasses import replace
+
+    from utils.sync_worker import acquire_worker_lock
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+
+    with pytest.raises(ValueError, match="write_behind_remote_config"):
+        with connect_from_config(config) as conn:
+            conn.execute("UPDATE sync_outbox SET status='processing' WHERE id=?", (1,))
+    with pytest.raises(ValueError, match="RETURNING"):
+        with connect_from_config(config) as conn:
+            conn.execute("DELETE FROM sync_outbox WHERE status='completed' RETURNING id")
+    # Worker locks are taken on the remote, where every process sees them.
+    assert acquire_worker_lock(config, lock_name="sheet-export", owner_id="a")
+    with connect(remote_db) as conn:
+        assert conn.execute("SELECT owner_id FROM sync_worker_locks").fetchone()[0] == "a"
+    with connect(tmp_path / "journal.db") as journal:
+        assert journal.execute("SELECT COUNT(*) FROM write_journal").fetchone()[0] == 0
+
+    # The outbox is claimed by id on the remote, so a remote-only event cannot shadow a local one.
+    create_color_powder(config, ColorPowderInput("P001"))
+    create_color_powder(remote, ColorPowderInput("P900"))
+    flush_write_behind(config)
+    worksheet = WritableWorksheet()
+    applied = sync_color_powder_outbox(worksheet, [["色粉編號", "名稱"]], db_config=config, dry_run=False)
+    assert applied.written == 2
+    assert sorted(row[0] for row in worksheet.appended) == ["P001", "P900"]
+    with connect(remote_db) as conn:
+        assert {row[0] for row in conn.execute("SELECT status FROM sync_outbox")} == {"completed"}
+
+
+def test_write_behind_replay_recomputes_stock_balances_on_the_remote(tmp_path):
+    from dataclasses import replace
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    create_color_powder(remote, ColorPowderInput("P001"))
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+
+    create_inventory_movement(remote, {
+        "類型": "進貨", "色粉編號": "P001", "日期": "2026/01/01", "數量": 7, "單位": "g", "_sync_id": "R1",
+    })
+    create_inventory_movement(config, {
+        "類型": "進貨", "色粉編號": "P001", "日期": "2026/01/02", "數量": 5, "單位": "g", "_sync_id": "L1",
+    })
+    # The replica's own balance only knows its 5 g; the journal carries the powder id, not the row.
+    assert get_powder_stock_balance(config, "P001")["balance_g"] == 5
+    with connect(tmp_path / "journal.db") as journal:
+        journaled = [row[0] for row in journal.execute("SELECT sql FROM write_journal")]
+    assert not any("powder_stock_balances" in sql and "INSERT" in sql for sql in journaled)
+
+    result = flush_write_behind(config)
+    assert (result.flushed, result.pending, result.ok) == (1, 0, True)
+    assert get_powder_stock_balance(remote, "P001")["balance_g"] == 12
+    assert check_powder_stock_balances(remote) == []
+    assert get_powder_stock_balance(config, "P001")["balance_g"] == 12
+
+
+def test_write_behind_reversal_replays_on_the_natural_movement_key(tmp_path):
+    from dataclasses import replace
+
+    remote_db = tmp_path / "remote.db"
+    initialize_database(remote_db)
+    remote = DatabaseConfig(backend="sqlite", path=remote_db)
+    create_color_powder(remote, ColorPowderInput("P001"))
+    config = replace(remote, write_behind_path=tmp_path / "journal.db")
+    initialize_database_from_config(config)
+
+    with pytest.raises(ValueError, match="write_behind_remote_config"):
+        with connect_from_config(config) as conn:
+            conn.execute("UPDATE inventory_movements SET notes='x' WHERE movement_id=?", (1,))
+    # Both sides hand out movement_id 1: R1 on the remote, L1 on the replica.
+    create_inventory_movement(remote, {
+        "類型": "進貨", "色粉編號": "P001", "日期": "2026/01/01", "數量": 7, "單位": "g", "_sync_id": "R1",
+    })
+    create_inventory_movement(config, {
+        "類型": "進貨", "色粉編號": "P001", "日期": "2026/01/02", "數量": 5, "單位": "g", "_sync_id": "L1",
+    })
+    reverse_inventory_movement(config, "L1", reason="輸入錯誤", reversal_sync_id="L1-R")
+
+    result = flush_write_behind(config)
+    assert (result.flushed, result.pending, result.ok) == (2, 0, True)
+    rows_sql = "SELECT sheet_row_key, reversed_at IS NOT NULL FROM inventory_movements ORDER BY sheet_row_key"
+    with connect(tmp_path / "journal.db") as journal, connect(remote_db) as conn:
+        remote_rows = [tuple(row) for row in conn.execute(rows_sql)]
+        assert remote_rows == [("L1", 1), ("L1-R", 0), ("R1", 0)]
+        assert [tuple(row) for row in journal.execute(rows_sql)] == remote_rows
+
+
 def test_production_order_cancel_requires_reason(tmp_path):
     db = tmp_path / "production-cancel-reason.db"
     initialize_database(db)
@@ -1330,7 +2473,7 @@ def test_supplier_import_accepts_supplier_code_and_short_name_headers(tmp_path):
     assert supplier["notes"] == "常用"
 
 
-def test_database_health_check_reports_schema_v9(tmp_path):
+def test_database_health_check_reports_schema_v21(tmp_path):
     db = tmp_path / "colorpowder.db"
     initialize_database(db)
     config = database_config_from_secrets({})
@@ -1338,7 +2481,7 @@ def test_database_health_check_reports_schema_v9(tmp_path):
     health = database_health_check(config)
     assert health.backend == "sqlite"
     assert health.select_1_ok
-    assert health.schema_version == 9
+    assert health.schema_version == 22
     assert health.main_tables_exist
     assert health.schema_compatible
     assert health.missing_required_columns == {}
@@ -1397,6 +2540,20 @@ def test_nested_streamlit_secrets_select_turso_backend(monkeypatch, secrets):
     assert config.turso_auth_token == "nested-token"
 
 
+def test_write_behind_journal_path_comes_from_secrets_only(monkeypatch, tmp_path):
+    monkeypatch.delenv("TURSO_DATABASE_URL", raising=False)
+    monkeypatch.delenv("TURSO_AUTH_TOKEN", raising=False)
+    monkeypatch.setenv("WRITE_BEHIND_JOURNAL_PATH", str(tmp_path / "env.db"))
+
+    assert database_config_from_secrets().write_behind_path is None
+    config = database_config_from_secrets({
+        "TURSO_DATABASE_URL": "libsql://example.turso.io",
+        "TURSO_AUTH_TOKEN": "token",
+        "WRITE_BEHIND_JOURNAL_PATH": "data/journal.db",
+    })
+    assert config.backend == "turso" and str(config.write_behind_path) == "data/journal.db"
+
+
 def test_partial_nested_turso_credentials_fail_fast(monkeypatch):
     monkeypatch.delenv("TURSO_DATABASE_URL", raising=False)
     monkeypatch.delenv("TURSO_AUTH_TOKEN", raising=False)
@@ -1429,10 +2586,16 @@ def test_connect_from_config_uses_turso_transaction_lifecycle(monkeypatch):
         turso_auth_token="secret-token",
     )
 
+    with connect_from_config(config) as conn:
+        assert conn is fake
     with connect_from_config(config) as conn:
         assert conn is fake
 
-    assert events == ["commit", "close"]
+    assert events == ["commit", "commit"]
+    stats = connection_pool_stats(config)
+    assert (stats.hits, stats.misses, stats.idle) == (1, 1, 1)
+    close_connection_pools()
+    assert events == ["commit", "commit", "close"]
 
 
 def test_connect_from_config_rolls_back_failed_turso_transaction(monkeypatch):
@@ -1463,6 +2626,72 @@ def test_connect_from_config_rolls_back_failed_turso_transaction(monkeypatch):
     assert events == ["rollback", "close"]
 
 
+def test_sqlite_pool_reuses_connections_and_scopes_transactions(tmp_path):
+    db = tmp_path / "pooled.db"
+    initialize_database(db)
+    config = DatabaseConfig(backend="sqlite", path=db)
+
+    with connect_from_config(config) as first:
+        first.execute(
+            "INSERT INTO color_powders(colorpowder_id, created_at, updated_at) VALUES ('P001', 'x', 'x')"
+        )
+    with pytest.raises(RuntimeError):
+        with connect_from_config(config) as second:
+            assert second is first
+            second.execute(
+                "INSERT INTO color_powders(colorpowder_id, created_at, updated_at) VALUES ('P002', 'x', 'x')"
+            )
+            raise RuntimeError("abort")
+    with connect_from_config(config) as third:
+        ids = [row[0] for row in third.execute("SELECT colorpowder_id FROM color_powders")]
+
+    assert ids == ["P001"]
+    assert third is not first
+    stats = connection_pool_stats(config)
+    assert (stats.hits, stats.misses, stats.discarded) == (1, 2, 1)
+
+
+def test_connection_pool_limits_size_evicts_idle_and_health_checks():
+    now = [0.0]
+    created = []
+
+    class FakeConnection:
+        def __init__(self):
+            self.healthy = True
+            self.closed = False
+            created.append(self)
+
+        def execute(self, sql, parameters=()):
+            if not self.healthy:
+                raise RuntimeError("stream expired")
+            return type("Cursor", (), {"fetchone": lambda _self: (1,)})()
+
+        def close(self):
+            self.closed = True
+
+    pool = ConnectionPool(
+        FakeConnection, backend="turso", max_size=1, idle_timeout_seconds=100,
+        health_check_after_seconds=10, checkout_timeout_seconds=0, clock=lambda: now[0],
+    )
+    conn = pool.acquire()
+    with pytest.raises(DatabaseStartupError, match="pool size is 1"):
+        pool.acquire()
+    pool.release(conn)
+
+    now[0] = 20
+    conn.healthy = False
+    replacement = pool.acquire()
+    pool.release(replacement)
+    now[0] = 200
+    evicted_replacement = pool.acquire()
+
+    assert conn.closed and replacement.closed
+    assert evicted_replacement is created[-1] and len(created) == 3
+    stats = pool.stats()
+    assert (stats.hits, stats.misses) == (0, 3)
+    assert (stats.health_check_failures, stats.evicted, stats.in_use) == (1, 1, 1)
+
+
 def test_import_sheet_values_accepts_database_config(tmp_path):
     db = tmp_path / "configured.db"
     config = DatabaseConfig(backend="sqlite", path=db)
@@ -1618,7 +2847,7 @@ def test_database_startup_diagnostics_do_not_include_token_value(tmp_path):
     )
     assert "Database backend: sqlite" in lines
     assert "Database health: OK" in lines
-    assert "Schema version: 9" in lines
+    assert "Schema version: 22" in lines
     assert "Required columns present: True" in lines
     assert "TURSO_AUTH_TOKEN configured: True" in lines
     assert "secret-token" not in "\n".join(lines)
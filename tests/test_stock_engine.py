@@ -0,0 +1,238 @@
+import random
+
+import pandas as pd
+import pytest
+
+from utils import stock_engine
+from utils.stock_engine import (
+    _parse_one,
+    parse_datetime_series,
+    parse_datetime_values,
+    prepare_movements,
+    stock_summary,
+    summarize_stock,
+)
+
+
+def test_parse_datetime_values_matches_per_cell_parser():
+    cells = [
+        "2026/1/5", "2026-01-05T08:30", "2026.01.05", "2026/01/05 8:30", "2026-01-05 08:30:00.5",
+        " 2026/02/30 ", "2026-02-28 25:00", "2026/01-05", "46030", "46030.5", "99999", "12", "0",
+        "20260105", "2026", "01/05/2026", "Jan 5 2026", "2026年1月5日", "", " ", None, float("nan"),
+        46030.0, pd.Timestamp("2026-01-05 10:00"),
+    ]
+
+    parsed = parse_datetime_values(cells + cells)
+
+    for cell, value in zip(cells + cells, parsed):
+        expected = _parse_one(cell)
+        assert (pd.isna(value) and pd.isna(expected)) or value == expected, cell
+
+
+def _legacy_stock_summary(df_stock, usage_rows, all_pids, start_dt, end_dt):
+    """The 庫存區 per-powder loop as it ran before the grouped engine."""
+
+    def to_grams(qty, unit):
+        try:
+            q = float(qty or 0)
+        except Exception:
+            q = 0.0
+        return q * 1000 if str(unit).lower() == "kg" else q
+
+    df_stock_copy = df_stock.copy()
+    raw_date_dt = parse_datetime_series(df_stock_copy.get("日期"), df_stock_copy.index)
+    raw_datetime_dt = parse_datetime_series(df_stock_copy.get("日期時間"), df_stock_copy.index)
+    df_stock_copy["日期時間"] = raw_datetime_dt.combine_first(raw_date_dt)
+    df_stock_copy["日期"] = raw_date_dt.dt.normalize()
+    df_stock_copy["數量_g"] = df_stock_copy.apply(lambda r: to_grams(r["數量"], r["單位"]), axis=1)
+    df_stock_copy["色粉編號"] = df_stock_copy["色粉編號"].astype(str).str.strip()
+
+    usage_by_pid = {}
+    for pid, order_dt, grams in usage_rows:
+        usage_by_pid.setdefault(pid, []).append((order_dt, grams))
+
+    summary = []
+    for pid in all_pids:
+        df_pid = df_stock_copy[df_stock_copy["色粉編號"] == pid]
+        df_ini = df_pid[df_pid["類型"].astype(str).str.strip() == "初始"]
+        if not df_ini.empty:
+            latest_ini = df_ini.sort_values("日期時間", ascending=False).iloc[0]
+            ini_value = latest_ini["數量_g"]
+            ini_dt = latest_ini["日期時間"]
+        else:
+            ini_value = 0.0
+            ini_dt = pd.NaT
+        if pd.notna(ini_dt):
+            calc_start_dt = max(start_dt, ini_dt.normalize() + pd.Timedelta(hours=23, minutes=59, seconds=59))
+        else:
+            earliest_stock_dt = pd.to_datetime(df_pid["日期時間"], errors="coerce").min()
+            if pd.notna(earliest_stock_dt):
+                calc_start_dt = max(start_dt, earliest_stock_dt.normalize())
+            else:
+                calc_start_dt = start_dt
+        in_qty = df_pid[
+            (df_pid["類型"].astype(str).str.strip().isin({"進貨", "新增庫存"})) &
+            (df_pid["日期時間"] > calc_start_dt) &
+            (df_pid["日期時間"] <= end_dt)
+        ]["數量_g"].sum()
+        usage_qty = sum(
+            grams for order_dt, grams in usage_by_pid.get(pid, [])
+            if calc_start_dt < order_dt <= end_dt
+        )
+        summary.append((pid, float(ini_value), float(in_qty), float(usage_qty), float(ini_value + in_qty - usage_qty)))
+    return summary
+
+
+def _random_inventory(seed):
+    rng = random.Random(seed)
+    powders = [f"P{index:03d}" for index in range(12)]
+    dates = ["2026/01/05", "2026-01-05 08:30", "2026-02-01", "46030", "", "2026/03/15 17:00:00", "not a date"]
+    movements = []
+    for _ in range(150):
+        movements.append({
+            "類型": rng.choice(["初始", "進貨", " 進貨 ", "新增庫存", "沖銷", "初始"]),
+            "色粉編號": rng.choice(powders) + rng.choice(["", " "]),
+            "日期": rng.choice(dates),
+            "數量": rng.choice(["100", "2.5", "", "abc", "1000"]),
+            "單位": rng.choice(["g", "kg", "KG"]),
+        })
+    usage_rows = [
+        (
+            rng.choice(powders),
+            pd.Timestamp("2026-01-01") + pd.Timedelta(days=rng.randrange(90), hours=12),
+            float(rng.randrange(1, 500)),
+        )
+        for _ in range(300)
+    ]
+    return pd.DataFrame(movements), usage_rows, powders + ["P999"]
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("query", [
+    (None, "2026-12-31"),
+    ("2026-01-20", "2026-02-28"),
+    ("2026-03-01", "2026-03-01"),
+])
+def test_summarize_stock_matches_legacy_per_powder_loop(seed, query):
+    df_stock, usage_rows, powder_ids = _random_inventory(seed)
+    start = pd.Timestamp(query[0]) if query[0] else None
+    end = pd.Timestamp(query[1]) + pd.Timedelta(hours=23, minutes=59, seconds=59)
+    usage = pd.DataFrame(usage_rows, columns=["色粉編號", "生產時間", "用量_g"])
+
+    engine = summarize_stock(prepare_movements(df_stock), usage, powder_ids, start=start, end=end)
+    legacy = _legacy_stock_summary(df_stock, usage_rows, powder_ids, start or pd.Timestamp.min, end)
+
+    actual = list(engine[["色粉編號", "期初庫存_g", "區間進貨_g", "區間用量_g", "期末庫存_g"]].itertuples(index=False))
+    assert [row[0] for row in actual] == [row[0] for row in legacy]
+    for got, expected in zip(actual, legacy):
+        assert tuple(got[1:]) == pytest.approx(expected[1:])
+
+
+def test_summarize_stock_reports_initial_source():
+    df_stock = pd.DataFrame([
+        {"類型": "初始", "色粉編號": "P1", "日期": "2026/01/02", "數量": "1", "單位": "kg"},
+        {"類型": "初始", "色粉編號": "P1", "日期": "2026/01/02", "數量": "7", "單位": "g"},
+        {"類型": "初始", "色粉編號": "P2", "日期": "", "數量": "5", "單位": "g"},
+        {"類型": "進貨", "色粉編號": "P3", "日期": "2026/01/03", "數量": "9", "單位": "g"},
+    ])
+    usage = pd.DataFrame(columns=["色粉編號", "生產時間", "用量_g"])
+
+    summary = summarize_stock(
+        prepare_movements(df_stock), usage, ["P1", "P2", "P3"], end=pd.Timestamp("2026-12-31"),
+    ).set_index("色粉編號")
+
+    # Ties on the initial date keep the first row, as the stable sort did.
+    assert summary.loc["P1", "期初庫存_g"] == 1000
+    assert summary.loc["P1", "期初時間"] == pd.Timestamp("2026-01-02")
+    assert bool(summary.loc["P2", "有期初"]) and pd.isna(summary.loc["P2", "期初時間"])
+    # Without an initial the period starts at midnight of the first movement day.
+    assert not summary.loc["P3", "有期初"]
+    assert summary.loc["P3", "區間進貨_g"] == 0
+
+
+def test_stock_summary_is_shared_per_content_fingerprint(monkeypatch):
+    stock_engine.clear_stock_cache()
+    calls = []
+    original = stock_engine.summarize_stock
+    monkeypatch.setattr(stock_engine, "summarize_stock", lambda *a, **k: calls.append(1) or original(*a, **k))
+    df_stock, usage_rows, powder_ids = _random_inventory(1)
+    usage = pd.DataFrame(usage_rows, columns=["色粉編號", "生產時間", "用量_g"])
+    end = pd.Timestamp("2026-12-31 23:59:59")
+
+    first = stock_summary(df_stock, usage, powder_ids, end=end)
+    # A fresh copy of the same rows (another session's load) hits the cache.
+    second = stock_summary(df_stock.copy(), usage.copy(), powder_ids, end=end)
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+    second.loc[0, "期末庫存_g"] = -1
+    assert stock_summary(df_stock, usage, powder_ids, end=end).loc[0, "期末庫存_g"] != -1
+
+    changed = df_stock.copy()
+    changed.loc[0, "數量"] = "12345"
+    stock_summary(changed, usage, powder_ids, end=end)
+    assert len(calls) == 2
+    stock_engine.clear_stock_cache()
+
+
+def test_stock_summary_version_key_skips_fingerprints(monkeypatch):
+    stock_engine.clear_stock_cache()
+    df_stock, usage_rows, powder_ids = _random_inventory(2)
+    usage = pd.DataFrame(usage_rows, columns=["色粉編號", "生產時間", "用量_g"])
+    end = pd.Timestamp("2026-12-31 23:59:59")
+    first = stock_summary(df_stock, usage, powder_ids, end=end, version_key=(3, 5, 1))
+
+    monkeypatch.setattr(stock_engine, "frame_fingerprint", lambda frame: pytest.fail("fingerprinted"))
+    monkeypatch.setattr(stock_engine, "summarize_stock", lambda *a, **k: pytest.fail("recomputed"))
+    pd.testing.assert_frame_equal(
+        stock_summary(df_stock.copy(), usage.copy(), powder_ids, end=end, version_key=(3, 5, 1)), first
+    )
+    with pytest.raises(pytest.fail.Exception):
+        stock_summary(df_stock, usage, powder_ids, end=end, version_key=(4, 5, 1))
+    stock_engine.clear_stock_cache()
+
+
+def _app_stock_page_functions(namespace):
+    """Compile the 庫存區 helpers straight out of app.py (Streamlit cannot be imported here)."""
+    import ast
+    from pathlib import Path
+
+    source = (Path(__file__).resolve().parents[1] / "app.py").read_text(encoding="utf-8")
+    wanted = {
+        node.name: node
+        for node in ast.walk(ast.parse(source))
+        if isinstance(node, ast.FunctionDef)
+        and (node.name == "build_stock_summary" or (node.name == "format_usage" and node.args.args[0].arg == "val_g"))
+    }
+    exec(compile(ast.Module(body=list(wanted.values()), type_ignores=[]), "app.py", "exec"), namespace)
+    return namespace["build_stock_summary"]
+
+
+def test_app_build_stock_summary_runs_the_engine():
+    stock_engine.clear_stock_cache()
+    df_stock = pd.DataFrame({
+        "類型": ["初始", "進貨"], "色粉編號": ["P1", "P1"], "日期": ["2026/1/1", "2026/1/3"],
+        "數量": ["1", "500"], "單位": ["kg", "g"], "備註": ["", ""],
+    })
+    session_state = {}
+    namespace = {
+        "pd": pd,
+        "st": type("St", (), {"session_state": session_state, "warning": staticmethod(pytest.fail)}),
+        "df_stock": df_stock,
+        "df_recipe": pd.DataFrame(),
+        "DATABASE_CONFIG": None,
+        "list_powder_usage": lambda *args, **kwargs: [
+            {"colorpowder_id": "P1", "production_date": "2026-01-05", "grams": 200},
+        ],
+        "stock_versions": {"inventory_movements": 1, "production_orders": 1, "recipe_components": 1,
+                           "order_powder_consumption": 1},
+        "compute_stock_summary": stock_summary,
+    }
+    build_stock_summary = _app_stock_page_functions(namespace)
+
+    rows, error = build_stock_summary(query_end="2026-12-31")
+
+    assert error is None
+    assert [(row["色粉編號"], row["期末庫存"]) for row in rows] == [("P1", "1.3 kg")]
+    assert session_state["last_final_stock"] == {"P1": 1300.0}
+    stock_engine.clear_stock_cache()
@@ -0,0 +1,239 @@
+"""Consistent, compressed and rotated database backups with checksum manifests."""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+from .database import (
+    BACKUP_PAGE_ROWS,
+    DatabaseConfig,
+    _quote_identifier,
+    connect_from_config,
+    copy_database_by_pages,
+    get_db_path,
+    snapshot_sqlite,
+    write_behind_remote_config,
+)
+
+
+DEFAULT_BACKUP_DIR = Path("data/backups")
+BACKUP_KEEP_LAST = 14
+MANIFEST_SUFFIX = ".manifest.json"
+_CHUNK_SIZE = 1 << 20
+_COMPRESSIONS: dict[str, tuple[str, Callable[..., Any]]] = {
+    "gzip": (".gz", gzip.open),
+    "lzma": (".xz", lzma.open),
+    "none": ("", open),
+}
+_BACKUP_NAME = re.compile(r"^colorpowder-(\d{8}T\d{6}Z)\.db(\.gz|\.xz)?$")
+_STAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+class BackupError(RuntimeError):
+    """Raised when a backup cannot be written or restored safely."""
+
+
+@dataclass
+class BackupResult:
+    path: Path
+    manifest_path: Path
+    backend: str
+    compression: str
+    size_bytes: int
+    sha256: str
+    tables: dict[str, int] = field(default_factory=dict)
+    removed: list[Path] = field(default_factory=list)
+
+
+@dataclass
+class BackupVerification:
+    path: Path
+    checksum_ok: bool | None
+    quick_check: list[str] = field(default_factory=list)
+    tables: dict[str, int] = field(default_factory=dict)
+    restored_to: Path | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.checksum_ok is not False and self.quick_check == ["ok"]
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _compression_of(path: Path) -> str:
+    for name, (suffix, _) in _COMPRESSIONS.items():
+        if suffix and path.name.endswith(suffix):
+            return name
+    return "none"
+
+
+def _stream(source: Path, target: Path, *, read: Callable[..., Any], write: Callable[..., Any]) -> None:
+    with read(source, "rb") as reader, write(target, "wb") as writer:
+        shutil.copyfileobj(reader, writer, _CHUNK_SIZE)
+
+
+def _table_counts(conn: sqlite3.Connection) -> dict[str, int]:
+    names = [
+        row[0]
+        for row in conn.execute(
+            """SELECT name FROM sqlite_schema
+               WHERE type='table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'
+               ORDER BY name"""
+        ).fetchall()
+    ]
+    return {name: conn.execute(f"SELECT COUNT(*) FROM {_quote_identifier(name)}").fetchone()[0] for name in names}
+
+
+def rotate_backups(
+    backup_dir: str | Path = DEFAULT_BACKUP_DIR,
+    *,
+    keep_last: int = BACKUP_KEEP_LAST,
+    keep_days: int | None = None,
+    now: datetime | None = None,
+) -> list[Path]:
+    """Delete backups beyond the newest ``keep_last`` unless younger than ``keep_days``."""
+    if keep_last < 1:
+        raise ValueError("keep_last must be at least 1")
+    now = now or datetime.now(timezone.utc)
+    backups = sorted(
+        (
+            (datetime.strptime(match.group(1), _STAMP_FORMAT).replace(tzinfo=timezone.utc), path)
+            for path in Path(backup_dir).glob("colorpowder-*")
+            if (match := _BACKUP_NAME.match(path.name))
+        ),
+        reverse=True,
+    )
+    removed = []
+    for position, (created_at, path) in enumerate(backups):
+        if position < keep_last or (keep_days is not None and created_at >= now - timedelta(days=keep_days)):
+            continue
+        path.unlink()
+        path.with_name(path.name + MANIFEST_SUFFIX).unlink(missing_ok=True)
+        removed.append(path)
+    return removed
+
+
+def create_backup(
+    config: DatabaseConfig,
+    backup_dir: str | Path = DEFAULT_BACKUP_DIR,
+    *,
+    compression: str = "gzip",
+    keep_last: int = BACKUP_KEEP_LAST,
+    keep_days: int | None = None,
+    page_rows: int = BACKUP_PAGE_ROWS,
+    now: datetime | None = None,
+) -> BackupResult:
+    """Snapshot the configured database, compress it, write a manifest and rotate.
+
+    SQLite uses the online backup API; Turso is streamed table by table into a
+    local SQLite file.  The compressed file only appears under its final name
+    once complete, next to ``<file>.manifest.json`` holding its checksums.
+    A write-behind config is backed up from its remote, never the replica.
+    """
+    config = write_behind_remote_config(config)
+    if compression not in _COMPRESSIONS:
+        raise ValueError(f"compression must be one of {sorted(_COMPRESSIONS)}")
+    now = (now or datetime.now(timezone.utc)).replace(microsecond=0)
+    backup_dir = Path(backup_dir)
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    suffix, opener = _COMPRESSIONS[compression]
+    target = backup_dir / f"colorpowder-{now.astimezone(timezone.utc).strftime(_STAMP_FORMAT)}.db{suffix}"
+    if target.exists():
+        raise BackupError(f"Backup already exists: {target}")
+
+    with tempfile.TemporaryDirectory(dir=backup_dir) as workdir:
+        snapshot = Path(workdir) / "snapshot.db"
+        if config.backend == "sqlite":
+            source = get_db_path(config.path)
+            if not source.exists():
+                raise BackupError(f"SQLite database not found: {source}")
+            snapshot_sqlite(source, snapshot)
+        else:
+            with connect_from_config(config) as conn:
+                copy_database_by_pages(conn, snapshot, page_rows=page_rows)
+        local = sqlite3.connect(snapshot)
+        try:
+            tables = _table_counts(local)
+            schema_version = local.execute("SELECT MAX(version) FROM schema_migrations").fetchone()[0]
+        finally:
+            local.close()
+        partial = Path(workdir) / target.name
+        _stream(snapshot, partial, read=open, write=opener)
+        manifest = {
+            "file": target.name,
+            "created_at": now.astimezone(timezone.utc).isoformat(),
+            "backend": config.backend,
+            "schema_version": schema_version,
+            "compression": compression,
+            "size_bytes": partial.stat().st_size,
+            "sha256": _file_sha256(partial),
+            "db_size_bytes": snapshot.stat().st_size,
+            "db_sha256": _file_sha256(snapshot),
+            "tables": tables,
+        }
+        os.replace(partial, target)
+    manifest_path = target.with_name(target.name + MANIFEST_SUFFIX)
+    manifest_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    return BackupResult(
+        path=target,
+        manifest_path=manifest_path,
+        backend=config.backend,
+        compression=compression,
+        size_bytes=manifest["size_bytes"],
+        sha256=manifest["sha256"],
+        tables=tables,
+        removed=rotate_backups(backup_dir, keep_last=keep_last, keep_days=keep_days, now=now),
+    )
+
+
+def verify_backup(path: str | Path, *, restore_to: str | Path | None = None) -> BackupVerification:
+    """Check a backup against its manifest and run ``PRAGMA quick_check`` on it.
+
+    When ``restore_to`` is given and verification passes, the decompressed
+    database is moved there; an existing file is never overwritten.
+    """
+    path = Path(path)
+    if restore_to is not None and Path(restore_to).exists():
+        raise BackupError(f"Restore target already exists: {restore_to}")
+    manifest_path = path.with_name(path.name + MANIFEST_SUFFIX)
+    checksum_ok = None
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        checksum_ok = _file_sha256(path) == manifest.get("sha256")
+    result = BackupVerification(path=path, checksum_ok=checksum_ok)
+    with tempfile.TemporaryDirectory() as workdir:
+        restored = Path(workdir) / "restored.db"
+        try:
+            _stream(path, restored, read=_COMPRESSIONS[_compression_of(path)][1], write=open)
+            conn = sqlite3.connect(restored)
+            try:
+                result.quick_check = [str(row[0]) for row in conn.execute("PRAGMA quick_check").fetchall()]
+                result.tables = _table_counts(conn)
+            finally:
+                conn.close()
+        except (OSError, EOFError, lzma.LZMAError, sqlite3.DatabaseError) as exc:
+            result.quick_check = [f"{type(exc).__name__}: {exc}"]
+        if result.ok and restore_to is not None:
+            target = Path(restore_to)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(restored), target)
+            result.restored_to = target
+    return result
@@ -3,12 +3,28 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Any
-
-from .database import DatabaseConfig, connect_from_config, enqueue_sheet_sync, utc_now_iso
+from typing import Any, Iterable
+
+from .database import (
+    ChangeSet,
+    DatabaseConfig,
+    connect_from_config,
+    enqueue_sheet_sync,
+    keyset_after,
+    page_limit,
+    change_watermark,
+    utc_now_iso,
+)
 from .sheet_export import color_powder_sheet_payload
 
 
+COLOR_POWDER_LIST_COLUMNS = (
+    "colorpowder_id", "international_code", "name", "category", "package",
+    "notes", "lifecycle_status", "deleted_at", "delete_reason",
+    "version", "updated_at", "last_synced_at",
+)
+
+
 class ColorPowderError(RuntimeError):
     """Base error safe for the color-powder UI to present."""
 
@@ -57,18 +73,72 @@ def _mappings(cursor) -> list[dict[str, Any]]:
     return [dict(zip(columns, row)) for row in rows]
 
 
-def list_color_powders(config: DatabaseConfig, *, include_inactive: bool = False) -> list[dict[str, Any]]:
-    """Return canonical color powders from the configured source of truth."""
+def list_color_powders(
+    config: DatabaseConfig,
+    *,
+    include_inactive: bool = False,
+    colorpowder_id: str | None = None,
+    category: str | None = None,
+    lifecycle: str | None = None,
+    changed_after: int | None = None,
+    columns: Iterable[str] | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+) -> list[dict[str, Any]]:
+    """Return canonical color powders from the configured source of truth.
+
+    Filters run in SQL; ``after`` is the last ``colorpowder_id`` of the previous
+    page and ``limit`` caps the page size.  ``lifecycle`` overrides
+    ``include_inactive``.
+    """
+    selected = list(columns or COLOR_POWDER_LIST_COLUMNS)
+    unknown = set(selected) - set(COLOR_POWDER_LIST_COLUMNS)
+    if unknown:
+        raise ColorPowderError(f"不支援的欄位：{', '.join(sorted(unknown))}")
+    clauses: list[str] = []
+    params: list[Any] = []
+    if lifecycle:
+        clauses.append("lifecycle_status=?")
+        params.append(lifecycle)
+    elif not include_inactive:
+        clauses.append("lifecycle_status='active'")
+    for column, value in (("colorpowder_id", colorpowder_id), ("category", category)):
+        if value:
+            clauses.append(f"{column}=?")
+            params.append(str(value).strip())
+    if changed_after is not None:
+        clauses.append("change_seq>?")
+        params.append(changed_after)
+    if after is not None:
+        clauses.append(keyset_after(["colorpowder_id"], "?"))
+        params.append(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    limit_sql, limit_params = page_limit(limit)
     with connect_from_config(config) as conn:
-        where = "" if include_inactive else "WHERE lifecycle_status='active'"
         return _mappings(conn.execute(
-            f"""SELECT colorpowder_id, international_code, name, category, package,
-                       notes, lifecycle_status, deleted_at, delete_reason,
-                       version, updated_at, last_synced_at
-                FROM color_powders {where} ORDER BY colorpowder_id"""
+            f"""SELECT {', '.join(selected)}
+                FROM color_powders {where} ORDER BY colorpowder_id {limit_sql}""",
+            (*params, *limit_params),
         ))
 
 
+def list_color_powders_changed_since(
+    config: DatabaseConfig, watermark: int | None, *, include_inactive: bool = False,
+) -> ChangeSet:
+    """Powders written after ``watermark``; disabled ones are tombstones unless included."""
+    with connect_from_config(config) as conn:
+        next_watermark = change_watermark(conn, "color_powders")
+    rows = list_color_powders(config, include_inactive=True, changed_after=watermark)
+    return ChangeSet(
+        upserted=[row for row in rows if include_inactive or row["lifecycle_status"] == "active"],
+        tombstoned=[
+            row["colorpowder_id"] for row in rows
+            if not include_inactive and row["lifecycle_status"] != "active"
+        ],
+        watermark=watermark if next_watermark is None else next_watermark,
+    )
+
+
 def set_color_powder_active(config: DatabaseConfig, colorpowder_id: str, *, active: bool, reason: str = "") -> dict[str, Any]:
     """Soft-disable or restore a powder without deleting inventory history."""
     colorpowder_id = str(colorpowder_id or "").strip()
@@ -10,18 +10,48 @@ from __future__ import annotations
 
 import json
 import logging
+import math
 import os
-import shutil
+import re
 import sqlite3
+import threading
+import time
+import uuid
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Protocol
+from typing import Any, Callable, Iterable, Protocol, Sequence
 
 DEFAULT_DB_PATH = Path("data/colorpowder.db")
-SCHEMA_VERSION = 9
+SCHEMA_VERSION = 22
 LOGGER = logging.getLogger(__name__)
+POOL_MAX_SIZE = 4
+POOL_IDLE_TIMEOUT_SECONDS = 300.0
+POOL_HEALTH_CHECK_AFTER_SECONDS = 30.0
+POOL_CHECKOUT_TIMEOUT_SECONDS = 30.0
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP_SECONDS = 0.01
+BACKUP_PAGE_ROWS = 500
+# Tables whose every mutation bumps a data_versions counter for shared caches.
+VERSIONED_TABLES = (
+    "recipes",
+    "recipe_components",
+    "color_powders",
+    "suppliers",
+    "inventory_movements",
+    "production_orders",
+    "order_powder_consumption",
+)
+# Tables whose rows carry ``change_seq``: the table's data_versions counter at
+# their last write, stamped by trigger so change feeds need no client clock.
+CHANGE_CURSOR_TABLES = (
+    "color_powders",
+    "suppliers",
+    "recipes",
+    "inventory_movements",
+    "production_orders",
+)
 MAIN_TABLES = {
     "color_powders",
     "suppliers",
@@ -36,16 +66,28 @@ MAIN_TABLES = {
     "sync_log",
     "sync_conflicts",
     "sync_outbox",
+    "sync_outbox_archive",
     "sync_worker_locks",
+    "powder_stock_balances",
+    "order_powder_consumption",
+    "recipe_usage_vectors",
+    "recipe_search",
+    "production_order_search",
+    "sequences",
+    "data_versions",
+    "write_journal",
+    "write_journal_applied",
 }
 REQUIRED_TABLE_COLUMNS = {
-    "color_powders": {"lifecycle_status", "deleted_at", "delete_reason"},
-    "suppliers": {"lifecycle_status", "deleted_at", "delete_reason"},
+    "color_powders": {"lifecycle_status", "deleted_at", "delete_reason", "change_seq"},
+    "suppliers": {"lifecycle_status", "deleted_at", "delete_reason", "change_seq"},
     "inventory_movements": {
-        "supplier_id", "supplier_name", "reversal_of_movement_key", "reversed_at",
+        "supplier_id", "supplier_name", "reversal_of_movement_key", "reversed_at", "change_seq", "movement_day",
     },
-    "recipes": {"oem_multiplier", "lifecycle_status", "deleted_at", "delete_reason"},
-    "production_orders": {"cancelled_at", "cancel_reason"},
+    "recipes": {"oem_multiplier", "lifecycle_status", "deleted_at", "delete_reason", "change_seq"},
+    "production_orders": {"cancelled_at", "cancel_reason", "change_seq", "production_day"},
+    "order_powder_consumption": {"balance_grams", "ranking_grams"},
+    "recipe_usage_vectors": {"balance_grams_per_kg", "ranking_grams_per_kg"},
 }
 
 
@@ -57,6 +99,10 @@ class SqlExecutor(Protocol):
     def execute(self, sql: str, parameters: tuple[Any, ...] = ()) -> Any: ...
 
 
+Statement = tuple[str, Sequence[Any]]
+_LITERAL_OR_PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|\?")
+
+
 def _execute_script(conn: SqlExecutor, sql_script: str) -> None:
     if hasattr(conn, "executescript"):
         conn.executescript(sql_script)
@@ -67,6 +113,88 @@ def _execute_script(conn: SqlExecutor, sql_script: str) -> None:
             conn.execute(statement)
 
 
+def _sql_literal(value: Any) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float) and math.isfinite(value):
+        return repr(value)
+    if isinstance(value, str) and "\x00" not in value:
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, bytes):
+        return "X'" + value.hex() + "'"
+    raise TypeError(f"cannot inline {type(value).__name__} into a batch")
+
+
+def _render_statement(sql: str, params: Sequence[Any]) -> str:
+    values = iter(params)
+
+    def substitute(match: re.Match[str]) -> str:
+        if match.group(0) != "?":
+            return match.group(0)
+        value = next(values, _LITERAL_OR_PLACEHOLDER)
+        if value is _LITERAL_OR_PLACEHOLDER:
+            raise ValueError("fewer parameters than placeholders")
+        return _sql_literal(value)
+
+    rendered = _LITERAL_OR_PLACEHOLDER.sub(substitute, sql)
+    if next(values, _LITERAL_OR_PLACEHOLDER) is not _LITERAL_OR_PLACEHOLDER:
+        raise ValueError("more parameters than placeholders")
+    return rendered
+
+
+def execute_batch(conn: SqlExecutor, statements: Iterable[Statement]) -> None:
+    """Send write statements whose results are not needed in as few round trips as possible.
+
+    Local sqlite3 runs in-process; consecutive repeats of one statement go
+    through ``executemany`` (``executescript`` would commit the caller's
+    transaction).  A remote libsql connection gets the whole list as one
+    ``executescript`` request with parameters rendered as SQL literals, opening
+    the implicit transaction first so the batch commits or rolls back with the
+    rest of the ``connect_from_config`` block.
+    """
+    statements = [(sql, tuple(params)) for sql, params in statements]
+    if not statements:
+        return
+    if not isinstance(conn, sqlite3.Connection) and hasattr(conn, "executescript"):
+        try:
+            script = ";\n".join(_render_statement(sql, params) for sql, params in statements)
+        except (TypeError, ValueError):
+            script = None
+        if script is not None:
+            if not getattr(conn, "in_transaction", False):
+                script = "BEGIN;\n" + script
+            conn.executescript(script + ";")
+            return
+    index = 0
+    while index < len(statements):
+        sql = statements[index][0]
+        end = index + 1
+        while end < len(statements) and statements[end][0] == sql:
+            end += 1
+        if end - index > 1 and hasattr(conn, "executemany"):
+            conn.executemany(sql, [params for _sql, params in statements[index:end]])
+        else:
+            for _sql, params in statements[index:end]:
+                conn.execute(sql, params)
+        index = end
+
+
+def missing_keys(conn: SqlExecutor, table: str, column: str, keys: Iterable[str]) -> list[str]:
+    """Keys (in the given order) with no row in ``table``, checked with one ``IN`` query."""
+    wanted = list(dict.fromkeys(str(key) for key in keys if str(key or "")))
+    if not wanted:
+        return []
+    rows = conn.execute(
+        f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join('?' for _ in wanted)})", wanted,
+    ).fetchall()
+    found = {str(row[0]) for row in rows}
+    return [key for key in wanted if key not in found]
+
+
 @dataclass(frozen=True)
 class DatabaseHealth:
     backend: str
@@ -84,6 +212,38 @@ class DatabaseHealth:
         return self.main_tables_exist and not self.missing_required_columns
 
 
+@dataclass(frozen=True)
+class ChangeSet:
+    """Rows written since a watermark: current rows, keys that left the list, and the next watermark."""
+
+    upserted: list[dict[str, Any]]
+    tombstoned: list[str]
+    watermark: int | None
+
+
+def change_watermark(conn: SqlExecutor, table: str) -> int | None:
+    """The table's data_versions counter; read before the delta so no write can slip past it.
+
+    Rows written later carry a larger ``change_seq``, so ``change_seq > watermark``
+    never depends on ``updated_at`` text, which Sheet imports fill with
+    whatever date format the Sheet uses.
+    """
+    row = conn.execute("SELECT version FROM data_versions WHERE table_name=?", (table,)).fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def keyset_after(sort_key: Sequence[str], anchor_sql: str) -> str:
+    """Row-value predicate for rows sorting after the cursor row selected by ``anchor_sql``."""
+    return f"({', '.join(sort_key)}) > ({anchor_sql})"
+
+
+def page_limit(limit: int | None) -> tuple[str, tuple[Any, ...]]:
+    """``LIMIT ?`` clause and parameter, or nothing when ``limit`` is None."""
+    if limit is None:
+        return "", ()
+    return "LIMIT ?", (max(int(limit), 0),)
+
+
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
@@ -94,6 +254,8 @@ class DatabaseConfig:
     path: Path | None = DEFAULT_DB_PATH
     turso_database_url: str | None = None
     turso_auth_token: str | None = None
+    # Local SQLite journal for write-behind mode; None writes straight to the backend.
+    write_behind_path: Path | None = None
 
 
 def _clean_secret(value: Any) -> str | None:
@@ -166,9 +328,16 @@ def database_config_from_secrets(secrets: Any | None = None) -> DatabaseConfig:
     if bool(url) != bool(token):
         missing = "TURSO_AUTH_TOKEN" if url else "TURSO_DATABASE_URL"
         raise DatabaseStartupError(f"Turso credentials are incomplete: missing {missing}.")
+    # Write-behind is opt-in per deployment through secrets only, so CLI workers
+    # configured from the environment keep writing straight to the backend.
+    journal = _secret_value(secrets, "WRITE_BEHIND_JOURNAL_PATH")
+    write_behind_path = Path(journal) if journal else None
     if url and token:
-        return DatabaseConfig(backend="turso", path=None, turso_database_url=url, turso_auth_token=token)
-    return DatabaseConfig(backend="sqlite", path=DEFAULT_DB_PATH)
+        return DatabaseConfig(
+            backend="turso", path=None, turso_database_url=url, turso_auth_token=token,
+            write_behind_path=write_behind_path,
+        )
+    return DatabaseConfig(backend="sqlite", path=DEFAULT_DB_PATH, write_behind_path=write_behind_path)
 
 
 def secret_presence_from_secrets(secrets: Any | None = None) -> dict[str, bool]:
@@ -219,16 +388,21 @@ def get_db_path(path: str | Path | None = None) -> Path:
     return Path(path) if path else DEFAULT_DB_PATH
 
 
-@contextmanager
-def connect(db_path: str | Path | None = None):
-    """Open a SQLite connection with production-safe defaults."""
+def _open_sqlite(db_path: str | Path | None = None, *, check_same_thread: bool = True) -> sqlite3.Connection:
     path = get_db_path(db_path)
     path.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(path)
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     conn.execute("PRAGMA journal_mode = WAL")
     conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+@contextmanager
+def connect(db_path: str | Path | None = None):
+    """Open a SQLite connection with production-safe defaults."""
+    conn = _open_sqlite(db_path)
     try:
         yield conn
         conn.commit()
@@ -239,27 +413,230 @@ def connect(db_path: str | Path | None = None):
         conn.close()
 
 
-@contextmanager
-def connect_from_config(config: DatabaseConfig):
-    """Open the configured SQLite-compatible backend with one transaction policy."""
+@dataclass(frozen=True)
+class ConnectionPoolStats:
+    backend: str
+    max_size: int
+    hits: int
+    misses: int
+    health_check_failures: int
+    evicted: int
+    discarded: int
+    idle: int
+    in_use: int
+
+    @property
+    def handshakes_saved(self) -> int:
+        return self.hits
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of reusable connections for one backend.
+
+    Each checkout is exclusive to one caller. Idle connections older than
+    ``idle_timeout_seconds`` are closed, and a connection that sat idle for
+    ``health_check_after_seconds`` must answer ``SELECT 1`` before reuse.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        *,
+        backend: str,
+        max_size: int = POOL_MAX_SIZE,
+        idle_timeout_seconds: float = POOL_IDLE_TIMEOUT_SECONDS,
+        health_check_after_seconds: float = POOL_HEALTH_CHECK_AFTER_SECONDS,
+        checkout_timeout_seconds: float = POOL_CHECKOUT_TIMEOUT_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._factory = factory
+        self.backend = backend
+        self.max_size = max_size
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.health_check_after_seconds = health_check_after_seconds
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._idle: list[tuple[Any, float]] = []
+        self._in_use = 0
+        self._closed = False
+        self._hits = 0
+        self._misses = 0
+        self._health_check_failures = 0
+        self._evicted = 0
+        self._discarded = 0
+
+    def _evict_expired_locked(self, now: float) -> list[Any]:
+        expired = [conn for conn, last_used in self._idle if now - last_used >= self.idle_timeout_seconds]
+        if expired:
+            self._idle = [
+                (conn, last_used) for conn, last_used in self._idle
+                if now - last_used < self.idle_timeout_seconds
+            ]
+            self._evicted += len(expired)
+        return expired
+
+    @staticmethod
+    def _close_quietly(conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:  # pragma: no cover - best effort cleanup of broken clients
+            LOGGER.debug("Ignoring error while closing pooled connection", exc_info=True)
+
+    def _healthy(self, conn: Any) -> bool:
+        try:
+            return conn.execute("SELECT 1").fetchone()[0] == 1
+        except Exception:
+            return False
+
+    def acquire(self) -> Any:
+        deadline = self._clock() + self.checkout_timeout_seconds
+        while True:
+            candidate: tuple[Any, float] | None = None
+            with self._condition:
+                if self._closed:
+                    raise DatabaseStartupError("Connection pool is closed")
+                expired = self._evict_expired_locked(self._clock())
+                if self._idle:
+                    candidate = self._idle.pop()
+                    self._in_use += 1
+                elif self._in_use < self.max_size:
+                    self._in_use += 1
+                    self._misses += 1
+                else:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        raise DatabaseStartupError(
+                            f"Timed out waiting for a {self.backend} connection; pool size is {self.max_size}."
+                        )
+                    self._condition.wait(remaining)
+                    continue
+            for conn in expired:
+                self._close_quietly(conn)
+            if candidate is None:
+                try:
+                    return self._factory()
+                except BaseException:
+                    with self._condition:
+                        self._in_use -= 1
+                        self._condition.notify()
+                    raise
+            conn, last_used = candidate
+            if self._clock() - last_used < self.health_check_after_seconds or self._healthy(conn):
+                with self._condition:
+                    self._hits += 1
+                return conn
+            self._close_quietly(conn)
+            with self._condition:
+                self._health_check_failures += 1
+                self._in_use -= 1
+                self._condition.notify()
+
+    def release(self, conn: Any, *, reusable: bool = True) -> None:
+        with self._condition:
+            self._in_use -= 1
+            keep = reusable and not self._closed
+            if keep:
+                self._idle.append((conn, self._clock()))
+            else:
+                self._discarded += 1
+            self._condition.notify()
+        if not keep:
+            self._close_quietly(conn)
+
+    def close(self) -> None:
+        with self._condition:
+            idle = [conn for conn, _last_used in self._idle]
+            self._idle = []
+            self._closed = True
+            self._condition.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> ConnectionPoolStats:
+        with self._condition:
+            return ConnectionPoolStats(
+                backend=self.backend,
+                max_size=self.max_size,
+                hits=self._hits,
+                misses=self._misses,
+                health_check_failures=self._health_check_failures,
+                evicted=self._evicted,
+                discarded=self._discarded,
+                idle=len(self._idle),
+                in_use=self._in_use,
+            )
+
+
+_CONNECTION_POOLS: dict[DatabaseConfig, ConnectionPool] = {}
+_CONNECTION_POOLS_LOCK = threading.Lock()
+
+
+def _pool_key(config: DatabaseConfig) -> DatabaseConfig:
     if config.backend == "sqlite":
-        with connect(config.path) as conn:
-            yield conn
-        return
-    if config.backend != "turso":
+        return DatabaseConfig(backend="sqlite", path=get_db_path(config.path).resolve())
+    return replace(config, write_behind_path=None)
+
+
+def _connection_pool(config: DatabaseConfig) -> ConnectionPool:
+    if config.backend not in {"sqlite", "turso"}:
         raise DatabaseStartupError(f"Unsupported database backend: {config.backend}")
+    key = _pool_key(config)
+    with _CONNECTION_POOLS_LOCK:
+        pool = _CONNECTION_POOLS.get(key)
+        if pool is None:
+            if config.backend == "sqlite":
+                factory = lambda: _open_sqlite(key.path, check_same_thread=False)  # noqa: E731
+            else:
+                factory = lambda: _connect_turso(config)  # noqa: E731
+            pool = ConnectionPool(factory, backend=config.backend)
+            _CONNECTION_POOLS[key] = pool
+        return pool
+
+
+def connection_pool_stats(config: DatabaseConfig) -> ConnectionPoolStats:
+    """Return hit/miss counters; each hit is one avoided connect handshake."""
+    return _connection_pool(config).stats()
+
 
-    client = _connect_turso(config)
+def close_connection_pools() -> None:
+    """Close every idle pooled connection, e.g. at shutdown or between tests."""
+    with _CONNECTION_POOLS_LOCK:
+        pools = list(_CONNECTION_POOLS.values())
+        _CONNECTION_POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+@contextmanager
+def connect_from_config(config: DatabaseConfig):
+    """Check out a pooled connection for the configured backend as one transaction.
+
+    Success commits and returns the connection to the process-wide pool. Any
+    failure rolls back and discards the connection so a broken remote client
+    is never handed to the next caller.  In write-behind mode the block runs on
+    the local journal instead (see ``JournalConnection``).
+    """
+    if config.write_behind_path is not None:
+        with connect_from_config(write_behind_journal_config(config)) as conn:
+            yield JournalConnection(conn)
+        return
+    pool = _connection_pool(config)
+    conn = pool.acquire()
+    reusable = False
     try:
-        yield client
-        if hasattr(client, "commit"):
-            client.commit()
+        yield conn
+        if hasattr(conn, "commit"):
+            conn.commit()
+        reusable = not getattr(conn, "in_transaction", False)
     except Exception:
-        if hasattr(client, "rollback"):
-            client.rollback()
+        if hasattr(conn, "rollback"):
+            conn.rollback()
         raise
     finally:
-        client.close()
+        pool.release(conn, reusable=reusable)
 
 
 def _fetchall(cursor: Any) -> list[Any]:
@@ -282,8 +659,7 @@ def _add_column_if_missing(conn: SqlExecutor, table_name: str, column_name: str,
         conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_sql}")
 
 
-def _initialize_schema(conn: SqlExecutor) -> None:
-    """Create/validate the current schema on an open SQLite-compatible connection."""
+def _migrate_v1_core_tables(conn: SqlExecutor) -> None:
     _execute_script(
         conn,
         """
@@ -326,14 +702,6 @@ def _initialize_schema(conn: SqlExecutor) -> None:
             sheet_row_key TEXT UNIQUE
         );
 
-        CREATE TABLE IF NOT EXISTS supplier_aliases (
-            alias TEXT PRIMARY KEY,
-            supplier_id TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (supplier_id) REFERENCES suppliers(supplier_id)
-                ON UPDATE CASCADE ON DELETE CASCADE
-        );
-
         CREATE TABLE IF NOT EXISTS inventory_movements (
             movement_id INTEGER PRIMARY KEY AUTOINCREMENT,
             movement_key TEXT UNIQUE,
@@ -359,6 +727,108 @@ def _initialize_schema(conn: SqlExecutor) -> None:
             UNIQUE(sheet_name, sheet_row_key)
         );
 
+        CREATE TABLE IF NOT EXISTS sheet_rows (
+            sheet_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            payload_json TEXT NOT NULL,
+            row_hash TEXT NOT NULL,
+            source TEXT NOT NULL DEFAULT 'google_sheets',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            sheet_updated_at TEXT,
+            last_seen_at TEXT NOT NULL,
+            last_synced_at TEXT,
+            PRIMARY KEY (sheet_name, row_key)
+        );
+
+        CREATE TABLE IF NOT EXISTS sync_state (
+            sync_name TEXT PRIMARY KEY,
+            last_success_at TEXT,
+            last_attempt_at TEXT,
+            status TEXT NOT NULL DEFAULT 'never_run',
+            message TEXT,
+            high_watermark TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS sync_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sync_name TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            read_count INTEGER NOT NULL DEFAULT 0,
+            written_count INTEGER NOT NULL DEFAULT 0,
+            error_count INTEGER NOT NULL DEFAULT 0,
+            message TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS sync_conflicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity_type TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            sqlite_payload_json TEXT,
+            sheet_payload_json TEXT,
+            reason TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            detected_at TEXT NOT NULL,
+            resolved_at TEXT,
+            resolution_notes TEXT
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_color_powders_updated_at ON color_powders(updated_at);
+        CREATE INDEX IF NOT EXISTS idx_color_powders_category ON color_powders(category);
+        CREATE INDEX IF NOT EXISTS idx_inventory_powder_date ON inventory_movements(colorpowder_id, movement_date);
+        CREATE INDEX IF NOT EXISTS idx_inventory_updated_at ON inventory_movements(updated_at);
+        CREATE INDEX IF NOT EXISTS idx_sheet_rows_updated_at ON sheet_rows(sheet_name, updated_at);
+        CREATE INDEX IF NOT EXISTS idx_sheet_rows_hash ON sheet_rows(sheet_name, row_hash);
+        CREATE INDEX IF NOT EXISTS idx_sync_conflicts_status ON sync_conflicts(status, detected_at);
+        """
+    )
+
+
+def _migrate_v2_sheet_row_identity(conn: SqlExecutor) -> None:
+    # Databases created by schema version 1 lack the permanent Sheet row keys.
+    _add_column_if_missing(conn, "suppliers", "sheet_row_key", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "movement_key", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "sheet_name", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "sheet_row_key", "TEXT")
+    _add_column_if_missing(conn, "sheet_rows", "sheet_updated_at", "TEXT")
+    _add_column_if_missing(conn, "sheet_rows", "last_seen_at", "TEXT")
+    conn.execute("UPDATE sheet_rows SET last_seen_at = COALESCE(last_seen_at, updated_at, ?) WHERE last_seen_at IS NULL", (utc_now_iso(),))
+    _execute_script(
+        conn,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_suppliers_sheet_row_key ON suppliers(sheet_row_key) WHERE sheet_row_key IS NOT NULL;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_movement_key ON inventory_movements(movement_key) WHERE movement_key IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_inventory_sheet_row ON inventory_movements(sheet_name, sheet_row_key);
+        """
+    )
+
+
+def _migrate_v3_inventory_suppliers(conn: SqlExecutor) -> None:
+    _add_column_if_missing(conn, "inventory_movements", "supplier_id", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "supplier_name", "TEXT")
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS supplier_aliases (
+            alias TEXT PRIMARY KEY,
+            supplier_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (supplier_id) REFERENCES suppliers(supplier_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_inventory_supplier_id ON inventory_movements(supplier_id);
+        """
+    )
+
+
+def _migrate_v4_recipes(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
         CREATE TABLE IF NOT EXISTS recipes (
             recipe_id TEXT PRIMARY KEY,
             color TEXT,
@@ -404,6 +874,58 @@ def _initialize_schema(conn: SqlExecutor) -> None:
                 ON UPDATE CASCADE ON DELETE RESTRICT
         );
 
+        CREATE INDEX IF NOT EXISTS idx_recipes_updated_at ON recipes(updated_at);
+        CREATE INDEX IF NOT EXISTS idx_recipes_customer_id ON recipes(customer_id);
+        CREATE INDEX IF NOT EXISTS idx_recipe_components_powder ON recipe_components(colorpowder_id);
+        """
+    )
+
+
+def _migrate_v5_sync_outbox(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS sync_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sheet_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            operation TEXT NOT NULL CHECK(operation IN ('insert', 'update', 'delete')),
+            payload_json TEXT,
+            entity_version INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK(status IN ('pending', 'processing', 'completed', 'failed', 'conflict')),
+            attempt_count INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            processed_at TEXT,
+            UNIQUE(sheet_name, row_key, entity_version)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_sync_outbox_pending ON sync_outbox(status, sheet_name, created_at);
+        """
+    )
+
+
+def _migrate_v6_recipe_oem_multiplier(conn: SqlExecutor) -> None:
+    _add_column_if_missing(conn, "recipes", "oem_multiplier", "REAL NOT NULL DEFAULT 1")
+    conn.execute(
+        """UPDATE recipes
+           SET oem_multiplier = COALESCE(
+               (SELECT CAST(json_extract(sheet_rows.payload_json, '$."代工倍率"') AS REAL)
+                FROM sheet_rows
+                WHERE sheet_rows.sheet_name='配方管理'
+                  AND sheet_rows.row_key=recipes.recipe_id
+                  AND TRIM(COALESCE(json_extract(sheet_rows.payload_json, '$."代工倍率"'), '')) != ''),
+               oem_multiplier
+           )
+           WHERE recipes.source != 'app'"""
+    )
+
+
+def _migrate_v7_production_orders(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
         CREATE TABLE IF NOT EXISTS production_orders (
             production_order_id TEXT PRIMARY KEY,
             production_date TEXT,
@@ -437,109 +959,10 @@ def _initialize_schema(conn: SqlExecutor) -> None:
                 ON UPDATE CASCADE ON DELETE CASCADE
         );
 
-        CREATE TABLE IF NOT EXISTS sheet_rows (
-            sheet_name TEXT NOT NULL,
-            row_key TEXT NOT NULL,
-            payload_json TEXT NOT NULL,
-            row_hash TEXT NOT NULL,
-            source TEXT NOT NULL DEFAULT 'google_sheets',
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL,
-            sheet_updated_at TEXT,
-            last_seen_at TEXT NOT NULL,
-            last_synced_at TEXT,
-            PRIMARY KEY (sheet_name, row_key)
-        );
-
-        CREATE TABLE IF NOT EXISTS sync_state (
-            sync_name TEXT PRIMARY KEY,
-            last_success_at TEXT,
-            last_attempt_at TEXT,
-            status TEXT NOT NULL DEFAULT 'never_run',
-            message TEXT,
-            high_watermark TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS sync_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sync_name TEXT NOT NULL,
-            direction TEXT NOT NULL,
-            status TEXT NOT NULL,
-            started_at TEXT NOT NULL,
-            finished_at TEXT,
-            read_count INTEGER NOT NULL DEFAULT 0,
-            written_count INTEGER NOT NULL DEFAULT 0,
-            error_count INTEGER NOT NULL DEFAULT 0,
-            message TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS sync_conflicts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entity_type TEXT NOT NULL,
-            entity_id TEXT NOT NULL,
-            sqlite_payload_json TEXT,
-            sheet_payload_json TEXT,
-            reason TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'open',
-            detected_at TEXT NOT NULL,
-            resolved_at TEXT,
-            resolution_notes TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS sync_outbox (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sheet_name TEXT NOT NULL,
-            row_key TEXT NOT NULL,
-            operation TEXT NOT NULL CHECK(operation IN ('insert', 'update', 'delete')),
-            payload_json TEXT,
-            entity_version INTEGER NOT NULL,
-            status TEXT NOT NULL DEFAULT 'pending'
-                CHECK(status IN ('pending', 'processing', 'completed', 'failed', 'conflict')),
-            attempt_count INTEGER NOT NULL DEFAULT 0,
-            last_error TEXT,
-            created_at TEXT NOT NULL,
-            processed_at TEXT,
-            UNIQUE(sheet_name, row_key, entity_version)
-        );
-
-        CREATE TABLE IF NOT EXISTS sync_worker_locks (
-            lock_name TEXT PRIMARY KEY,
-            owner_id TEXT NOT NULL,
-            acquired_at TEXT NOT NULL,
-            expires_at TEXT NOT NULL
-        );
+        CREATE INDEX IF NOT EXISTS idx_production_orders_recipe ON production_orders(recipe_id);
+        CREATE INDEX IF NOT EXISTS idx_production_orders_date ON production_orders(production_date);
         """
     )
-    # Lightweight migrations for databases created by schema version 1.
-    _add_column_if_missing(conn, "suppliers", "sheet_row_key", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "movement_key", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "sheet_name", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "sheet_row_key", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "supplier_id", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "supplier_name", "TEXT")
-    _add_column_if_missing(conn, "sheet_rows", "sheet_updated_at", "TEXT")
-    _add_column_if_missing(conn, "sheet_rows", "last_seen_at", "TEXT")
-    _add_column_if_missing(conn, "recipes", "oem_multiplier", "REAL NOT NULL DEFAULT 1")
-    for table_name in ("color_powders", "suppliers", "recipes"):
-        _add_column_if_missing(conn, table_name, "lifecycle_status", "TEXT NOT NULL DEFAULT 'active'")
-        _add_column_if_missing(conn, table_name, "deleted_at", "TEXT")
-        _add_column_if_missing(conn, table_name, "delete_reason", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "reversal_of_movement_key", "TEXT")
-    _add_column_if_missing(conn, "inventory_movements", "reversed_at", "TEXT")
-    _add_column_if_missing(conn, "production_orders", "cancelled_at", "TEXT")
-    _add_column_if_missing(conn, "production_orders", "cancel_reason", "TEXT")
-    conn.execute(
-        """UPDATE recipes
-           SET oem_multiplier = COALESCE(
-               (SELECT CAST(json_extract(sheet_rows.payload_json, '$."代工倍率"') AS REAL)
-                FROM sheet_rows
-                WHERE sheet_rows.sheet_name='配方管理'
-                  AND sheet_rows.row_key=recipes.recipe_id
-                  AND TRIM(COALESCE(json_extract(sheet_rows.payload_json, '$."代工倍率"'), '')) != ''),
-               oem_multiplier
-           )
-           WHERE recipes.source != 'app'"""
-    )
     conn.execute(
         """INSERT OR IGNORE INTO production_orders(
                production_order_id, production_date, recipe_id, color, customer_name,
@@ -570,27 +993,20 @@ def _initialize_schema(conn: SqlExecutor) -> None:
                        OR TRIM(COALESCE(json_extract(payload_json, '$."包裝份數{position}"'), '')) != '')""",
             (position,),
         )
-    conn.execute("UPDATE sheet_rows SET last_seen_at = COALESCE(last_seen_at, updated_at, ?) WHERE last_seen_at IS NULL", (utc_now_iso(),))
-    conn.execute(
-        "INSERT OR IGNORE INTO schema_migrations(version, applied_at) VALUES (?, ?)",
-        (SCHEMA_VERSION, utc_now_iso()),
-    )
+
+
+def _migrate_v8_lifecycle(conn: SqlExecutor) -> None:
+    for table_name in ("color_powders", "suppliers", "recipes"):
+        _add_column_if_missing(conn, table_name, "lifecycle_status", "TEXT NOT NULL DEFAULT 'active'")
+        _add_column_if_missing(conn, table_name, "deleted_at", "TEXT")
+        _add_column_if_missing(conn, table_name, "delete_reason", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "reversal_of_movement_key", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "reversed_at", "TEXT")
+    _add_column_if_missing(conn, "production_orders", "cancelled_at", "TEXT")
+    _add_column_if_missing(conn, "production_orders", "cancel_reason", "TEXT")
     _execute_script(
         conn,
         """
-        CREATE INDEX IF NOT EXISTS idx_color_powders_updated_at ON color_powders(updated_at);
-        CREATE INDEX IF NOT EXISTS idx_color_powders_category ON color_powders(category);
-        CREATE INDEX IF NOT EXISTS idx_inventory_powder_date ON inventory_movements(colorpowder_id, movement_date);
-        CREATE INDEX IF NOT EXISTS idx_inventory_updated_at ON inventory_movements(updated_at);
-        CREATE INDEX IF NOT EXISTS idx_inventory_supplier_id ON inventory_movements(supplier_id);
-        CREATE INDEX IF NOT EXISTS idx_recipes_updated_at ON recipes(updated_at);
-        CREATE INDEX IF NOT EXISTS idx_recipes_customer_id ON recipes(customer_id);
-        CREATE INDEX IF NOT EXISTS idx_recipe_components_powder ON recipe_components(colorpowder_id);
-        CREATE INDEX IF NOT EXISTS idx_production_orders_recipe ON production_orders(recipe_id);
-        CREATE INDEX IF NOT EXISTS idx_production_orders_date ON production_orders(production_date);
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_suppliers_sheet_row_key ON suppliers(sheet_row_key) WHERE sheet_row_key IS NOT NULL;
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_movement_key ON inventory_movements(movement_key) WHERE movement_key IS NOT NULL;
-        CREATE INDEX IF NOT EXISTS idx_inventory_sheet_row ON inventory_movements(sheet_name, sheet_row_key);
         CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_single_reversal
             ON inventory_movements(reversal_of_movement_key)
             WHERE reversal_of_movement_key IS NOT NULL;
@@ -598,13 +1014,379 @@ def _initialize_schema(conn: SqlExecutor) -> None:
         CREATE INDEX IF NOT EXISTS idx_suppliers_lifecycle ON suppliers(lifecycle_status);
         CREATE INDEX IF NOT EXISTS idx_recipes_lifecycle ON recipes(lifecycle_status);
         CREATE INDEX IF NOT EXISTS idx_production_orders_status ON production_orders(status);
-        CREATE INDEX IF NOT EXISTS idx_sheet_rows_updated_at ON sheet_rows(sheet_name, updated_at);
-        CREATE INDEX IF NOT EXISTS idx_sheet_rows_hash ON sheet_rows(sheet_name, row_hash);
-        CREATE INDEX IF NOT EXISTS idx_sync_conflicts_status ON sync_conflicts(status, detected_at);
-        CREATE INDEX IF NOT EXISTS idx_sync_outbox_pending ON sync_outbox(status, sheet_name, created_at);
         """
     )
 
+
+def _migrate_v9_worker_locks(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS sync_worker_locks (
+            lock_name TEXT PRIMARY KEY,
+            owner_id TEXT NOT NULL,
+            acquired_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        );
+        """
+    )
+
+
+def _migrate_v10_powder_stock_balances(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS powder_stock_balances (
+            colorpowder_id TEXT PRIMARY KEY,
+            initial_quantity_g REAL NOT NULL DEFAULT 0,
+            initial_date TEXT,
+            purchased_g REAL NOT NULL DEFAULT 0,
+            consumed_g REAL NOT NULL DEFAULT 0,
+            balance_g REAL NOT NULL DEFAULT 0,
+            as_of_date TEXT NOT NULL,
+            pending_from TEXT,
+            updated_at TEXT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_powder_stock_balances_pending
+            ON powder_stock_balances(pending_from) WHERE pending_from IS NOT NULL;
+        """
+    )
+    # Balances are derived data; the first read after the upgrade rebuilds them.
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, status) VALUES ('powder_stock_balances', 'rebuild_required')
+           ON CONFLICT(sync_name) DO UPDATE SET status='rebuild_required'"""
+    )
+
+
+def _migrate_v11_order_powder_consumption(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS order_powder_consumption (
+            production_order_id TEXT NOT NULL,
+            colorpowder_id TEXT NOT NULL,
+            grams REAL NOT NULL,
+            production_date TEXT,
+            PRIMARY KEY (production_order_id, colorpowder_id),
+            FOREIGN KEY (production_order_id) REFERENCES production_orders(production_order_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_order_powder_consumption_powder_date
+            ON order_powder_consumption(colorpowder_id, production_date);
+        CREATE INDEX IF NOT EXISTS idx_order_powder_consumption_date
+            ON order_powder_consumption(production_date, colorpowder_id, grams);
+        """
+    )
+    # Historic orders are backfilled, and balances rebuilt, on the first stock read.
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, status) VALUES ('order_powder_consumption', 'backfill_required')
+           ON CONFLICT(sync_name) DO UPDATE SET status='backfill_required'"""
+    )
+
+
+def _migrate_v12_recipe_usage_vectors(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS recipe_usage_vectors (
+            recipe_id TEXT NOT NULL,
+            colorpowder_id TEXT NOT NULL,
+            grams_per_kg REAL NOT NULL,
+            PRIMARY KEY (recipe_id, colorpowder_id),
+            FOREIGN KEY (recipe_id) REFERENCES recipes(recipe_id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_recipe_usage_vectors_powder
+            ON recipe_usage_vectors(colorpowder_id, recipe_id, grams_per_kg);
+        """
+    )
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, status) VALUES ('recipe_usage_vectors', 'rebuild_required')
+           ON CONFLICT(sync_name) DO UPDATE SET status='rebuild_required'"""
+    )
+
+
+def _search_index_statements(index: str, table: str, columns: tuple[str, ...]) -> list[str]:
+    """FTS5 external-content index over ``table`` plus the triggers that keep it current."""
+    indexed = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+    delete_old = f"INSERT INTO {index}({index}, rowid, {indexed}) VALUES ('delete', old.rowid, {old_values});"
+    insert_new = f"INSERT INTO {index}(rowid, {indexed}) VALUES (new.rowid, {new_values});"
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5(
+                {indexed}, content='{table}', content_rowid='rowid', tokenize='trigram')""",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"""CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {indexed} ON {table}
+            BEGIN {delete_old} {insert_new} END""",
+        f"INSERT INTO {index}({index}) VALUES ('rebuild')",
+    ]
+
+
+def _migrate_v13_search_indexes(conn: SqlExecutor) -> None:
+    # Trigger bodies contain semicolons, so statements run one by one rather
+    # than through _execute_script's split on remote connections.
+    statements = _search_index_statements(
+        "recipe_search", "recipes",
+        ("recipe_id", "color", "customer_id", "customer_name", "pantone_code", "notes"),
+    ) + _search_index_statements(
+        "production_order_search", "production_orders",
+        ("production_order_id", "recipe_id", "customer_name", "color"),
+    )
+    for statement in statements:
+        conn.execute(statement)
+
+
+def _migrate_v14_sequences(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT NOT NULL,
+            period TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (name, period)
+        );
+        """
+    )
+    # Seed per-day production order numbers once from IDs shaped YYYYMMDD-<digits>.
+    conn.execute(
+        """INSERT INTO sequences(name, period, value, updated_at)
+           SELECT 'production_order', substr(production_order_id, 1, 8),
+                  MAX(CAST(substr(production_order_id, 10) AS INTEGER)), ?
+           FROM production_orders
+           WHERE production_order_id GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9]*'
+             AND substr(production_order_id, 10) NOT GLOB '*[^0-9]*'
+           GROUP BY substr(production_order_id, 1, 8)
+           ON CONFLICT(name, period) DO UPDATE SET value=MAX(value, excluded.value)""",
+        (utc_now_iso(),),
+    )
+
+
+def _migrate_v15_updated_at_indexes(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE INDEX IF NOT EXISTS idx_suppliers_updated_at ON suppliers(updated_at);
+        CREATE INDEX IF NOT EXISTS idx_production_orders_updated_at ON production_orders(updated_at);
+        """
+    )
+
+
+def _migrate_v16_outbox_archive(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS sync_outbox_archive (
+            id INTEGER PRIMARY KEY,
+            sheet_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            payload_json TEXT,
+            entity_version INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempt_count INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            processed_at TEXT,
+            archived_at TEXT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_sync_outbox_archive_row
+            ON sync_outbox_archive(sheet_name, row_key, entity_version);
+        CREATE INDEX IF NOT EXISTS idx_sync_outbox_latest_pending
+            ON sync_outbox(sheet_name, row_key, entity_version, status)
+            WHERE status IN ('pending', 'failed', 'processing');
+        """
+    )
+
+
+def _migrate_v17_data_versions(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    # Trigger bodies contain semicolons, so statements run one by one.
+    for table in ("recipes", "recipe_components", "color_powders", "inventory_movements", "production_orders"):
+        conn.execute("INSERT OR IGNORE INTO data_versions(table_name, version) VALUES (?, 0)", (table,))
+        bump = f"UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';"
+        for suffix, event in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS data_versions_{table}_{suffix} "
+                f"AFTER {event} ON {table} BEGIN {bump} END"
+            )
+
+
+def _migrate_v18_write_behind_journal(conn: SqlExecutor) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS write_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id TEXT NOT NULL,
+            sql TEXT NOT NULL,
+            params_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempt_count INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_write_journal_status ON write_journal(status, id);
+
+        CREATE TABLE IF NOT EXISTS write_journal_applied (
+            idempotency_key TEXT PRIMARY KEY,
+            applied_at TEXT NOT NULL
+        );
+        """
+    )
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[SqlExecutor], None]
+
+
+def _migrate_v19_change_cursors(conn: SqlExecutor) -> None:
+    for table in CHANGE_CURSOR_TABLES:
+        _add_column_if_missing(conn, table, "change_seq", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_change_seq ON {table}(change_seq)")
+        conn.execute("INSERT OR IGNORE INTO data_versions(table_name, version) VALUES (?, 0)", (table,))
+        bump = f"UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';"
+        stamp = (
+            f"UPDATE {table} SET change_seq = (SELECT version FROM data_versions WHERE table_name = '{table}') "
+            "WHERE rowid = NEW.rowid;"
+        )
+        conn.execute(f"DROP TRIGGER IF EXISTS data_versions_{table}_ai")
+        conn.execute(f"DROP TRIGGER IF EXISTS data_versions_{table}_au")
+        conn.execute(f"CREATE TRIGGER data_versions_{table}_ai AFTER INSERT ON {table} BEGIN {bump} {stamp} END")
+        # The stamp itself is an UPDATE; it changes change_seq, so the guard skips it.
+        conn.execute(
+            f"CREATE TRIGGER data_versions_{table}_au AFTER UPDATE ON {table} "
+            f"WHEN NEW.change_seq IS OLD.change_seq BEGIN {bump} {stamp} END"
+        )
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS data_versions_{table}_ad AFTER DELETE ON {table} BEGIN {bump} END"
+        )
+
+
+def _migrate_v20_consumption_versions(conn: SqlExecutor) -> None:
+    # Backfills and rebuilds rewrite the ledger without touching orders or recipes.
+    conn.execute("INSERT OR IGNORE INTO data_versions(table_name, version) VALUES ('order_powder_consumption', 0)")
+    bump = "UPDATE data_versions SET version = version + 1 WHERE table_name = 'order_powder_consumption';"
+    for suffix, event in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS data_versions_order_powder_consumption_{suffix} "
+            f"AFTER {event} ON order_powder_consumption BEGIN {bump} END"
+        )
+
+
+def _migrate_v21_usage_bases(conn: SqlExecutor) -> None:
+    # The 生產單 balance and the 用量排行榜 count an order's powders differently
+    # from the 庫存區; each rule gets its own column, filled by the backfill.
+    _add_column_if_missing(conn, "order_powder_consumption", "balance_grams", "REAL NOT NULL DEFAULT 0")
+    _add_column_if_missing(conn, "order_powder_consumption", "ranking_grams", "REAL NOT NULL DEFAULT 0")
+    _add_column_if_missing(conn, "recipe_usage_vectors", "balance_grams_per_kg", "REAL NOT NULL DEFAULT 0")
+    _add_column_if_missing(conn, "recipe_usage_vectors", "ranking_grams_per_kg", "REAL NOT NULL DEFAULT 0")
+    conn.execute("DROP INDEX IF EXISTS idx_order_powder_consumption_date")
+    conn.execute(
+        """CREATE INDEX idx_order_powder_consumption_date
+           ON order_powder_consumption(production_date, colorpowder_id, grams, balance_grams, ranking_grams)"""
+    )
+    for state_name, status in (
+        ("recipe_usage_vectors", "rebuild_required"), ("order_powder_consumption", "backfill_required"),
+    ):
+        conn.execute(
+            """INSERT INTO sync_state(sync_name, status) VALUES (?, ?)
+               ON CONFLICT(sync_name) DO UPDATE SET status=excluded.status""",
+            (state_name, status),
+        )
+
+
+def _migrate_v22_record_days(conn: SqlExecutor) -> None:
+    # Sheet dates such as 2026/9/1 do not compare as text; date filters use
+    # the parsed ISO day, written on save and filled once by the backfill.
+    _add_column_if_missing(conn, "production_orders", "production_day", "TEXT")
+    _add_column_if_missing(conn, "inventory_movements", "movement_day", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_production_orders_day ON production_orders(production_day)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_movements_day ON inventory_movements(movement_day)")
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, status) VALUES ('record_days', 'backfill_required')
+           ON CONFLICT(sync_name) DO UPDATE SET status=excluded.status"""
+    )
+
+
+# Ordered schema history. Every step is idempotent so databases created by
+# releases that recorded only some versions converge safely; new schema work
+# must be appended here with the next version instead of editing old steps.
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(1, "core master data, inventory and sync tables", _migrate_v1_core_tables),
+    Migration(2, "permanent Sheet row identities", _migrate_v2_sheet_row_identity),
+    Migration(3, "inventory supplier columns and supplier aliases", _migrate_v3_inventory_suppliers),
+    Migration(4, "recipes and recipe components", _migrate_v4_recipes),
+    Migration(5, "Sheet sync outbox", _migrate_v5_sync_outbox),
+    Migration(6, "recipe oem_multiplier backfill", _migrate_v6_recipe_oem_multiplier),
+    Migration(7, "production orders and packages backfill", _migrate_v7_production_orders),
+    Migration(8, "lifecycle, reversal and cancellation columns", _migrate_v8_lifecycle),
+    Migration(9, "sync worker locks", _migrate_v9_worker_locks),
+    Migration(10, "materialized powder stock balances", _migrate_v10_powder_stock_balances),
+    Migration(11, "order powder consumption ledger", _migrate_v11_order_powder_consumption),
+    Migration(12, "recipe usage vectors", _migrate_v12_recipe_usage_vectors),
+    Migration(13, "recipe and production order search indexes", _migrate_v13_search_indexes),
+    Migration(14, "atomic numbering sequences", _migrate_v14_sequences),
+    Migration(15, "updated_at indexes for change feeds", _migrate_v15_updated_at_indexes),
+    Migration(16, "outbox archive and latest-pending index", _migrate_v16_outbox_archive),
+    Migration(17, "table data version counters", _migrate_v17_data_versions),
+    Migration(18, "write-behind journal", _migrate_v18_write_behind_journal),
+    Migration(19, "trigger-stamped change cursors", _migrate_v19_change_cursors),
+    Migration(20, "order powder consumption data version", _migrate_v20_consumption_versions),
+    Migration(21, "per-page powder usage columns", _migrate_v21_usage_bases),
+    Migration(22, "normalized ISO day columns", _migrate_v22_record_days),
+)
+
+
+def _applied_migration_versions(conn: SqlExecutor) -> set[int]:
+    try:
+        rows = _fetchall(conn.execute("SELECT version FROM schema_migrations"))
+    except Exception:
+        # A brand-new or pre-migration database has no schema_migrations table.
+        return set()
+    return {int(row[0]) for row in rows}
+
+
+def pending_migrations(conn: SqlExecutor) -> list[Migration]:
+    """Return migrations not yet recorded, using one schema_migrations read."""
+    applied = _applied_migration_versions(conn)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def _initialize_schema(conn: SqlExecutor) -> list[int]:
+    """Apply pending migrations in version order; a current schema costs one read."""
+    applied_versions = []
+    for migration in pending_migrations(conn):
+        migration.apply(conn)
+        conn.execute(
+            "INSERT OR IGNORE INTO schema_migrations(version, applied_at) VALUES (?, ?)",
+            (migration.version, utc_now_iso()),
+        )
+        applied_versions.append(migration.version)
+    if applied_versions:
+        LOGGER.info("Applied schema migrations: %s", applied_versions)
+    return applied_versions
+
+
 def initialize_database(db_path: str | Path | None = None) -> Path:
     """Create/validate the local SQLite database, schema, and indexes automatically."""
     path = get_db_path(db_path)
@@ -623,51 +1405,43 @@ def _connect_turso(config: DatabaseConfig):
 
 def initialize_database_from_config(config: DatabaseConfig) -> str | Path:
     """Initialize configured backend; full Turso credentials never fall back to SQLite."""
+    if config.write_behind_path is not None:
+        initialized = initialize_database_from_config(replace(config, write_behind_path=None))
+        initialize_write_behind_journal(config)
+        return initialized
     if config.backend == "sqlite":
         return initialize_database(config.path)
     if config.backend != "turso":
         raise DatabaseStartupError(f"Unsupported database backend: {config.backend}")
-    client = _connect_turso(config)
     try:
-        _initialize_schema(client)
-        if hasattr(client, "commit"):
-            client.commit()
+        with connect_from_config(config) as client:
+            _initialize_schema(client)
+    except DatabaseStartupError:
+        raise
     except Exception as exc:
         raise DatabaseStartupError(f"Could not initialize Turso database schema v{SCHEMA_VERSION}: {exc}") from exc
-    finally:
-        client.close()
     return "turso"
 
 
 def database_health_check(config: DatabaseConfig) -> DatabaseHealth:
     """Run non-destructive startup checks: SELECT 1, schema_migrations, and table presence."""
-    conn_manager = None
-    client = None
-    conn = None
     try:
-        if config.backend == "sqlite":
-            conn_manager = connect(config.path)
-            conn = conn_manager.__enter__()
-        elif config.backend == "turso":
-            client = _connect_turso(config)
-            conn = client
-        else:
-            raise DatabaseStartupError(f"Unsupported database backend: {config.backend}")
-        select_1_ok = bool(conn.execute("SELECT 1").fetchone()[0] == 1)
-        schema_row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
-        schema_version = schema_row[0] if schema_row else None
-        table_rows = conn.execute("SELECT name FROM sqlite_schema WHERE type='table'").fetchall()
-        existing_tables = {row[0] for row in table_rows}
-        missing_required_columns = {}
-        for table_name, required_columns in REQUIRED_TABLE_COLUMNS.items():
-            if table_name not in existing_tables:
-                continue
-            existing_columns = {
-                row[1] for row in conn.execute(f"PRAGMA table_info({table_name})").fetchall()
-            }
-            missing = required_columns - existing_columns
-            if missing:
-                missing_required_columns[table_name] = missing
+        with connect_from_config(config) as conn:
+            select_1_ok = bool(conn.execute("SELECT 1").fetchone()[0] == 1)
+            schema_row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+            schema_version = schema_row[0] if schema_row else None
+            table_rows = conn.execute("SELECT name FROM sqlite_schema WHERE type='table'").fetchall()
+            existing_tables = {row[0] for row in table_rows}
+            missing_required_columns = {}
+            for table_name, required_columns in REQUIRED_TABLE_COLUMNS.items():
+                if table_name not in existing_tables:
+                    continue
+                existing_columns = {
+                    row[1] for row in conn.execute(f"PRAGMA table_info({table_name})").fetchall()
+                }
+                missing = required_columns - existing_columns
+                if missing:
+                    missing_required_columns[table_name] = missing
         return DatabaseHealth(
             config.backend,
             select_1_ok,
@@ -679,21 +1453,100 @@ def database_health_check(config: DatabaseConfig) -> DatabaseHealth:
         raise
     except Exception as exc:
         raise DatabaseStartupError(f"Database health check failed for backend {config.backend}: {exc}") from exc
+
+
+def current_versions(config: DatabaseConfig) -> dict[str, int]:
+    """Return the mutation counter of every versioned table in one small read."""
+    with connect_from_config(config) as conn:
+        rows = conn.execute("SELECT table_name, version FROM data_versions").fetchall()
+    return {str(row[0]): int(row[1]) for row in rows}
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def copy_database_by_pages(conn: SqlExecutor, target: str | Path, *, page_rows: int = BACKUP_PAGE_ROWS) -> Path:
+    """Stream every table of a (remote) database into a new local SQLite file.
+
+    Rows are read in ``rowid`` keyset pages so no single response is large,
+    and every page is read inside one read transaction (``BEGIN`` ...
+    ``COMMIT`` on the stream), so the copy is one point-in-time snapshot even
+    while others write.  Indexes, triggers and FTS5 tables are created after
+    the data is loaded, so triggers do not fire during the copy, and the
+    search indexes are rebuilt.
+    """
+    if page_rows < 1:
+        raise ValueError("page_rows must be at least 1")
+    # A transaction the caller already opened pins the snapshot just as well.
+    own_transaction = not getattr(conn, "in_transaction", False)
+    if own_transaction:
+        conn.execute("BEGIN")
+    objects = [tuple(row) for row in _fetchall(conn.execute(
+        """SELECT type, name, tbl_name, sql FROM sqlite_schema
+           WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"""
+    ))]
+    virtual = {row[1] for row in objects if row[0] == "table" and row[3].upper().startswith("CREATE VIRTUAL")}
+
+    def is_shadow(name: str) -> bool:
+        return any(name.startswith(f"{table}_") for table in virtual)
+
+    tables = [row for row in objects if row[0] == "table" and row[1] not in virtual and not is_shadow(row[1])]
+    deferred = [row for row in objects if row not in tables and not is_shadow(row[2])]
+    target = Path(target)
+    local = sqlite3.connect(target)
+    try:
+        for _, name, _, create_sql in tables:
+            local.execute(create_sql)
+            columns = [_quote_identifier(row[1]) for row in _fetchall(conn.execute(f"PRAGMA table_info({_quote_identifier(name)})"))]
+            select = f"SELECT rowid, {', '.join(columns)} FROM {_quote_identifier(name)}"
+            insert = (
+                f"INSERT INTO {_quote_identifier(name)}(rowid, {', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * (len(columns) + 1))})"
+            )
+            rows = _fetchall(conn.execute(f"{select} ORDER BY rowid LIMIT ?", (page_rows,)))
+            while rows:
+                local.executemany(insert, [tuple(row) for row in rows])
+                if len(rows) < page_rows:
+                    break
+                rows = _fetchall(conn.execute(
+                    f"{select} WHERE rowid > ? ORDER BY rowid LIMIT ?", (rows[-1][0], page_rows)
+                ))
+        if own_transaction:
+            conn.execute("COMMIT")
+        for _, name, _, create_sql in deferred:
+            local.execute(create_sql)
+            if name in virtual and "FTS5" in create_sql.upper():
+                local.execute(f"INSERT INTO {_quote_identifier(name)}({_quote_identifier(name)}) VALUES ('rebuild')")
+        local.commit()
+    finally:
+        local.close()
+    return target
+
+
+def snapshot_sqlite(source: str | Path, target: str | Path, *, pages: int = BACKUP_PAGES_PER_STEP) -> Path:
+    """Copy a live SQLite database through the online backup API, ``pages`` at a time.
+
+    Unlike a file copy this yields a consistent image, including commits still
+    in the WAL, and writers may proceed between steps.
+    """
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    source_conn = sqlite3.connect(source)
+    target_conn = sqlite3.connect(target)
+    try:
+        source_conn.backup(target_conn, pages=pages, sleep=BACKUP_STEP_SLEEP_SECONDS)
     finally:
-        if conn_manager is not None and conn is not None:
-            conn_manager.__exit__(None, None, None)
-        if client is not None:
-            client.close()
+        target_conn.close()
+        source_conn.close()
+    return target
 
 
 def backup_database(db_path: str | Path | None = None, backup_dir: str | Path = "data/backups") -> Path:
-    """Create a timestamped SQLite file backup without modifying Google Sheets."""
+    """Create a timestamped, consistent SQLite backup without modifying Google Sheets."""
     source = initialize_database(db_path)
-    target_dir = Path(backup_dir)
-    target_dir.mkdir(parents=True, exist_ok=True)
-    target = target_dir / f"colorpowder-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.db"
-    shutil.copy2(source, target)
-    return target
+    target = Path(backup_dir) / f"colorpowder-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.db"
+    return snapshot_sqlite(source, target)
 
 
 def record_sync_log(conn: sqlite3.Connection, *, sync_name: str, direction: str, status: str,
@@ -720,19 +1573,36 @@ def record_sync_conflict(conn: sqlite3.Connection, *, entity_type: str, entity_i
     )
 
 
-def enqueue_sheet_sync(
-    conn: sqlite3.Connection,
+def next_sequence(conn: SqlExecutor, name: str, period: str, *, floor: int = 0) -> int:
+    """Atomically allocate the next number of ``name`` within ``period``.
+
+    ``floor`` is the highest number already taken outside the sequence (for
+    example rows imported from the Sheet); the result is always above it.
+    The upsert takes the write lock before the value is read back, and it has
+    no ``RETURNING`` so the write-behind journal can replay it by natural key.
+    """
+    conn.execute(
+        """INSERT INTO sequences(name, period, value, updated_at) VALUES (?, ?, ?, ?)
+           ON CONFLICT(name, period) DO UPDATE SET
+               value=MAX(sequences.value, excluded.value - 1) + 1, updated_at=excluded.updated_at""",
+        (name, period, int(floor) + 1, utc_now_iso()),
+    )
+    row = conn.execute("SELECT value FROM sequences WHERE name=? AND period=?", (name, period)).fetchone()
+    return int(row[0])
+
+
+def sheet_sync_statement(
     *,
     sheet_name: str,
     row_key: str,
     operation: str,
     payload: dict[str, Any] | None,
     entity_version: int,
-) -> None:
-    """Durably queue one entity version for delivery to Google Sheets."""
+) -> Statement:
+    """The outbox insert for one entity version, for callers that batch their writes."""
     if operation not in {"insert", "update", "delete"}:
         raise ValueError(f"Unsupported sync operation: {operation}")
-    conn.execute(
+    return (
         """INSERT INTO sync_outbox(
                sheet_name, row_key, operation, payload_json, entity_version, created_at
            ) VALUES (?, ?, ?, ?, ?, ?)
@@ -748,6 +1618,22 @@ def enqueue_sheet_sync(
     )
 
 
+def enqueue_sheet_sync(
+    conn: sqlite3.Connection,
+    *,
+    sheet_name: str,
+    row_key: str,
+    operation: str,
+    payload: dict[str, Any] | None,
+    entity_version: int,
+) -> None:
+    """Durably queue one entity version for delivery to Google Sheets."""
+    conn.execute(*sheet_sync_statement(
+        sheet_name=sheet_name, row_key=row_key, operation=operation,
+        payload=payload, entity_version=entity_version,
+    ))
+
+
 def upsert_sheet_row(conn: sqlite3.Connection, sheet_name: str, row_key: str, payload: dict[str, Any],
                      row_hash: str, sheet_updated_at: str | None = None) -> None:
     observed_at = utc_now_iso()
@@ -768,3 +1654,464 @@ def upsert_sheet_row(conn: sqlite3.Connection, sheet_name: str, row_key: str, pa
         (sheet_name, row_key, json.dumps(payload, ensure_ascii=False), row_hash,
          observed_at, sheet_updated_at or observed_at, sheet_updated_at, observed_at, observed_at),
     )
+
+
+# ---------------------------------------------------------------------------
+# Write-behind journal
+# ---------------------------------------------------------------------------
+
+WRITE_BEHIND_BATCH_TRANSACTIONS = 50
+WRITE_BEHIND_INTERVAL_SECONDS = 2.0
+WRITE_BEHIND_MAX_BACKOFF_SECONDS = 60.0
+_UNJOURNALED_SQL = re.compile(
+    r"^\s*(SELECT|PRAGMA|EXPLAIN|VALUES|BEGIN|COMMIT|END|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE
+)
+_CTE_WRITE = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+# Statements whose effect depends on values the local replica assigned (a
+# rowid or INTEGER PRIMARY KEY, a RETURNING result) would hit other rows on
+# replay.  ``id`` is refused on every table; the target table's own rowid
+# alias (e.g. ``movement_id``) is looked up from its schema.
+_REPLAY_UNSAFE_SQL = re.compile(r"\bRETURNING\b", re.IGNORECASE)
+_ROWID_NAMES = ("rowid", "oid", "_rowid_", "id")
+_LOCAL_KEY_COMPARISON = r"\b(?:WHERE|AND|OR|ON)\s+\(?\s*(?:\w+\.)?(?:{columns})\s*(?:=|IN\b)"
+_WRITE_TARGET = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)",
+    re.IGNORECASE,
+)
+WRITE_BEHIND_PULL_STATE = "write_behind_pull:{counter}"
+# Materialized aggregates over rows other writers change too: replaying the
+# replica's values would overwrite the remote's.  Writes to these tables stay
+# local; the journal records the keys and replay runs the hook the owning
+# repository registered on the remote (``register_replay_hook``).
+_REPLAY_HOOKS: dict[str, Callable[[SqlExecutor, list[str]], None]] = {}
+_RECOMPUTE_SQL = "-- recompute {table}"
+_RECOMPUTE_PATTERN = re.compile(r"^-- recompute (\w+)$")
+# What the replica pulls back when a remote data_versions counter moves.
+# Cursor tables pull only the rows past the counter value last pulled; the
+# rest, including the derived tables the replayed writes maintain on the
+# remote, are re-read whole.
+WRITE_BEHIND_PULL_TABLES: dict[str, tuple[str, ...]] = {
+    "color_powders": ("color_powders",),
+    "suppliers": ("suppliers",),
+    "recipes": ("recipes", "recipe_usage_vectors"),
+    "recipe_components": ("recipe_components", "recipe_usage_vectors"),
+    "inventory_movements": ("inventory_movements", "powder_stock_balances"),
+    "production_orders": ("production_orders", "production_order_packages", "powder_stock_balances", "sequences"),
+    "order_powder_consumption": ("order_powder_consumption", "powder_stock_balances"),
+}
+# Tables keyed on a local rowid alias: pulls match their rows on the natural
+# key and leave each side's rowid alone.
+_PULL_NATURAL_KEYS: dict[str, tuple[str, ...]] = {"inventory_movements": ("movement_key",)}
+# Parents before children, so pulled rows satisfy the foreign keys.
+_PULL_ORDER = (
+    "color_powders", "suppliers", "recipes", "recipe_components", "recipe_usage_vectors",
+    "inventory_movements", "production_orders", "production_order_packages",
+    "order_powder_consumption", "powder_stock_balances", "sequences",
+)
+
+
+def write_behind_journal_config(config: DatabaseConfig) -> DatabaseConfig:
+    """Plain SQLite config for the local journal replica of a write-behind config."""
+    return DatabaseConfig(backend="sqlite", path=config.write_behind_path)
+
+
+def write_behind_remote_config(config: DatabaseConfig) -> DatabaseConfig:
+    """The backend the journal flushes to, opened without write-behind."""
+    return replace(config, write_behind_path=None)
+
+
+def register_replay_hook(table: str, hook: Callable[[SqlExecutor, list[str]], None]) -> None:
+    """Recompute ``table`` rows with ``hook(remote_conn, keys)`` on replay instead of journaling them."""
+    _REPLAY_HOOKS[table] = hook
+
+
+def _is_journaled(sql: str) -> bool:
+    if _UNJOURNALED_SQL.match(sql):
+        return False
+    if sql.lstrip()[:4].upper() == "WITH":
+        return bool(_CTE_WRITE.search(sql))
+    return True
+
+
+class JournalConnection:
+    """Local SQLite connection that journals every write for replay on the remote.
+
+    The data is written to the local replica (so the caller reads its own
+    writes at once) and each statement is appended to ``write_journal`` in the
+    same local transaction, tagged with a per-transaction idempotency key.
+    Writes keyed on a rowid or INTEGER PRIMARY KEY or using ``RETURNING`` are
+    refused; such paths (the Sheet outbox, worker locks) run on the remote
+    directly.  Writes to tables with a replay hook are applied locally only,
+    and ``recompute_on_replay`` journals the keys to recompute instead.
+    """
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self._conn = conn
+        self._txn_id: str | None = None
+        self._rowid_aliases: dict[str, str | None] = {}
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._conn.in_transaction
+
+    def _record(self, sql: str, params: list[tuple[Any, ...]]) -> None:
+        if self._txn_id is None:
+            self._txn_id = uuid.uuid4().hex
+        self._conn.execute(
+            "INSERT INTO write_journal(txn_id, sql, params_json, created_at) VALUES (?, ?, ?, ?)",
+            (self._txn_id, sql, json.dumps(params, ensure_ascii=False), utc_now_iso()),
+        )
+
+    def _rowid_alias(self, table: str) -> str | None:
+        if table not in self._rowid_aliases:
+            keys = [row for row in self._conn.execute(f"PRAGMA table_info({table})").fetchall() if row[5]]
+            self._rowid_aliases[table] = (
+                keys[0][1] if len(keys) == 1 and str(keys[0][2]).upper() == "INTEGER" else None
+            )
+        return self._rowid_aliases[table]
+
+    def _check_replayable(self, sql: str) -> bool:
+        if not _is_journaled(sql):
+            return False
+        target = _WRITE_TARGET.match(sql)
+        if target and target.group(1).lower() in _REPLAY_HOOKS:
+            return False
+        alias = self._rowid_alias(target.group(1)) if target else None
+        columns = "|".join(_ROWID_NAMES + ((re.escape(alias),) if alias else ()))
+        if _REPLAY_UNSAFE_SQL.search(sql) or re.search(
+            _LOCAL_KEY_COMPARISON.format(columns=columns), sql, re.IGNORECASE
+        ):
+            raise ValueError(
+                "Write-behind cannot replay a write keyed on local ids or using RETURNING; "
+                "run it on write_behind_remote_config(config)"
+            )
+        return True
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ()) -> Any:
+        journaled = self._check_replayable(sql)
+        cursor = self._conn.execute(sql, parameters)
+        if journaled:
+            self._record(sql, [tuple(parameters)])
+        return cursor
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence[Any]]) -> Any:
+        journaled = self._check_replayable(sql)
+        params = [tuple(row) for row in seq_of_parameters]
+        cursor = self._conn.executemany(sql, params)
+        if params and journaled:
+            self._record(sql, params)
+        return cursor
+
+    def recompute_on_replay(self, table: str, keys: Iterable[str]) -> None:
+        """Have the replay of this transaction run ``table``'s hook for ``keys`` on the remote."""
+        keys = sorted({str(key) for key in keys})
+        if keys:
+            self._record(_RECOMPUTE_SQL.format(table=table), [(key,) for key in keys])
+
+    def commit(self) -> None:
+        self._conn.commit()
+        self._txn_id = None
+
+    def rollback(self) -> None:
+        self._conn.rollback()
+        self._txn_id = None
+
+
+def initialize_write_behind_journal(config: DatabaseConfig) -> Path:
+    """Create the journal replica, seeding a new file from the remote backend."""
+    path = get_db_path(config.write_behind_path)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        seed = path.with_name(path.name + ".seed")
+        seed.unlink(missing_ok=True)
+        with connect_from_config(write_behind_remote_config(config)) as remote:
+            copy_database_by_pages(remote, seed)
+        with connect(seed) as seeded:
+            # The copied counters are the remote's at the snapshot: pulls start there.
+            _mark_pulled(seeded, {
+                str(row[0]): int(row[1]) for row in seeded.execute("SELECT table_name, version FROM data_versions")
+            })
+        seed.replace(path)
+    return initialize_database(path)
+
+
+def _mark_pulled(conn: SqlExecutor, versions: dict[str, int]) -> None:
+    now = utc_now_iso()
+    execute_batch(conn, [(
+        """INSERT INTO sync_state(sync_name, last_success_at, last_attempt_at, status, high_watermark)
+           VALUES (?, ?, ?, 'ok', ?)
+           ON CONFLICT(sync_name) DO UPDATE SET
+               last_success_at=excluded.last_success_at, last_attempt_at=excluded.last_attempt_at,
+               status='ok', high_watermark=excluded.high_watermark""",
+        (WRITE_BEHIND_PULL_STATE.format(counter=counter), now, now, str(version)),
+    ) for counter, version in versions.items() if counter in WRITE_BEHIND_PULL_TABLES])
+
+
+def _mark_resync_required(conn: SqlExecutor, statements: Sequence[Statement]) -> None:
+    """Have the next pull re-read every table a parked transaction wrote, undoing it locally."""
+    targets = [_WRITE_TARGET.match(sql) for sql, _ in statements]
+    if all(targets):
+        written = {match.group(1).lower() for match in targets}
+        counters = [counter for counter, tables in WRITE_BEHIND_PULL_TABLES.items() if written & set(tables)]
+    else:
+        counters = list(WRITE_BEHIND_PULL_TABLES)
+    execute_batch(conn, [(
+        """INSERT INTO sync_state(sync_name, status) VALUES (?, 'resync_required')
+           ON CONFLICT(sync_name) DO UPDATE SET status='resync_required'""",
+        (WRITE_BEHIND_PULL_STATE.format(counter=counter),),
+    ) for counter in counters])
+
+
+def _pull_columns(table: str, table_info: list[tuple[Any, ...]]) -> tuple[list[str], list[str]]:
+    """The (match key, pulled columns) of a pulled table; ``change_seq`` stays local."""
+    primary = [row[1] for row in sorted(table_info, key=lambda info: info[5]) if row[5]]
+    natural = _PULL_NATURAL_KEYS.get(table)
+    skipped = {"change_seq", *(primary if natural else ())}
+    return list(natural or primary), [row[1] for row in table_info if row[1] not in skipped]
+
+
+def _pending_journal_transactions(conn: SqlExecutor) -> int:
+    return int(conn.execute(
+        "SELECT COUNT(DISTINCT txn_id) FROM write_journal WHERE status='pending'"
+    ).fetchone()[0])
+
+
+def refresh_write_behind_replica(config: DatabaseConfig) -> int:
+    """Pull what others wrote to the remote into the journal replica; returns rows pulled.
+
+    Only runs while nothing is pending in the journal, so it never overwrites
+    a local write the remote has not seen.  Every counter that moved since the
+    last pull re-reads its ``WRITE_BEHIND_PULL_TABLES``; a counter marked by a
+    conflict re-reads them whole, which also drops the parked transaction's
+    local rows.  Rows are upserted by primary key (by natural key where the
+    primary key is a local rowid), so the local triggers bump the replica's
+    own counters and change cursors.
+    """
+    journal_config = write_behind_journal_config(config)
+    with connect_from_config(journal_config) as journal:
+        if _pending_journal_transactions(journal):
+            return 0
+        pulled = {
+            str(row[0]).split(":", 1)[1]: (row[1], row[2])
+            for row in journal.execute(
+                "SELECT sync_name, status, high_watermark FROM sync_state WHERE sync_name LIKE 'write_behind_pull:%'"
+            ).fetchall()
+        }
+        table_info = {
+            table: [tuple(row) for row in journal.execute(f"PRAGMA table_info({table})").fetchall()]
+            for table in _PULL_ORDER
+        }
+
+    moved: dict[str, int] = {}
+    full: set[str] = set()
+    fetched: dict[str, list[tuple[Any, ...]]] = {}
+    with connect_from_config(write_behind_remote_config(config)) as remote:
+        own_transaction = not getattr(remote, "in_transaction", False)
+        if own_transaction:
+            remote.execute("BEGIN")
+        versions = {
+            str(row[0]): int(row[1]) for row in _fetchall(remote.execute("SELECT table_name, version FROM data_versions"))
+        }
+        for counter, tables in WRITE_BEHIND_PULL_TABLES.items():
+            status, watermark = pulled.get(counter, (None, None))
+            if counter not in versions or (status == "ok" and watermark == str(versions[counter])):
+                continue
+            moved[counter] = versions[counter]
+            full.update(table for table in tables if status != "ok" or table not in CHANGE_CURSOR_TABLES)
+        for table in _PULL_ORDER:
+            if table in full:
+                where, params, order = "", (), "rowid"
+            elif table in moved:
+                where, params, order = " WHERE change_seq>?", (int(pulled[table][1]),), "change_seq"
+            else:
+                continue
+            columns = ", ".join(_pull_columns(table, table_info[table])[1])
+            fetched[table] = [tuple(row) for row in _fetchall(remote.execute(
+                f"SELECT {columns} FROM {table}{where} ORDER BY {order}", params
+            ))]
+        if own_transaction:
+            remote.execute("COMMIT")
+    if not moved:
+        return 0
+
+    with connect_from_config(journal_config) as journal:
+        journal.execute("BEGIN IMMEDIATE")
+        if _pending_journal_transactions(journal):
+            return 0  # a local write landed meanwhile; pull again after it is flushed
+        for table in reversed(_PULL_ORDER):
+            if table not in full:
+                continue
+            keys, columns = _pull_columns(table, table_info[table])
+            positions = [columns.index(key) for key in keys]
+            remote_keys = {tuple(row[position] for position in positions) for row in fetched[table]}
+            local_keys = {tuple(row) for row in journal.execute(f"SELECT {', '.join(keys)} FROM {table}")}
+            journal.executemany(
+                f"DELETE FROM {table} WHERE {' AND '.join(f'{key}=?' for key in keys)}",
+                sorted(local_keys - remote_keys),
+            )
+        for table in _PULL_ORDER:
+            if not fetched.get(table):
+                continue
+            keys, columns = _pull_columns(table, table_info[table])
+            values = [column for column in columns if column not in keys]
+            update = (
+                f"DO UPDATE SET {', '.join(f'{column}=excluded.{column}' for column in values)} "
+                f"WHERE ({', '.join(f'{table}.{column}' for column in values)}) "
+                f"IS NOT ({', '.join(f'excluded.{column}' for column in values)})"
+                if values else "DO NOTHING"
+            )
+            journal.executemany(
+                f"INSERT INTO {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT({', '.join(keys)}) {update}",
+                fetched[table],
+            )
+        _mark_pulled(journal, moved)
+    return sum(len(rows) for rows in fetched.values())
+
+
+@dataclass
+class WriteBehindFlushResult:
+    flushed: int = 0
+    already_applied: int = 0
+    conflicts: list[str] = field(default_factory=list)
+    error: str | None = None
+    pending: int = 0
+    pulled: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.conflicts
+
+
+def _is_conflict(exc: Exception) -> bool:
+    return isinstance(exc, sqlite3.IntegrityError) or "constraint" in str(exc).lower()
+
+
+def flush_write_behind(
+    config: DatabaseConfig, *, max_transactions: int = WRITE_BEHIND_BATCH_TRANSACTIONS
+) -> WriteBehindFlushResult:
+    """Replay pending journal transactions on the remote, oldest first.
+
+    Each transaction is applied in one remote transaction together with its
+    idempotency key in ``write_journal_applied``, so a replay after a crash is
+    skipped instead of applied twice.  A constraint failure parks the
+    transaction as ``conflict``, records it in ``sync_conflicts`` and has the
+    next pull re-read the tables it wrote; any other error stops the flush
+    (keeping order) and is retried on the next call.  Once nothing is pending
+    the replica pulls what others wrote (``refresh_write_behind_replica``).
+    Keys journaled by ``recompute_on_replay`` are recomputed on the remote
+    after the transaction's writes, inside the same remote transaction.
+    """
+    if max_transactions < 1:
+        raise ValueError("max_transactions must be at least 1")
+    journal_config = write_behind_journal_config(config)
+    remote_config = write_behind_remote_config(config)
+    result = WriteBehindFlushResult()
+    with connect_from_config(journal_config) as journal:
+        txn_ids = [row[0] for row in journal.execute(
+            """SELECT txn_id FROM write_journal WHERE status='pending'
+               GROUP BY txn_id ORDER BY MIN(id) LIMIT ?""",
+            (max_transactions,),
+        ).fetchall()]
+    for txn_id in txn_ids:
+        with connect_from_config(journal_config) as journal:
+            entries = journal.execute(
+                "SELECT sql, params_json FROM write_journal WHERE txn_id=? ORDER BY id", (txn_id,)
+            ).fetchall()
+        statements = [(row[0], tuple(params)) for row in entries for params in json.loads(row[1])]
+        writes: list[Statement] = []
+        recompute: dict[str, set[str]] = {}
+        for sql, params in statements:
+            match = _RECOMPUTE_PATTERN.match(sql)
+            if match:
+                recompute.setdefault(match.group(1), set()).update(params)
+            else:
+                writes.append((sql, params))
+        try:
+            with connect_from_config(remote_config) as remote:
+                applied = remote.execute(
+                    "SELECT 1 FROM write_journal_applied WHERE idempotency_key=?", (txn_id,)
+                ).fetchone()
+                if applied is None:
+                    mark = (
+                        "INSERT INTO write_journal_applied(idempotency_key, applied_at) VALUES (?, ?)",
+                        (txn_id, utc_now_iso()),
+                    )
+                    execute_batch(remote, writes + ([] if recompute else [mark]))
+                    for table, keys in sorted(recompute.items()):
+                        if table not in _REPLAY_HOOKS:
+                            raise RuntimeError(f"No replay hook registered for {table}")
+                        _REPLAY_HOOKS[table](remote, sorted(keys))
+                    if recompute:
+                        execute_batch(remote, [mark])
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+            with connect_from_config(journal_config) as journal:
+                if _is_conflict(exc):
+                    journal.execute(
+                        "UPDATE write_journal SET status='conflict', last_error=? WHERE txn_id=?", (error, txn_id)
+                    )
+                    record_sync_conflict(
+                        journal, entity_type="write_journal", entity_id=txn_id,
+                        sqlite_payload={"statements": [[sql, list(params)] for sql, params in statements]},
+                        sheet_payload=None, reason=f"write-behind replay failed: {error}",
+                    )
+                    _mark_resync_required(journal, writes)
+                    result.conflicts.append(txn_id)
+                    continue
+                journal.execute(
+                    "UPDATE write_journal SET attempt_count=attempt_count+1, last_error=? WHERE txn_id=?",
+                    (error, txn_id),
+                )
+            result.error = error
+            break
+        with connect_from_config(journal_config) as journal:
+            journal.execute("DELETE FROM write_journal WHERE txn_id=?", (txn_id,))
+        if applied is None:
+            result.flushed += 1
+        else:
+            result.already_applied += 1
+    with connect_from_config(journal_config) as journal:
+        result.pending = _pending_journal_transactions(journal)
+    if result.pending == 0 and result.error is None:
+        try:
+            result.pulled = refresh_write_behind_replica(config)
+        except Exception as exc:
+            result.error = f"{type(exc).__name__}: {exc}"
+    return result
+
+
+class WriteBehindFlusher(threading.Thread):
+    """Daemon thread that keeps flushing the journal, backing off while the remote fails."""
+
+    def __init__(
+        self,
+        config: DatabaseConfig,
+        *,
+        interval_seconds: float = WRITE_BEHIND_INTERVAL_SECONDS,
+        max_backoff_seconds: float = WRITE_BEHIND_MAX_BACKOFF_SECONDS,
+    ) -> None:
+        super().__init__(name="write-behind-flusher", daemon=True)
+        self.config = config
+        self.interval_seconds = interval_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.last_result: WriteBehindFlushResult | None = None
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        delay = self.interval_seconds
+        while not self._stop_event.is_set():
+            try:
+                self.last_result = flush_write_behind(self.config)
+                failed = self.last_result.error is not None
+            except Exception:
+                LOGGER.exception("Write-behind flush failed")
+                failed = True
+            if failed:
+                delay = min(max(delay, self.interval_seconds) * 2, self.max_backoff_seconds)
+            else:
+                delay = 0 if self.last_result.pending else self.interval_seconds
+            self._stop_event.wait(delay)
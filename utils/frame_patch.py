@@ -0,0 +1,38 @@
+"""Apply repository change feeds to cached pandas frames by primary key."""
+
+from __future__ import annotations
+
+import pandas as pd
+
+from .database import ChangeSet
+
+
+def apply_changes(frame: pd.DataFrame | None, key_column: str, changes: ChangeSet) -> pd.DataFrame:
+    """Return ``frame`` patched with ``changes``: rows are replaced by key, new keys appended, tombstones dropped.
+
+    ``frame`` itself is never modified, so a frame other readers share can be
+    patched and swapped in afterwards.  Existing rows keep their position;
+    columns first seen in the delta are added (empty for older rows).
+    """
+    if frame is None or frame.empty or key_column not in frame.columns:
+        return pd.DataFrame(changes.upserted)
+    if not changes.upserted and not changes.tombstoned:
+        return frame
+    delta = pd.DataFrame(changes.upserted)
+    if not delta.empty:
+        frame = frame.copy()
+        delta[key_column] = delta[key_column].astype(str)
+        delta = delta.drop_duplicates(key_column, keep="last").set_index(key_column)
+        for column in delta.columns.difference(frame.columns):
+            frame[column] = ""
+        keys = frame[key_column].astype(str)
+        existing = keys.isin(delta.index)
+        if existing.any():
+            columns = list(delta.columns)
+            frame.loc[existing, columns] = delta.loc[keys[existing], columns].to_numpy()
+        new_rows = delta[~delta.index.isin(keys)]
+        if not new_rows.empty:
+            frame = pd.concat([frame, new_rows.reset_index()], ignore_index=True)
+    if changes.tombstoned:
+        frame = frame[~frame[key_column].astype(str).isin(set(map(str, changes.tombstoned)))].reset_index(drop=True)
+    return frame
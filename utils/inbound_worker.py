@@ -7,7 +7,14 @@ from typing import Any, Iterable
 from uuid import uuid4
 
 from .database import DatabaseConfig, initialize_database_from_config
-from .sheet_import import ImportAbortedError, import_sheet_values, read_worksheet_values_with_retry
+from .sheet_import import (
+    IMPORT_MAX_WORKERS,
+    ImportAbortedError,
+    import_order,
+    import_sheet_values,
+    read_worksheets_values,
+    run_per_sheet,
+)
 from .sync_worker import SYNC_WORKER_LOCK_NAME, acquire_worker_lock, release_worker_lock
 
 
@@ -42,12 +49,15 @@ def run_controlled_inbound_worker(
     sheet_names: Iterable[str] | None = None,
     max_changes: int = 25,
     lock_ttl_seconds: int = 900,
+    max_workers: int = IMPORT_MAX_WORKERS,
 ) -> InboundWorkerResult:
     """Preflight all selected Sheets, then atomically apply each safe snapshot.
 
     Missing Sheet rows are never interpreted as deletes. A write pass uses the
     exact values that passed preflight and stops before writing when any selected
     Sheet has validation errors, duplicate IDs, conflicts, or too many changes.
+    All Sheets are read in one batched request and preflighted concurrently;
+    applies follow ``import_order``.
     """
     if max_changes < 1:
         raise ValueError("max_changes must be at least 1")
@@ -58,24 +68,32 @@ def run_controlled_inbound_worker(
 
     initialize_database_from_config(db_config)
     result = InboundWorkerResult(dry_run=dry_run, max_changes=max_changes)
-    snapshots: list[tuple[str, list[list[Any]]]] = []
+    try:
+        snapshots = read_worksheets_values(spreadsheet, names, max_workers=max_workers)
+    except Exception as exc:
+        result.errors.append(f"{', '.join(names)}: {type(exc).__name__}: {exc}")
+        return result
 
+    futures = run_per_sheet(
+        names,
+        lambda sheet_name: import_sheet_values(
+            sheet_name,
+            snapshots[sheet_name],
+            db_config=db_config,
+            dry_run=True,
+            initialize_schema=False,
+        ),
+        max_workers=max_workers,
+    )
     for sheet_name in names:
         try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-            values = read_worksheet_values_with_retry(worksheet)
-            snapshots.append((sheet_name, values))
-            preflight = import_sheet_values(
-                sheet_name,
-                values,
-                db_config=db_config,
-                dry_run=True,
-                initialize_schema=False,
-            )
-            result.preflight.append(asdict(preflight))
+            preflight = futures[sheet_name].result()
         except Exception as exc:
             result.errors.append(f"{sheet_name}: {type(exc).__name__}: {exc}")
-            return result
+            continue
+        result.preflight.append(asdict(preflight))
+    if result.errors:
+        return result
 
     change_count = sum(
         item["to_insert"] + item["to_update"] for item in result.preflight
@@ -99,11 +117,11 @@ def run_controlled_inbound_worker(
         return result
 
     try:
-        for sheet_name, values in snapshots:
+        for sheet_name in import_order(names):
             try:
                 applied = import_sheet_values(
                     sheet_name,
-                    values,
+                    snapshots[sheet_name],
                     db_config=db_config,
                     dry_run=False,
                     initialize_schema=False,
@@ -2,16 +2,65 @@
 
 from __future__ import annotations
 
+import json
+import math
 import uuid
-from typing import Any
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Iterable
 
-from .database import DatabaseConfig, connect_from_config, enqueue_sheet_sync, utc_now_iso
+from .database import (
+    ChangeSet,
+    DatabaseConfig,
+    connect_from_config,
+    enqueue_sheet_sync,
+    execute_batch,
+    keyset_after,
+    page_limit,
+    sheet_sync_statement,
+    change_watermark,
+    utc_now_iso,
+)
+from .stock_repository import iso_day, refresh_powder_stock_balances
+
+
+# The stored columns each listed field is built from; only the requested ones are read.
+_MOVEMENT_LIST_SOURCES = {
+    "類型": ("movement_type",),
+    "色粉編號": ("colorpowder_id",),
+    "日期": ("movement_date",),
+    "數量": ("quantity",),
+    "單位": ("unit",),
+    "備註": ("notes",),
+    "廠商編號": ("supplier_id",),
+    "廠商名稱": ("supplier_name",),
+    "_sync_id": ("sheet_row_key",),
+    "沖銷原始ID": ("reversal_of_movement_key",),
+    "沖銷記錄ID": ("reversal_sync_id",),
+    "沖銷時間": ("reversed_at",),
+    "沖銷狀態": ("reversal_of_movement_key", "reversed_at"),
+}
+_MOVEMENT_SORT_KEY = ("movement.movement_date IS NOT NULL", "COALESCE(movement.movement_date, '')", "movement.movement_id")
 
 
 class InventoryError(RuntimeError):
     pass
 
 
+@dataclass(frozen=True)
+class InventoryBulkRowResult:
+    """Outcome of one input row of ``create_inventory_movements_bulk``."""
+
+    index: int
+    sync_id: str
+    payload: dict[str, str] | None = None
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 def _mapping(cursor) -> dict[str, Any] | None:
     row = cursor.fetchone()
     if row is None:
@@ -45,16 +94,73 @@ def inventory_sheet_payload(entity: dict[str, Any]) -> dict[str, str]:
     }
 
 
-def list_inventory_movements(config: DatabaseConfig) -> list[dict[str, str]]:
+def list_inventory_movements(
+    config: DatabaseConfig,
+    *,
+    powder_id: str | None = None,
+    movement_type: str | None = None,
+    start: date | str | None = None,
+    end: date | str | None = None,
+    changed_after: int | None = None,
+    columns: Iterable[str] | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+) -> list[dict[str, str]]:
+    """Inventory rows as Sheet payloads, ordered by date then insertion.
+
+    ``start``/``end`` are inclusive days matched on the indexed ISO
+    ``movement_day``; ``after`` is the ``_sync_id`` of the previous page's
+    last row.  Only the stored columns behind ``columns`` are selected, and
+    the reversal join only runs when 沖銷記錄ID is asked for.
+    """
+    selected = list(columns or _MOVEMENT_LIST_SOURCES)
+    unknown = set(selected) - set(_MOVEMENT_LIST_SOURCES)
+    if unknown:
+        raise InventoryError(f"不支援的欄位：{', '.join(sorted(unknown))}")
+    sources = {source for column in selected for source in _MOVEMENT_LIST_SOURCES[column]}
+    clauses = ["movement.sheet_name='庫存記錄'"]
+    params: list[Any] = []
+    if powder_id:
+        clauses.append("movement.colorpowder_id=?")
+        params.append(str(powder_id).strip())
+    if movement_type:
+        clauses.append("movement.movement_type=?")
+        params.append(movement_type)
+    for value, operator in ((start, ">="), (end, "<=")):
+        if value:
+            day = iso_day(value)
+            if day is None:
+                raise InventoryError(f"無法辨識的日期：{value}")
+            clauses.append(f"movement.movement_day {operator} ?")
+            params.append(day)
+    if changed_after is not None:
+        clauses.append("movement.change_seq>?")
+        params.append(changed_after)
+    if after is not None:
+        clauses.append(keyset_after(
+            _MOVEMENT_SORT_KEY,
+            """SELECT movement.movement_date IS NOT NULL, COALESCE(movement.movement_date, ''), movement.movement_id
+               FROM inventory_movements AS movement
+               WHERE movement.sheet_name='庫存記錄' AND movement.sheet_row_key=?""",
+        ))
+        params.append(after)
+    limit_sql, limit_params = page_limit(limit)
+    select = [
+        "reversal.sheet_row_key AS reversal_sync_id" if source == "reversal_sync_id" else f"movement.{source}"
+        for source in sorted(sources)
+    ]
+    join = (
+        """LEFT JOIN inventory_movements AS reversal
+             ON reversal.reversal_of_movement_key = movement.movement_key"""
+        if "reversal_sync_id" in sources else ""
+    )
     with connect_from_config(config) as conn:
         entities = _mappings(conn.execute(
-            """SELECT movement.*,
-                      reversal.sheet_row_key AS reversal_sync_id
-               FROM inventory_movements AS movement
-               LEFT JOIN inventory_movements AS reversal
-                 ON reversal.reversal_of_movement_key = movement.movement_key
-               WHERE movement.sheet_name='庫存記錄'
-               ORDER BY movement.movement_date, movement.movement_id"""
+            f"""SELECT {', '.join(select)}
+                FROM inventory_movements AS movement {join}
+                WHERE {' AND '.join(clauses)}
+                ORDER BY {', '.join(_MOVEMENT_SORT_KEY)} {limit_sql}""",
+            (*params, *limit_params),
         ))
     result = []
     for entity in entities:
@@ -67,17 +173,54 @@ def list_inventory_movements(config: DatabaseConfig) -> list[dict[str, str]]:
                 "已沖銷" if entity.get("reversed_at") else "有效"
             ),
         })
-        result.append(row)
+        result.append({column: row[column] for column in selected})
     return result
 
 
-def _validate_refs(conn, powder_id: str, supplier_id: str) -> None:
+def list_inventory_movements_changed_since(config: DatabaseConfig, watermark: int | None) -> ChangeSet:
+    """Movements written after ``watermark``; reversals are rows, so nothing is tombstoned."""
+    with connect_from_config(config) as conn:
+        next_watermark = change_watermark(conn, "inventory_movements")
+    return ChangeSet(
+        upserted=list_inventory_movements(config, changed_after=watermark),
+        tombstoned=[],
+        watermark=watermark if next_watermark is None else next_watermark,
+    )
+
+
+def _validate_refs(conn, powder_id: str, supplier_id: str, *, new_sync_id: str | None = None) -> None:
+    """Check the powder, the supplier and (for creates) the sync ID in one query."""
     if not powder_id:
         raise InventoryError("請輸入色粉編號")
-    if _mapping(conn.execute("SELECT colorpowder_id FROM color_powders WHERE colorpowder_id=?", (powder_id,))) is None:
+    powder_found, supplier_found, sync_id_taken = conn.execute(
+        """SELECT EXISTS(SELECT 1 FROM color_powders WHERE colorpowder_id=?),
+                  EXISTS(SELECT 1 FROM suppliers WHERE supplier_id=?),
+                  EXISTS(SELECT 1 FROM inventory_movements WHERE sheet_name='庫存記錄' AND sheet_row_key=?)""",
+        (powder_id, supplier_id, new_sync_id),
+    ).fetchone()
+    if not powder_found:
         raise InventoryError(f"找不到色粉編號 {powder_id}")
-    if supplier_id and _mapping(conn.execute("SELECT supplier_id FROM suppliers WHERE supplier_id=?", (supplier_id,))) is None:
+    if supplier_id and not supplier_found:
         raise InventoryError(f"找不到供應商編號 {supplier_id}")
+    if new_sync_id is not None and sync_id_taken:
+        raise InventoryError(f"庫存 _sync_id {new_sync_id} 已存在")
+
+
+def _movement_entity(row: dict[str, Any], sync_id: str, powder_id: str, supplier_id: str) -> dict[str, Any]:
+    """The stored columns of a form row, so the Sheet payload needs no re-read."""
+    movement_date = str(row.get("日期") or "").strip()
+    return {
+        "sheet_row_key": sync_id,
+        "movement_type": str(row.get("類型") or "").strip(),
+        "colorpowder_id": powder_id,
+        "movement_date": movement_date,
+        "movement_day": iso_day(movement_date),
+        "quantity": float(row.get("數量") or 0),
+        "unit": str(row.get("單位") or "g").strip(),
+        "notes": str(row.get("備註") or "").strip(),
+        "supplier_id": supplier_id,
+        "supplier_name": str(row.get("廠商名稱") or "").strip(),
+    }
 
 
 def create_inventory_movement(
@@ -87,42 +230,127 @@ def create_inventory_movement(
     powder_id = str(row.get("色粉編號") or "").strip()
     supplier_id = str(row.get("廠商編號") or "").strip()
     now = utc_now_iso()
+    entity = _movement_entity(row, sync_id, powder_id, supplier_id)
+    payload = inventory_sheet_payload(entity)
     with connect_from_config(config) as conn:
-        _validate_refs(conn, powder_id, supplier_id)
-        if _mapping(conn.execute(
-            "SELECT movement_id FROM inventory_movements WHERE sheet_name='庫存記錄' AND sheet_row_key=?",
-            (sync_id,),
-        )) is not None:
-            raise InventoryError(f"庫存 _sync_id {sync_id} 已存在")
-        conn.execute(
-            """INSERT INTO inventory_movements(
-                   movement_key, sheet_name, sheet_row_key, movement_type, colorpowder_id,
-                   movement_date, quantity, unit, notes, supplier_id, supplier_name,
-                   source, version, created_at, updated_at, last_synced_at)
-               VALUES (?, '庫存記錄', ?, ?, ?, ?, ?, ?, ?, ?, ?, 'app', 1, ?, ?, NULL)""",
-            (
-                f"sheet:庫存記錄:{sync_id}", sync_id, str(row.get("類型") or "").strip(), powder_id,
-                str(row.get("日期") or "").strip(), float(row.get("數量") or 0),
-                str(row.get("單位") or "g").strip(), str(row.get("備註") or "").strip(),
-                supplier_id, str(row.get("廠商名稱") or "").strip(), now, now,
+        _validate_refs(conn, powder_id, supplier_id, new_sync_id=sync_id)
+        execute_batch(conn, [
+            ("""INSERT INTO inventory_movements(
+                    movement_key, sheet_name, sheet_row_key, movement_type, colorpowder_id,
+                    movement_date, movement_day, quantity, unit, notes, supplier_id, supplier_name,
+                    source, version, created_at, updated_at, last_synced_at)
+                VALUES (?, '庫存記錄', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'app', 1, ?, ?, NULL)""",
+             (
+                 f"sheet:庫存記錄:{sync_id}", sync_id, entity["movement_type"], powder_id,
+                 entity["movement_date"], entity["movement_day"], entity["quantity"], entity["unit"], entity["notes"],
+                 supplier_id, entity["supplier_name"], now, now,
+             )),
+            sheet_sync_statement(
+                sheet_name="庫存記錄", row_key=sync_id, operation="insert",
+                payload=payload, entity_version=1,
             ),
-        )
-        entity = _mapping(conn.execute(
-            "SELECT * FROM inventory_movements WHERE sheet_name='庫存記錄' AND sheet_row_key=?", (sync_id,)
-        ))
-        payload = inventory_sheet_payload(entity)
-        enqueue_sheet_sync(
-            conn, sheet_name="庫存記錄", row_key=sync_id, operation="insert",
-            payload=payload, entity_version=1,
-        )
+        ])
+        refresh_powder_stock_balances(conn, {powder_id})
         return payload
 
 
+def create_inventory_movements_bulk(
+    config: DatabaseConfig, rows: Iterable[dict[str, Any]],
+) -> list[InventoryBulkRowResult]:
+    """Create many movements in one transaction and report each row.
+
+    Powder, supplier and existing sync IDs are checked for the whole batch in a
+    single query; rows that fail validation are reported and skipped while the
+    rest are inserted, queued for the Sheet and folded into the stock balances
+    together.
+    """
+    rows = list(rows)
+    now = utc_now_iso()
+    prepared: list[tuple[int, str, dict[str, Any]]] = []
+    results: dict[int, InventoryBulkRowResult] = {}
+    for index, row in enumerate(rows):
+        sync_id = str(row.get("_sync_id") or uuid.uuid4().hex).strip()
+        powder_id = str(row.get("色粉編號") or "").strip()
+        supplier_id = str(row.get("廠商編號") or "").strip()
+        try:
+            entity = _movement_entity(row, sync_id, powder_id, supplier_id)
+            if not math.isfinite(entity["quantity"]):
+                raise ValueError(entity["quantity"])
+        except (TypeError, ValueError):
+            results[index] = InventoryBulkRowResult(index, sync_id, error=f"數量 {row.get('數量')} 不是數字")
+            continue
+        if not powder_id:
+            results[index] = InventoryBulkRowResult(index, sync_id, error="請輸入色粉編號")
+            continue
+        prepared.append((index, sync_id, entity))
+
+    with connect_from_config(config) as conn:
+        found: dict[str, set[str]] = {"powder": set(), "supplier": set(), "sync_id": set()}
+        if prepared:
+            for kind, key in conn.execute(
+                """SELECT 'powder', colorpowder_id FROM color_powders
+                   WHERE colorpowder_id IN (SELECT value FROM json_each(?))
+                   UNION ALL
+                   SELECT 'supplier', supplier_id FROM suppliers
+                   WHERE supplier_id IN (SELECT value FROM json_each(?))
+                   UNION ALL
+                   SELECT 'sync_id', sheet_row_key FROM inventory_movements
+                   WHERE sheet_name='庫存記錄' AND sheet_row_key IN (SELECT value FROM json_each(?))""",
+                tuple(
+                    json.dumps(sorted({entity[column] for _, _, entity in prepared}), ensure_ascii=False)
+                    for column in ("colorpowder_id", "supplier_id", "sheet_row_key")
+                ),
+            ).fetchall():
+                found[kind].add(str(key))
+        statements = []
+        powder_ids = set()
+        for index, sync_id, entity in prepared:
+            if entity["colorpowder_id"] not in found["powder"]:
+                error = f"找不到色粉編號 {entity['colorpowder_id']}"
+            elif entity["supplier_id"] and entity["supplier_id"] not in found["supplier"]:
+                error = f"找不到供應商編號 {entity['supplier_id']}"
+            elif sync_id in found["sync_id"]:
+                error = f"庫存 _sync_id {sync_id} 已存在"
+            else:
+                error = None
+            if error:
+                results[index] = InventoryBulkRowResult(index, sync_id, error=error)
+                continue
+            found["sync_id"].add(sync_id)
+            payload = inventory_sheet_payload(entity)
+            statements.append((
+                """INSERT INTO inventory_movements(
+                       movement_key, sheet_name, sheet_row_key, movement_type, colorpowder_id,
+                       movement_date, movement_day, quantity, unit, notes, supplier_id, supplier_name,
+                       source, version, created_at, updated_at, last_synced_at)
+                   VALUES (?, '庫存記錄', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'app', 1, ?, ?, NULL)""",
+                (
+                    f"sheet:庫存記錄:{sync_id}", sync_id, entity["movement_type"], entity["colorpowder_id"],
+                    entity["movement_date"], entity["movement_day"], entity["quantity"], entity["unit"], entity["notes"],
+                    entity["supplier_id"], entity["supplier_name"], now, now,
+                ),
+            ))
+            powder_ids.add(entity["colorpowder_id"])
+            results[index] = InventoryBulkRowResult(index, sync_id, payload=payload)
+        # Movements first, then their outbox events, so each half is one executemany run.
+        execute_batch(conn, statements + [
+            sheet_sync_statement(
+                sheet_name="庫存記錄", row_key=result.sync_id, operation="insert",
+                payload=result.payload, entity_version=1,
+            )
+            for result in sorted(results.values(), key=lambda item: item.index) if result.ok
+        ])
+        refresh_powder_stock_balances(conn, powder_ids)
+    return [results[index] for index in range(len(rows))]
+
+
 def update_inventory_movement(config: DatabaseConfig, sync_id: str, row: dict[str, Any]) -> dict[str, str]:
     sync_id = str(sync_id or "").strip()
     powder_id = str(row.get("色粉編號") or "").strip()
     supplier_id = str(row.get("廠商編號") or "").strip()
     now = utc_now_iso()
+    entity = _movement_entity(row, sync_id, powder_id, supplier_id)
+    payload = inventory_sheet_payload(entity)
     with connect_from_config(config) as conn:
         _validate_refs(conn, powder_id, supplier_id)
         existing = _mapping(conn.execute(
@@ -135,25 +363,22 @@ def update_inventory_movement(config: DatabaseConfig, sync_id: str, row: dict[st
         if existing.get("reversed_at"):
             raise InventoryError("已沖銷的庫存記錄不可修改")
         version = int(existing["version"]) + 1
-        conn.execute(
-            """UPDATE inventory_movements SET movement_type=?, colorpowder_id=?, movement_date=?,
-                      quantity=?, unit=?, notes=?, supplier_id=?, supplier_name=?, source='app',
-                      version=?, updated_at=? WHERE sheet_name='庫存記錄' AND sheet_row_key=?""",
-            (
-                str(row.get("類型") or "").strip(), powder_id, str(row.get("日期") or "").strip(),
-                float(row.get("數量") or 0), str(row.get("單位") or "g").strip(),
-                str(row.get("備註") or "").strip(), supplier_id,
-                str(row.get("廠商名稱") or "").strip(), version, now, sync_id,
+        execute_batch(conn, [
+            ("""UPDATE inventory_movements SET movement_type=?, colorpowder_id=?, movement_date=?,
+                       movement_day=?, quantity=?, unit=?, notes=?, supplier_id=?, supplier_name=?, source='app',
+                       version=?, updated_at=? WHERE sheet_name='庫存記錄' AND sheet_row_key=?""",
+             (
+                 entity["movement_type"], powder_id, entity["movement_date"], entity["movement_day"],
+                 entity["quantity"],
+                 entity["unit"], entity["notes"], supplier_id, entity["supplier_name"],
+                 version, now, sync_id,
+             )),
+            sheet_sync_statement(
+                sheet_name="庫存記錄", row_key=sync_id, operation="update",
+                payload=payload, entity_version=version,
             ),
-        )
-        entity = _mapping(conn.execute(
-            "SELECT * FROM inventory_movements WHERE sheet_name='庫存記錄' AND sheet_row_key=?", (sync_id,)
-        ))
-        payload = inventory_sheet_payload(entity)
-        enqueue_sheet_sync(
-            conn, sheet_name="庫存記錄", row_key=sync_id, operation="update",
-            payload=payload, entity_version=version,
-        )
+        ])
+        refresh_powder_stock_balances(conn, {powder_id, str(existing["colorpowder_id"] or "")})
         return payload
 
 
@@ -198,12 +423,12 @@ def reverse_inventory_movement(
         conn.execute(
             """INSERT INTO inventory_movements(
                    movement_key, sheet_name, sheet_row_key, movement_type, colorpowder_id,
-                   movement_date, quantity, unit, notes, supplier_id, supplier_name,
+                   movement_date, movement_day, quantity, unit, notes, supplier_id, supplier_name,
                    reversal_of_movement_key, source, version, created_at, updated_at, last_synced_at)
-               VALUES (?, '庫存記錄', ?, '沖銷', ?, ?, ?, ?, ?, ?, ?, ?, 'app', 1, ?, ?, NULL)""",
+               VALUES (?, '庫存記錄', ?, '沖銷', ?, ?, ?, ?, ?, ?, ?, ?, ?, 'app', 1, ?, ?, NULL)""",
             (
                 f"sheet:庫存記錄:{reversal_sync_id}", reversal_sync_id,
-                original["colorpowder_id"], original["movement_date"],
+                original["colorpowder_id"], original["movement_date"], iso_day(original["movement_date"]),
                 -float(original["quantity"]), original["unit"], reversal_notes,
                 original.get("supplier_id") or "", original.get("supplier_name") or "",
                 original["movement_key"], now, now,
@@ -212,14 +437,15 @@ def reverse_inventory_movement(
         conn.execute(
             """UPDATE inventory_movements
                SET reversed_at=?, updated_at=?, version=version+1
-               WHERE movement_id=? AND reversed_at IS NULL""",
-            (now, now, original["movement_id"]),
+               WHERE sheet_name='庫存記錄' AND sheet_row_key=? AND reversed_at IS NULL""",
+            (now, now, sync_id),
         )
         reversal = _mapping(conn.execute(
             "SELECT * FROM inventory_movements WHERE sheet_name='庫存記錄' AND sheet_row_key=?",
             (reversal_sync_id,),
         ))
         payload = inventory_sheet_payload(reversal)
+        refresh_powder_stock_balances(conn, {original["colorpowder_id"]})
         enqueue_sheet_sync(
             conn, sheet_name="庫存記錄", row_key=sync_id, operation="delete",
             payload=None, entity_version=int(original["version"]) + 1,
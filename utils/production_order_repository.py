@@ -3,9 +3,35 @@
 from __future__ import annotations
 
 import json
-from typing import Any
+import re
+from datetime import date
+from typing import Any, Iterable
 
-from .database import DatabaseConfig, connect_from_config, enqueue_sheet_sync, utc_now_iso
+from .database import (
+    ChangeSet,
+    DatabaseConfig,
+    connect_from_config,
+    enqueue_sheet_sync,
+    execute_batch,
+    keyset_after,
+    next_sequence,
+    page_limit,
+    sheet_sync_statement,
+    change_watermark,
+    utc_now_iso,
+)
+from .recipe_repository import load_recipe_snapshot
+from .stock_repository import iso_day, refresh_powder_stock_balances, write_order_powder_consumption
+
+
+PRODUCTION_ORDER_SEQUENCE = "production_order"
+# Columns kept outside payload_json; every other 生產單 field is read from the payload.
+_ORDER_STATUS_SQL = {
+    "取消狀態": "CASE WHEN cancelled_at IS NULL THEN '有效' ELSE '已取消' END",
+    "取消時間": "COALESCE(cancelled_at, '')",
+    "取消原因": "COALESCE(cancel_reason, '')",
+}
+_ORDER_SORT_KEY = ("production_date IS NOT NULL", "COALESCE(production_date, '')", "production_order_id")
 
 
 class ProductionOrderError(RuntimeError):
@@ -49,28 +75,72 @@ def _payload(row: dict[str, Any]) -> dict[str, str]:
 def _recipe_snapshot(conn, recipe_id: str) -> tuple[int | None, str | None]:
     if not recipe_id:
         return None, None
-    recipe = _mapping(conn.execute("SELECT * FROM recipes WHERE recipe_id=?", (recipe_id,)))
-    if recipe is None:
+    snapshot = load_recipe_snapshot(conn, recipe_id)
+    if snapshot is None:
         raise ProductionOrderError(f"找不到配方編號 {recipe_id}")
-    components = _mappings(conn.execute(
-        """SELECT position, colorpowder_id, weight FROM recipe_components
-           WHERE recipe_id=? ORDER BY position""",
-        (recipe_id,),
-    ))
-    snapshot = dict(recipe)
-    snapshot["components"] = components
-    return int(recipe["version"]), json.dumps(snapshot, ensure_ascii=False, default=str)
+    return int(snapshot["version"]), json.dumps(snapshot, ensure_ascii=False, default=str)
 
 
 def list_production_orders(
-    config: DatabaseConfig, *, include_cancelled: bool = False,
+    config: DatabaseConfig,
+    *,
+    include_cancelled: bool = False,
+    recipe_id: str | None = None,
+    customer: str | None = None,
+    status: str | None = None,
+    start: date | str | None = None,
+    end: date | str | None = None,
+    changed_after: int | None = None,
+    columns: Iterable[str] | None = None,
+    after: str | None = None,
+    limit: int | None = None,
 ) -> list[dict[str, str]]:
+    """Order payloads ordered by 生產日期 then 生產單號.
+
+    ``start``/``end`` are inclusive days matched on the indexed ISO
+    ``production_day``; ``after`` is the 生產單號 of the previous page's last
+    row.  ``columns`` are extracted from ``payload_json`` in SQL.
+    """
+    clauses: list[str] = []
+    params: list[Any] = []
+    if not include_cancelled:
+        clauses.append("cancelled_at IS NULL")
+    for column, value in (("recipe_id", recipe_id), ("customer_name", customer), ("status", status)):
+        if value:
+            clauses.append(f"{column}=?")
+            params.append(str(value).strip())
+    for value, operator in ((start, ">="), (end, "<=")):
+        if value:
+            clauses.append(f"production_day {operator} ?")
+            params.append(_day_bound(value))
+    if changed_after is not None:
+        clauses.append("change_seq>?")
+        params.append(changed_after)
+    if after is not None:
+        clauses.append(keyset_after(
+            _ORDER_SORT_KEY,
+            f"SELECT {', '.join(_ORDER_SORT_KEY)} FROM production_orders WHERE production_order_id=?",
+        ))
+        params.append(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    limit_sql, limit_params = page_limit(limit)
+    order_sql = f"FROM production_orders {where} ORDER BY {', '.join(_ORDER_SORT_KEY)} {limit_sql}"
+    if columns is not None:
+        selected = list(columns)
+        if any('"' in column for column in selected):
+            raise ProductionOrderError("欄位名稱不可包含雙引號")
+        expressions = [
+            _ORDER_STATUS_SQL.get(column, "COALESCE(json_extract(payload_json, ?), '')") for column in selected
+        ]
+        paths = [f'$."{column}"' for column in selected if column not in _ORDER_STATUS_SQL]
+        with connect_from_config(config) as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(expressions)} {order_sql}", (*paths, *params, *limit_params),
+            ).fetchall()
+        return [dict(zip(selected, tuple(row))) for row in rows]
     with connect_from_config(config) as conn:
-        where = "" if include_cancelled else "WHERE cancelled_at IS NULL"
         rows = _mappings(conn.execute(
-            f"""SELECT payload_json, cancelled_at, cancel_reason
-                FROM production_orders {where}
-                ORDER BY production_date, production_order_id"""
+            f"SELECT payload_json, cancelled_at, cancel_reason {order_sql}", (*params, *limit_params),
         ))
     result = []
     for row in rows:
@@ -84,6 +154,45 @@ def list_production_orders(
     return result
 
 
+def _day_bound(value: date | str) -> str:
+    day = iso_day(value)
+    if day is None:
+        raise ProductionOrderError(f"無法辨識的日期：{value}")
+    return day
+
+
+def list_production_orders_changed_since(
+    config: DatabaseConfig, watermark: int | None, *, include_cancelled: bool = False,
+) -> ChangeSet:
+    """Orders written after ``watermark``; cancelled ones are tombstones unless included."""
+    with connect_from_config(config) as conn:
+        next_watermark = change_watermark(conn, "production_orders")
+    rows = list_production_orders(config, include_cancelled=True, changed_after=watermark)
+    return ChangeSet(
+        upserted=[row for row in rows if include_cancelled or row["取消狀態"] != "已取消"],
+        tombstoned=[row["生產單號"] for row in rows if not include_cancelled and row["取消狀態"] == "已取消"],
+        watermark=watermark if next_watermark is None else next_watermark,
+    )
+
+
+def next_production_order_id(config: DatabaseConfig, day: date | None = None) -> str:
+    """Allocate ``YYYYMMDD-NNN`` from the per-day sequence; concurrent callers never share a number.
+
+    Only the day's own IDs are scanned (a primary-key range), so orders that
+    reached the table without the sequence, e.g. Sheet imports, are skipped over.
+    """
+    period = (day or date.today()).strftime("%Y%m%d")
+    with connect_from_config(config) as conn:
+        rows = conn.execute(
+            "SELECT production_order_id FROM production_orders WHERE production_order_id >= ? AND production_order_id < ?",
+            (f"{period}-", f"{period}."),
+        ).fetchall()
+        pattern = re.compile(rf"^{period}-(\d+)$")
+        taken = [int(match.group(1)) for row in rows if (match := pattern.match(str(row[0]).strip()))]
+        number = next_sequence(conn, PRODUCTION_ORDER_SEQUENCE, period, floor=max(taken, default=0))
+    return f"{period}-{number:03d}"
+
+
 def _save(config: DatabaseConfig, row: dict[str, Any], *, create: bool) -> dict[str, str]:
     payload = _payload(row)
     order_id = payload.get("生產單號", "")
@@ -104,41 +213,43 @@ def _save(config: DatabaseConfig, row: dict[str, Any], *, create: bool) -> dict[
         recipe_version, snapshot_json = _recipe_snapshot(conn, recipe_id)
         version = 1 if existing is None else int(existing["version"]) + 1
         created_at = now if existing is None else existing["created_at"]
-        conn.execute(
-            """INSERT INTO production_orders(
-                   production_order_id, production_date, recipe_id, color, customer_name,
+        packages = [
+            (position, _number(payload.get(f"包裝重量{position}")), _number(payload.get(f"包裝份數{position}")))
+            for position in range(1, 5)
+        ]
+        execute_batch(conn, [
+            ("""INSERT INTO production_orders(
+                   production_order_id, production_date, production_day, recipe_id, color, customer_name,
                    status, payload_json, recipe_version, recipe_snapshot_json, source,
                    version, created_at, updated_at, last_synced_at)
-               VALUES (?, ?, ?, ?, ?, 'draft', ?, ?, ?, 'app', ?, ?, ?, NULL)
+               VALUES (?, ?, ?, ?, ?, ?, 'draft', ?, ?, ?, 'app', ?, ?, ?, NULL)
                ON CONFLICT(production_order_id) DO UPDATE SET
-                   production_date=excluded.production_date, recipe_id=excluded.recipe_id,
+                   production_date=excluded.production_date, production_day=excluded.production_day,
+                   recipe_id=excluded.recipe_id,
                    color=excluded.color, customer_name=excluded.customer_name,
                    payload_json=excluded.payload_json, recipe_version=excluded.recipe_version,
                    recipe_snapshot_json=excluded.recipe_snapshot_json, source='app',
                    version=excluded.version, updated_at=excluded.updated_at""",
             (
-                order_id, payload.get("生產日期", ""), recipe_id or None,
+                order_id, payload.get("生產日期", ""), iso_day(payload.get("生產日期")), recipe_id or None,
                 payload.get("顏色", ""), payload.get("客戶名稱", ""),
                 json.dumps(payload, ensure_ascii=False), recipe_version, snapshot_json,
                 version, created_at, now,
+            )),
+            ("DELETE FROM production_order_packages WHERE production_order_id=?", (order_id,)),
+            *(
+                ("""INSERT INTO production_order_packages(
+                        production_order_id, position, package_weight, package_count, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                 (order_id, position, weight, count, now, now))
+                for position, weight, count in packages if weight or count
             ),
-        )
-        conn.execute("DELETE FROM production_order_packages WHERE production_order_id=?", (order_id,))
-        for position in range(1, 5):
-            weight = _number(payload.get(f"包裝重量{position}"))
-            count = _number(payload.get(f"包裝份數{position}"))
-            if not weight and not count:
-                continue
-            conn.execute(
-                """INSERT INTO production_order_packages(
-                       production_order_id, position, package_weight, package_count, created_at, updated_at)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (order_id, position, weight, count, now, now),
-            )
-        enqueue_sheet_sync(
-            conn, sheet_name="生產單", row_key=order_id,
-            operation="insert" if create else "update", payload=payload, entity_version=version,
-        )
+            sheet_sync_statement(
+                sheet_name="生產單", row_key=order_id,
+                operation="insert" if create else "update", payload=payload, entity_version=version,
+            ),
+        ])
+        refresh_powder_stock_balances(conn, write_order_powder_consumption(conn, order_id))
     return payload
 
 
@@ -203,6 +314,7 @@ def set_production_order_cancelled(
                 version, now, order_id,
             ),
         )
+        refresh_powder_stock_balances(conn, write_order_powder_consumption(conn, order_id))
         enqueue_sheet_sync(
             conn, sheet_name="生產單", row_key=order_id,
             operation="delete" if cancelled else "update",
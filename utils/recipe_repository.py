@@ -2,11 +2,47 @@
 
 from __future__ import annotations
 
-from typing import Any
-
-from .database import DatabaseConfig, connect_from_config, enqueue_sheet_sync, utc_now_iso
+from typing import Any, Iterable
+
+import pandas as pd
+
+from .database import (
+    ChangeSet,
+    DatabaseConfig,
+    SqlExecutor,
+    connect_from_config,
+    Statement,
+    enqueue_sheet_sync,
+    execute_batch,
+    keyset_after,
+    missing_keys,
+    page_limit,
+    sheet_sync_statement,
+    change_watermark,
+    utc_now_iso,
+)
+from .stock_engine import parse_datetime_values
 
 RECIPE_COMPONENT_POSITIONS = range(1, 9)
+RECIPE_USAGE_VECTOR_STATE = "recipe_usage_vectors"
+# How each page counted an order's powders, preserved per ledger column:
+# 庫存區 ("stock") adds every recipe's first slot plus the 合計類別 remainder,
+# the 生產單 balance ("balance") deducts a powder once per order so the main
+# recipe shadows its 附加配方, and the 用量排行榜 ("ranking") adds every slot.
+USAGE_BASES = ("stock", "balance", "ranking")
+# The recipes column behind each listed field; 色粉編號N/色粉重量N come from the components.
+_RECIPE_LIST_SOURCES = {
+    "配方編號": "recipe_id", "顏色": "color", "客戶編號": "customer_id", "客戶名稱": "customer_name",
+    "配方類別": "recipe_category", "狀態": "status", "原始配方": "original_recipe",
+    "色粉類別": "powder_category", "計量單位": "measurement_unit", "Pantone色號": "pantone_code",
+    "代工倍率": "oem_multiplier", "比例1": "ratio1", "比例2": "ratio2", "比例3": "ratio3",
+    "淨重": "net_weight", "淨重單位": "net_weight_unit", "合計類別": "total_category",
+    "重要提醒": "important_notice", "備註": "notes", "建檔時間": "sheet_created_at",
+    "生命週期": "lifecycle_status", "停用時間": "deleted_at", "停用原因": "delete_reason",
+}
+_COMPONENT_LIST_COLUMNS = {
+    f"{prefix}{position}" for prefix in ("色粉編號", "色粉重量") for position in RECIPE_COMPONENT_POSITIONS
+}
 
 
 class RecipeError(RuntimeError):
@@ -51,6 +87,204 @@ def _number(value: Any, default: float = 0) -> float:
         return default
 
 
+def load_recipe_snapshot(conn: SqlExecutor, recipe_id: str | None) -> dict[str, Any] | None:
+    """Current recipe with its components and active 附加配方, as stored on orders."""
+    if not recipe_id:
+        return None
+    recipe = _mapping(conn.execute("SELECT * FROM recipes WHERE recipe_id=?", (recipe_id,)))
+    if recipe is None:
+        return None
+    add_ons = _mappings(conn.execute(
+        """SELECT * FROM recipes
+           WHERE recipe_category='附加配方' AND original_recipe=? AND recipe_id<>?
+             AND lifecycle_status='active'
+           ORDER BY recipe_id""",
+        (recipe_id, recipe_id),
+    ))
+    components = _mappings(conn.execute(
+        """SELECT recipe_id, position, colorpowder_id, weight FROM recipe_components
+           WHERE recipe_id=? OR recipe_id IN (
+               SELECT recipe_id FROM recipes
+               WHERE recipe_category='附加配方' AND original_recipe=? AND lifecycle_status='active')
+           ORDER BY recipe_id, position""",
+        (recipe_id, recipe_id),
+    ))
+    by_recipe: dict[str, list[dict[str, Any]]] = {}
+    for component in components:
+        by_recipe.setdefault(str(component.pop("recipe_id")), []).append(component)
+    snapshot = dict(recipe)
+    snapshot["components"] = by_recipe.get(str(recipe_id), [])
+    snapshot["add_ons"] = [
+        {**add_on, "components": by_recipe.get(str(add_on["recipe_id"]), [])} for add_on in add_ons
+    ]
+    return snapshot
+
+
+def expand_recipe_usage(recipes: Iterable[dict[str, Any]], *, basis: str = "stock") -> dict[str, float]:
+    """Grams per packed kg of a main recipe followed by its 附加配方.
+
+    For ``"stock"`` each recipe contributes the weight of a powder's first
+    slot, and a 合計類別 recipe adds ``淨重 - Σ色粉重量`` to the total-category
+    powder when positive.  ``"balance"`` keeps only a powder's first positive
+    weight across the recipes, and ``"ranking"`` sums every positive slot.
+    """
+    if basis not in USAGE_BASES:
+        raise ValueError(f"basis must be one of {USAGE_BASES}")
+    usage: dict[str, float] = {}
+    for recipe in recipes:
+        components = sorted(recipe.get("components") or [], key=lambda item: int(item.get("position") or 0))
+        if basis != "stock":
+            for component in components:
+                powder_id = str(component.get("colorpowder_id") or "").strip()
+                weight = float(component.get("weight") or 0)
+                if not powder_id or weight <= 0:
+                    continue
+                if basis == "ranking":
+                    usage[powder_id] = usage.get(powder_id, 0.0) + weight
+                else:
+                    usage.setdefault(powder_id, weight)
+            continue
+        first_weights: dict[str, float] = {}
+        for component in components:
+            powder_id = str(component.get("colorpowder_id") or "").strip()
+            if powder_id:
+                first_weights.setdefault(powder_id, float(component.get("weight") or 0))
+        for powder_id, weight in first_weights.items():
+            if weight > 0:
+                usage[powder_id] = usage.get(powder_id, 0.0) + weight
+        total_category = str(recipe.get("total_category") or "").strip()
+        if total_category:
+            remainder = float(recipe.get("net_weight") or 0) - sum(
+                float(component.get("weight") or 0) for component in components
+            )
+            if remainder > 0:
+                usage[total_category] = usage.get(total_category, 0.0) + remainder
+    return usage
+
+
+def expand_recipe_usage_bases(recipes: Iterable[dict[str, Any]]) -> dict[str, tuple[float, float, float]]:
+    """Per-powder ``(stock, balance, ranking)`` grams per packed kg; see ``USAGE_BASES``."""
+    recipes = list(recipes)
+    expanded = [expand_recipe_usage(recipes, basis=basis) for basis in USAGE_BASES]
+    return {
+        powder_id: tuple(usage.get(powder_id, 0.0) for usage in expanded)
+        for powder_id in sorted(set().union(*expanded))
+    }
+
+
+def _recipe_usage_vectors(
+    recipes: list[dict[str, Any]], components: list[dict[str, Any]],
+) -> dict[str, dict[str, tuple[float, float, float]]]:
+    by_recipe: dict[str, list[dict[str, Any]]] = {}
+    for component in components:
+        by_recipe.setdefault(str(component["recipe_id"]), []).append(component)
+    add_ons: dict[str, list[dict[str, Any]]] = {}
+    for recipe in recipes:
+        original = str(recipe.get("original_recipe") or "")
+        if recipe.get("recipe_category") == "附加配方" and original and original != recipe["recipe_id"]:
+            add_ons.setdefault(original, []).append(recipe)
+    vectors = {}
+    for recipe in recipes:
+        if recipe.get("lifecycle_status") != "active":
+            continue
+        recipe_id = str(recipe["recipe_id"])
+        expanded = [recipe, *sorted(
+            (add_on for add_on in add_ons.get(recipe_id, []) if add_on.get("lifecycle_status") == "active"),
+            key=lambda add_on: str(add_on["recipe_id"]),
+        )]
+        vectors[recipe_id] = expand_recipe_usage_bases(
+            {**item, "components": by_recipe.get(str(item["recipe_id"]), [])} for item in expanded
+        )
+    return vectors
+
+
+def _usage_vector_statements(vectors: dict[str, dict[str, tuple[float, float, float]]]) -> list[Statement]:
+    return [
+        (
+            """INSERT INTO recipe_usage_vectors(
+                   recipe_id, colorpowder_id, grams_per_kg, balance_grams_per_kg, ranking_grams_per_kg)
+               VALUES (?, ?, ?, ?, ?)""",
+            (recipe_id, powder_id, *grams_per_kg),
+        )
+        for recipe_id, usage in vectors.items()
+        for powder_id, grams_per_kg in usage.items()
+    ]
+
+
+def _write_recipe_usage_vectors(conn: SqlExecutor, vectors: dict[str, dict[str, tuple[float, float, float]]]) -> None:
+    execute_batch(conn, _usage_vector_statements(vectors))
+
+
+def refresh_recipe_usage_vectors(conn: SqlExecutor, recipe_ids: Iterable[str | None]) -> None:
+    """Recompute usage vectors for ``recipe_ids`` inside the caller's transaction.
+
+    Pass the original recipe of a changed 附加配方 as well; its vector folds the add-on in.
+    Snapshots are read first and every vector write goes out as one batch.
+    """
+    statements: list[Statement] = []
+    for recipe_id in sorted({str(value).strip() for value in recipe_ids if str(value or "").strip()}):
+        statements.append(("DELETE FROM recipe_usage_vectors WHERE recipe_id=?", (recipe_id,)))
+        snapshot = load_recipe_snapshot(conn, recipe_id)
+        if snapshot is None or snapshot.get("lifecycle_status") != "active":
+            continue
+        statements.extend(_usage_vector_statements(
+            {recipe_id: expand_recipe_usage_bases([snapshot, *snapshot["add_ons"]])}
+        ))
+    execute_batch(conn, statements)
+
+
+def _rebuild_recipe_usage_vectors(conn: SqlExecutor) -> int:
+    recipes = _mappings(conn.execute(
+        "SELECT recipe_id, recipe_category, original_recipe, lifecycle_status, net_weight, total_category FROM recipes"
+    ))
+    components = _mappings(conn.execute(
+        "SELECT recipe_id, position, colorpowder_id, weight FROM recipe_components ORDER BY recipe_id, position"
+    ))
+    vectors = _recipe_usage_vectors(recipes, components)
+    conn.execute("DELETE FROM recipe_usage_vectors")
+    _write_recipe_usage_vectors(conn, vectors)
+    now = utc_now_iso()
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, last_success_at, last_attempt_at, status, message)
+           VALUES (?, ?, ?, 'ok', ?)
+           ON CONFLICT(sync_name) DO UPDATE SET
+               last_success_at=excluded.last_success_at, last_attempt_at=excluded.last_attempt_at,
+               status='ok', message=excluded.message""",
+        (RECIPE_USAGE_VECTOR_STATE, now, now, f"rebuilt {len(vectors)} recipes"),
+    )
+    return len(vectors)
+
+
+def ensure_recipe_usage_vectors(conn: SqlExecutor) -> None:
+    """Build every vector once after the schema upgrade that introduced the table."""
+    state = _mapping(conn.execute(
+        "SELECT status FROM sync_state WHERE sync_name=?", (RECIPE_USAGE_VECTOR_STATE,)
+    ))
+    if state is not None and state["status"] == "rebuild_required":
+        _rebuild_recipe_usage_vectors(conn)
+
+
+def recipe_usage_vector(conn: SqlExecutor, recipe_id: str | None) -> dict[str, tuple[float, float, float]]:
+    """Per-powder ``(stock, balance, ranking)`` grams per kg of one recipe."""
+    rows = _mappings(conn.execute(
+        """SELECT colorpowder_id, grams_per_kg, balance_grams_per_kg, ranking_grams_per_kg
+           FROM recipe_usage_vectors WHERE recipe_id=?""",
+        (str(recipe_id or ""),),
+    ))
+    return {
+        str(row["colorpowder_id"]): (
+            float(row["grams_per_kg"]), float(row["balance_grams_per_kg"]), float(row["ranking_grams_per_kg"]),
+        )
+        for row in rows
+    }
+
+
+def rebuild_recipe_usage_vectors(config: DatabaseConfig) -> int:
+    """Recompute every active recipe's usage vector; returns the number of recipes."""
+    with connect_from_config(config) as conn:
+        return _rebuild_recipe_usage_vectors(conn)
+
+
 def _validated_payload(conn, row: dict[str, Any]) -> tuple[dict[str, str], list[tuple[int, str, float]]]:
     payload = {str(key): _text(row, str(key)) for key in row}
     recipe_id = payload.get("配方編號", "")
@@ -66,11 +300,12 @@ def _validated_payload(conn, row: dict[str, Any]) -> tuple[dict[str, str], list[
             if _number(weight_text):
                 raise RecipeError(f"色粉重量{position}有值但色粉編號{position}空白")
             continue
-        if _mapping(conn.execute(
-            "SELECT colorpowder_id FROM color_powders WHERE colorpowder_id=?", (powder_id,)
-        )) is None:
-            raise RecipeError(f"找不到色粉編號 {powder_id}")
         components.append((position, powder_id, _number(weight_text)))
+    missing = missing_keys(
+        conn, "color_powders", "colorpowder_id", [powder_id for _, powder_id, _ in components],
+    )
+    if missing:
+        raise RecipeError(f"找不到色粉編號 {missing[0]}")
     return payload, components
 
 
@@ -86,8 +321,9 @@ def _save_recipe(config: DatabaseConfig, row: dict[str, Any], *, create: bool) -
             raise RecipeNotFound(f"找不到配方編號 {recipe_id}")
         version = 1 if existing is None else int(existing["version"]) + 1
         created_at = now if existing is None else existing["created_at"]
-        conn.execute(
-            """INSERT INTO recipes(
+        operation = "insert" if create else "update"
+        execute_batch(conn, [
+            ("""INSERT INTO recipes(
                    recipe_id, color, customer_id, customer_name, recipe_category, status,
                    original_recipe, powder_category, measurement_unit, pantone_code,
                    ratio1, ratio2, ratio3, net_weight, net_weight_unit, total_category,
@@ -115,20 +351,22 @@ def _save_recipe(config: DatabaseConfig, row: dict[str, Any], *, create: bool) -
                 payload.get("合計類別", ""), payload.get("建檔時間", ""), payload.get("備註", ""),
                 payload.get("重要提醒", ""), _number(payload.get("代工倍率"), 1) or 1,
                 version, created_at, now,
+            )),
+            ("DELETE FROM recipe_components WHERE recipe_id=?", (recipe_id,)),
+            *(
+                ("""INSERT INTO recipe_components(recipe_id, position, colorpowder_id, weight, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                 (recipe_id, position, powder_id, weight, now, now))
+                for position, powder_id, weight in components
             ),
-        )
-        conn.execute("DELETE FROM recipe_components WHERE recipe_id=?", (recipe_id,))
-        for position, powder_id, weight in components:
-            conn.execute(
-                """INSERT INTO recipe_components(recipe_id, position, colorpowder_id, weight, created_at, updated_at)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (recipe_id, position, powder_id, weight, now, now),
-            )
-        operation = "insert" if create else "update"
-        enqueue_sheet_sync(
-            conn, sheet_name="配方管理", row_key=recipe_id, operation=operation,
-            payload=payload, entity_version=version,
-        )
+            sheet_sync_statement(
+                sheet_name="配方管理", row_key=recipe_id, operation=operation,
+                payload=payload, entity_version=version,
+            ),
+        ])
+        refresh_recipe_usage_vectors(conn, {
+            recipe_id, payload.get("原始配方"), (existing or {}).get("original_recipe"),
+        })
         return payload
 
 
@@ -162,19 +400,158 @@ def _recipe_sheet_payload(entity: dict[str, Any], components: list[dict[str, Any
     return row
 
 
-def list_recipes(config: DatabaseConfig, *, include_inactive: bool = False) -> list[dict[str, str]]:
+def list_recipes(
+    config: DatabaseConfig,
+    *,
+    include_inactive: bool = False,
+    recipe_id: str | None = None,
+    customer: str | None = None,
+    powder_id: str | None = None,
+    status: str | None = None,
+    lifecycle: str | None = None,
+    changed_after: int | None = None,
+    columns: Iterable[str] | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+) -> list[dict[str, str]]:
+    """Recipes as Sheet rows, ordered by 配方編號.
+
+    ``customer`` matches the customer ID or name, ``powder_id`` goes through the
+    component powder index, and ``after``/``limit`` page by the last 配方編號.
+    Only the recipe columns behind ``columns`` are selected; components are
+    only read for the selected page, and not at all when ``columns`` asks for
+    no 色粉 fields.
+    """
+    selected = None if columns is None else list(columns)
+    unknown = set(selected or ()) - set(_RECIPE_LIST_SOURCES) - _COMPONENT_LIST_COLUMNS
+    if unknown:
+        raise RecipeError(f"不支援的欄位：{', '.join(sorted(unknown))}")
+    sources = ["recipe_id", *(
+        source for column, source in _RECIPE_LIST_SOURCES.items()
+        if source != "recipe_id" and (selected is None or column in selected)
+    )]
+    clauses: list[str] = []
+    params: list[Any] = []
+    if lifecycle:
+        clauses.append("lifecycle_status=?")
+        params.append(lifecycle)
+    elif not include_inactive:
+        clauses.append("lifecycle_status='active'")
+    if recipe_id:
+        clauses.append("recipe_id=?")
+        params.append(str(recipe_id).strip())
+    if customer:
+        clauses.append("(customer_id=? OR customer_name=?)")
+        params.extend([str(customer).strip()] * 2)
+    if powder_id:
+        clauses.append("recipe_id IN (SELECT recipe_id FROM recipe_components WHERE colorpowder_id=?)")
+        params.append(str(powder_id).strip())
+    if status:
+        clauses.append("status=?")
+        params.append(status)
+    if changed_after is not None:
+        clauses.append("change_seq>?")
+        params.append(changed_after)
+    if after is not None:
+        clauses.append(keyset_after(["recipe_id"], "?"))
+        params.append(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    limit_sql, limit_params = page_limit(limit)
+    page_sql = f"SELECT recipe_id FROM recipes {where} ORDER BY recipe_id {limit_sql}"
+    wants_components = selected is None or bool(_COMPONENT_LIST_COLUMNS & set(selected))
     with connect_from_config(config) as conn:
-        where = "" if include_inactive else "WHERE lifecycle_status='active'"
-        recipes = _mappings(conn.execute(f"SELECT * FROM recipes {where} ORDER BY recipe_id"))
-        components = _mappings(conn.execute(
-            "SELECT recipe_id, position, colorpowder_id, weight FROM recipe_components ORDER BY recipe_id, position"
+        recipes = _mappings(conn.execute(
+            f"SELECT {', '.join(sources)} FROM recipes {where} ORDER BY recipe_id {limit_sql}",
+            (*params, *limit_params),
         ))
+        components = _mappings(conn.execute(
+            f"""SELECT recipe_id, position, colorpowder_id, weight FROM recipe_components
+                WHERE recipe_id IN ({page_sql}) ORDER BY recipe_id, position""",
+            (*params, *limit_params),
+        )) if wants_components and recipes else []
     by_recipe: dict[str, list[dict[str, Any]]] = {}
     for component in components:
         by_recipe.setdefault(str(component["recipe_id"]), []).append(component)
+    rows = [_recipe_sheet_payload(entity, by_recipe.get(str(entity["recipe_id"]), [])) for entity in recipes]
+    if selected is None:
+        return rows
+    return [{column: row.get(column, "") for column in selected} for row in rows]
+
+
+def list_recipes_changed_since(
+    config: DatabaseConfig, watermark: int | None, *, include_inactive: bool = False,
+) -> ChangeSet:
+    """Recipes written after ``watermark``, components included; disabled ones are tombstones."""
+    with connect_from_config(config) as conn:
+        next_watermark = change_watermark(conn, "recipes")
+    rows = list_recipes(config, include_inactive=True, changed_after=watermark)
+    return ChangeSet(
+        upserted=[row for row in rows if include_inactive or row["生命週期"] == "active"],
+        tombstoned=[row["配方編號"] for row in rows if not include_inactive and row["生命週期"] != "active"],
+        watermark=watermark if next_watermark is None else next_watermark,
+    )
+
+
+def find_recipes_containing_powders(
+    config: DatabaseConfig, powder_ids: Iterable[str], limit: int = 200,
+) -> list[dict[str, str]]:
+    """Active recipes using every powder in ``powder_ids``, most recently produced first.
+
+    Matching intersects ``recipe_components`` through its powder index and
+    reads only the distinct production dates of the matched recipes'
+    non-cancelled orders, so the caller never loads the full recipe or order
+    tables.  Sheet dates such as ``2026/9/1`` are parsed before comparing.
+    """
+    wanted = sorted({str(powder_id or "").strip() for powder_id in powder_ids} - {""})
+    if not wanted:
+        return []
+    placeholders = ", ".join("?" for _ in wanted)
+    with connect_from_config(config) as conn:
+        rows = _mappings(conn.execute(
+            f"""WITH matched AS (
+                    SELECT recipe_id FROM recipe_components
+                    WHERE colorpowder_id IN ({placeholders})
+                    GROUP BY recipe_id
+                    HAVING COUNT(DISTINCT colorpowder_id)=?
+                ), produced AS (
+                    SELECT DISTINCT recipe_id, production_date FROM production_orders
+                    WHERE recipe_id IN (SELECT recipe_id FROM matched)
+                      AND cancelled_at IS NULL AND COALESCE(production_date, '')<>''
+                )
+                SELECT r.recipe_id, r.color, r.customer_name, p.production_date
+                FROM matched AS m
+                JOIN recipes AS r ON r.recipe_id=m.recipe_id
+                LEFT JOIN produced AS p ON p.recipe_id=m.recipe_id
+                WHERE r.lifecycle_status='active'""",
+            (*wanted, len(wanted)),
+        ))
+        recipes: dict[str, dict[str, Any]] = {}
+        for row, produced_at in zip(rows, parse_datetime_values(row["production_date"] for row in rows)):
+            recipe = recipes.setdefault(str(row["recipe_id"]), {**row, "last_date": None})
+            if not pd.isna(produced_at) and (recipe["last_date"] is None or produced_at > recipe["last_date"]):
+                recipe["last_date"] = produced_at
+        ranked = sorted(recipes.values(), key=lambda recipe: str(recipe["recipe_id"]))
+        ranked.sort(key=lambda recipe: recipe["last_date"] or pd.Timestamp.min, reverse=True)
+        ranked = ranked[:max(int(limit), 0)]
+        recipe_ids = [str(recipe["recipe_id"]) for recipe in ranked]
+        components = _mappings(conn.execute(
+            f"""SELECT recipe_id, colorpowder_id FROM recipe_components
+                WHERE recipe_id IN ({", ".join("?" for _ in recipe_ids)})
+                ORDER BY recipe_id, position""",
+            recipe_ids,
+        )) if recipe_ids else []
+    powders: dict[str, list[str]] = {}
+    for component in components:
+        powders.setdefault(str(component["recipe_id"]), []).append(str(component["colorpowder_id"]))
     return [
-        _recipe_sheet_payload(entity, by_recipe.get(str(entity["recipe_id"]), []))
-        for entity in recipes
+        {
+            "最後生產時間": recipe["last_date"].strftime("%Y-%m-%d") if recipe["last_date"] is not None else "",
+            "配方編號": str(recipe["recipe_id"]),
+            "顏色": str(recipe.get("color") or ""),
+            "客戶名稱": str(recipe.get("customer_name") or ""),
+            "色粉組成": "、".join(powders.get(str(recipe["recipe_id"]), [])),
+        }
+        for recipe in ranked
     ]
 
 
@@ -198,6 +575,7 @@ def set_recipe_active(config: DatabaseConfig, recipe_id: str, *, active: bool, r
                WHERE recipe_id=? ORDER BY position""",
             (recipe_id,),
         ))
+        refresh_recipe_usage_vectors(conn, {recipe_id, entity.get("original_recipe")})
         enqueue_sheet_sync(
             conn, sheet_name="配方管理", row_key=recipe_id,
             operation="update" if active else "delete",
@@ -0,0 +1,121 @@
+"""Ranked keyword search over the recipe and production order FTS5 indexes.
+
+The ``recipe_search`` and ``production_order_search`` indexes (schema v13) use
+the trigram tokenizer, so keywords match anywhere inside a field without
+regard to case, just like the Sheet-era ``str.contains`` filters.  Keywords
+shorter than three characters cannot use trigrams and fall back to ``LIKE``
+on the same index.  Every keyword must hit at least one indexed column.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any
+
+from .database import DatabaseConfig, connect_from_config
+
+RECIPE_SEARCH_COLUMNS = ("recipe_id", "color", "customer_id", "customer_name", "pantone_code", "notes")
+ORDER_SEARCH_COLUMNS = ("production_order_id", "recipe_id", "customer_name", "color")
+_KEYWORD_SPLIT = re.compile(r"[，,、;\s]+")
+_TRIGRAM_LENGTH = 3
+
+
+def _mappings(cursor) -> list[dict[str, Any]]:
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    if hasattr(rows[0], "keys"):
+        return [{key: row[key] for key in row.keys()} for row in rows]
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def split_search_keywords(query: str | None) -> list[str]:
+    """Split on commas, 頓號, semicolons and whitespace, as the search boxes do."""
+    return [term for term in _KEYWORD_SPLIT.split(str(query or "").strip()) if term]
+
+
+def _keyword_filter(index: str, columns: tuple[str, ...], keywords: list[str]) -> tuple[list[str], list[Any], bool]:
+    """WHERE clauses and parameters for ``keywords``; the flag tells whether MATCH ranks."""
+    clauses: list[str] = []
+    params: list[Any] = []
+    phrases = ['"' + term.replace('"', '""') + '"' for term in keywords if len(term) >= _TRIGRAM_LENGTH]
+    if phrases:
+        clauses.append(f"{index} MATCH ?")
+        params.append(" AND ".join(phrases))
+    for term in keywords:
+        if len(term) >= _TRIGRAM_LENGTH:
+            continue
+        pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        clauses.append("(" + " OR ".join(f"{index}.{column} LIKE ? ESCAPE '\\'" for column in columns) + ")")
+        params.extend([pattern] * len(columns))
+    return clauses, params, bool(phrases)
+
+
+def _search(
+    config: DatabaseConfig,
+    *,
+    index: str,
+    table: str,
+    key: str,
+    columns: tuple[str, ...],
+    select: str,
+    scope: str,
+    query: str,
+    limit: int,
+    offset: int,
+) -> list[dict[str, Any]]:
+    keywords = split_search_keywords(query)
+    if not keywords:
+        return []
+    clauses, params, ranked = _keyword_filter(index, columns, keywords)
+    if scope:
+        clauses.append(scope)
+    order = f"bm25({index}), t.{key}" if ranked else f"t.{key}"
+    with connect_from_config(config) as conn:
+        return _mappings(conn.execute(
+            f"""SELECT {select} FROM {index} JOIN {table} AS t ON t.rowid = {index}.rowid
+                WHERE {' AND '.join(clauses)}
+                ORDER BY {order}
+                LIMIT ? OFFSET ?""",
+            (*params, max(int(limit), 0), max(int(offset), 0)),
+        ))
+
+
+def search_recipes(
+    config: DatabaseConfig,
+    query: str,
+    limit: int = 50,
+    *,
+    offset: int = 0,
+    include_inactive: bool = False,
+) -> list[dict[str, Any]]:
+    """Best-ranked recipes whose ID, color, customer, Pantone code or notes hit every keyword."""
+    return _search(
+        config,
+        index="recipe_search", table="recipes", key="recipe_id", columns=RECIPE_SEARCH_COLUMNS,
+        select="""t.recipe_id AS 配方編號, t.color AS 顏色, t.customer_id AS 客戶編號,
+                  t.customer_name AS 客戶名稱, t.pantone_code AS Pantone色號""",
+        scope="" if include_inactive else "t.lifecycle_status='active'",
+        query=query, limit=limit, offset=offset,
+    )
+
+
+def search_production_orders(
+    config: DatabaseConfig,
+    query: str,
+    limit: int = 50,
+    *,
+    offset: int = 0,
+    include_cancelled: bool = False,
+) -> list[dict[str, Any]]:
+    """Best-ranked production orders whose number, recipe, customer or color hit every keyword."""
+    return _search(
+        config,
+        index="production_order_search", table="production_orders", key="production_order_id",
+        columns=ORDER_SEARCH_COLUMNS,
+        select="""t.production_order_id AS 生產單號, t.production_date AS 生產日期,
+                  t.recipe_id AS 配方編號, t.customer_name AS 客戶名稱, t.color AS 顏色""",
+        scope="" if include_cancelled else "t.cancelled_at IS NULL",
+        query=query, limit=limit, offset=offset,
+    )
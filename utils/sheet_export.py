@@ -14,6 +14,7 @@ from .database import (
     record_sync_log,
     upsert_sheet_row,
     utc_now_iso,
+    write_behind_remote_config,
 )
 from .sheet_import import COLOR_COLUMNS, _fetchone_mapping, _records_from_values, _row_hash
 
@@ -57,43 +58,81 @@ def _normalized_payload(payload: dict[str, Any], headers: list[str]) -> dict[str
     return {header: str(payload.get(header, "") or "").strip() for header in headers if header}
 
 
+TOMBSTONE_BACKFILL_STATE = "tombstone_outbox:{sheet_name}"
+_TOMBSTONE_SOURCES = {
+    "色粉管理": ("color_powders", "colorpowder_id", "lifecycle_status='inactive'"),
+    "供應商管理": ("suppliers", "supplier_id", "lifecycle_status='inactive'"),
+    "配方管理": ("recipes", "recipe_id", "lifecycle_status='inactive'"),
+    "生產單": ("production_orders", "production_order_id", "cancelled_at IS NOT NULL"),
+    "庫存記錄": (
+        "inventory_movements", "sheet_row_key",
+        "sheet_name='庫存記錄' AND (reversed_at IS NOT NULL OR reversal_of_movement_key IS NOT NULL)",
+    ),
+}
+
+
 def _ensure_tombstone_outbox(conn, sheet_name: str) -> None:
-    """Backfill one pending delete event for lifecycle rows created before tombstones."""
-    queries = {
-        "色粉管理": ("color_powders", "colorpowder_id", "lifecycle_status='inactive'"),
-        "供應商管理": ("suppliers", "supplier_id", "lifecycle_status='inactive'"),
-        "配方管理": ("recipes", "recipe_id", "lifecycle_status='inactive'"),
-        "生產單": ("production_orders", "production_order_id", "cancelled_at IS NOT NULL"),
-        "庫存記錄": (
-            "inventory_movements", "sheet_row_key",
-            "sheet_name='庫存記錄' AND (reversed_at IS NOT NULL OR reversal_of_movement_key IS NOT NULL)",
-        ),
-    }
-    if sheet_name not in queries:
+    """Backfill one pending delete event for lifecycle rows created before tombstones.
+
+    One ``INSERT ... SELECT`` anti-joins the tombstoned entities against their
+    delete events, including those compaction moved to ``sync_outbox_archive``.
+    The table's ``data_versions`` counter reached by the last pass is kept in
+    ``sync_state``, so later passes only look at rows whose ``change_seq`` is
+    above it (and at rows whose delete event ended in conflict, which are
+    queued again). ``updated_at`` is not a usable cursor: Sheet imports store
+    it in whatever date format the Sheet uses.
+    """
+    if sheet_name not in _TOMBSTONE_SOURCES:
         return
-    table, id_column, condition = queries[sheet_name]
-    rows = conn.execute(
-        f"SELECT {id_column}, version FROM {table} WHERE {condition} AND {id_column} IS NOT NULL"
-    ).fetchall()
-    for row in rows:
-        row_key, entity_version = str(row[0]), int(row[1])
-        existing_delete = conn.execute(
-            """SELECT 1 FROM sync_outbox
-               WHERE sheet_name=? AND row_key=? AND operation='delete'
-                 AND status IN ('pending','failed','processing','completed') LIMIT 1""",
-            (sheet_name, row_key),
-        ).fetchone()
-        if existing_delete:
-            continue
-        max_version = conn.execute(
-            "SELECT COALESCE(MAX(entity_version), 0) FROM sync_outbox WHERE sheet_name=? AND row_key=?",
-            (sheet_name, row_key),
-        ).fetchone()[0]
+    table, id_column, condition = _TOMBSTONE_SOURCES[sheet_name]
+    state_name = TOMBSTONE_BACKFILL_STATE.format(sheet_name=sheet_name)
+    watermark, marker = conn.execute(
+        """SELECT (SELECT version FROM data_versions WHERE table_name=?),
+                  (SELECT high_watermark FROM sync_state WHERE sync_name=?)""",
+        (table, state_name),
+    ).fetchone()
+    # Markers left by the old updated_at cursor are not counters; rescan once.
+    since = int(marker) if str(marker or "").isdigit() else -1
+    conn.execute(
+        f"""INSERT INTO sync_outbox(
+                sheet_name, row_key, operation, payload_json, entity_version, created_at)
+            SELECT ?, CAST(entity.{id_column} AS TEXT), 'delete', NULL,
+                   MAX(entity.version, COALESCE((
+                       SELECT MAX(previous.entity_version) FROM sync_outbox AS previous
+                       WHERE previous.sheet_name=? AND previous.row_key=CAST(entity.{id_column} AS TEXT)
+                   ), 0) + 1, COALESCE((
+                       SELECT MAX(archived.entity_version) FROM sync_outbox_archive AS archived
+                       WHERE archived.sheet_name=? AND archived.row_key=CAST(entity.{id_column} AS TEXT)
+                   ), 0) + 1),
+                   ?
+            FROM {table} AS entity
+            WHERE {condition} AND entity.{id_column} IS NOT NULL
+              AND (entity.change_seq > ? OR CAST(entity.{id_column} AS TEXT) IN (
+                  SELECT row_key FROM sync_outbox
+                  WHERE status='conflict' AND sheet_name=? AND operation='delete'
+              ))
+              AND NOT EXISTS (
+                  SELECT 1 FROM sync_outbox AS existing
+                  WHERE existing.sheet_name=? AND existing.row_key=CAST(entity.{id_column} AS TEXT)
+                    AND existing.operation='delete'
+                    AND existing.status IN ('pending','failed','processing','completed')
+              )
+              AND NOT EXISTS (
+                  SELECT 1 FROM sync_outbox_archive AS archived
+                  WHERE archived.sheet_name=? AND archived.row_key=CAST(entity.{id_column} AS TEXT)
+                    AND archived.operation='delete' AND archived.status='completed'
+              )""",
+        (sheet_name, sheet_name, sheet_name, utc_now_iso(), since, sheet_name, sheet_name, sheet_name),
+    )
+    if watermark is not None and str(watermark) != marker:
+        now = utc_now_iso()
         conn.execute(
-            """INSERT INTO sync_outbox(
-                   sheet_name, row_key, operation, payload_json, entity_version, created_at)
-               VALUES (?, ?, 'delete', NULL, ?, ?)""",
-            (sheet_name, row_key, max(entity_version, int(max_version) + 1), utc_now_iso()),
+            """INSERT INTO sync_state(sync_name, last_success_at, last_attempt_at, status, high_watermark)
+               VALUES (?, ?, ?, 'ok', ?)
+               ON CONFLICT(sync_name) DO UPDATE SET
+                   last_success_at=excluded.last_success_at, last_attempt_at=excluded.last_attempt_at,
+                   status='ok', high_watermark=excluded.high_watermark""",
+            (state_name, now, now, str(watermark)),
         )
 
 
@@ -118,6 +157,9 @@ def _sync_outbox(
     matches its last synchronized baseline. Tombstones physically remove the
     Sheet row while retaining the canonical Turso history.
     """
+    # Events are claimed by their outbox id, which only the remote's own rows
+    # carry; in write-behind mode delivery therefore skips the local journal.
+    db_config = write_behind_remote_config(db_config)
     if initialize_schema:
         initialize_database_from_config(db_config)
     result = ExportResult(sheet_name=sheet_name, dry_run=dry_run)
@@ -10,13 +10,20 @@ silently overwriting local SQLite changes.
 
 from __future__ import annotations
 
+import concurrent.futures
 import hashlib
 import json
+import operator
+import re
+import threading
 import time
 import uuid
 from dataclasses import dataclass, field
 from typing import Any, Callable, Iterable
 
+import numpy as np
+import pandas as pd
+
 from .database import (
     DatabaseConfig,
     connect_from_config,
@@ -26,6 +33,8 @@ from .database import (
     upsert_sheet_row,
     utc_now_iso,
 )
+from .recipe_repository import refresh_recipe_usage_vectors
+from .stock_repository import iso_day, refresh_powder_stock_balances, write_order_powder_consumption
 
 SHEET_KEY_COLUMNS = {
     "色粉管理": "色粉編號",
@@ -42,7 +51,28 @@ UPDATED_AT_COLUMNS = ["updated_at", "更新時間", "修改時間", "last_modifi
 COLOR_COLUMNS = ["色粉編號", "國際色號", "名稱", "色粉類別", "包裝", "備註"]
 INVENTORY_COLUMNS = ["類型", "色粉編號", "日期", "數量", "單位", "備註", "廠商編號", "廠商名稱", "_sync_id"]
 RECIPE_COMPONENT_POSITIONS = range(1, 9)
+PREFETCH_CHUNK_SIZE = 500
+IMPORT_CHECKPOINT_STATE = "import_checkpoint:{sheet_name}"
+IMPORT_MAX_WORKERS = 4
+# Sheets whose IDs a sheet references; they must be applied before it.
+SHEET_DEPENDENCIES = {
+    "配方管理": ("色粉管理",),
+    "生產單": ("配方管理",),
+    "庫存記錄": ("色粉管理", "供應商管理"),
+}
+# Entity table and key column checked for conflicts before a changed row is applied.
+ENTITY_LOOKUPS = {
+    "色粉管理": ("color_powders", "colorpowder_id"),
+    "供應商管理": ("suppliers", "supplier_id"),
+    "配方管理": ("recipes", "recipe_id"),
+    "生產單": ("production_orders", "production_order_id"),
+    "庫存記錄": ("inventory_movements", "movement_key"),
+}
 TRANSIENT_GOOGLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Worksheet objects (title -> worksheet, carrying gid and row count) per
+# spreadsheet id, loaded with one metadata request per process.
+_WORKSHEET_CACHE: dict[str, dict[str, Any]] = {}
+_WORKSHEET_CACHE_LOCK = threading.Lock()
 
 
 class SheetReadError(RuntimeError):
@@ -61,19 +91,57 @@ def _google_api_status_code(exc: Exception) -> int | None:
     return None
 
 
+class SharedBackoff:
+    """A pause shared by concurrent reads, so one rate limit slows every reader."""
+
+    def __init__(self, *, clock: Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def defer(self, seconds: float) -> None:
+        with self._lock:
+            self._resume_at = max(self._resume_at, self._clock() + seconds)
+
+    def remaining(self) -> float:
+        with self._lock:
+            return max(0.0, self._resume_at - self._clock())
+
+
 def read_worksheet_values_with_retry(
     worksheet,
     *,
     attempts: int = 4,
     base_delay_seconds: float = 1.0,
     sleep: Callable[[float], None] = time.sleep,
+    backoff: SharedBackoff | None = None,
 ) -> list[list[Any]]:
-    """Read one worksheet, retrying only transient Google/API failures."""
+    """Read one worksheet, retrying only transient Google/API failures.
+
+    With a shared ``backoff`` every retry delay is published to the other
+    readers, and each attempt first waits out the longest pending delay.
+    """
+    return _call_with_retry(
+        worksheet.get_all_values,
+        attempts=attempts, base_delay_seconds=base_delay_seconds, sleep=sleep, backoff=backoff,
+    )
+
+
+def _call_with_retry(
+    request: Callable[[], Any],
+    *,
+    attempts: int,
+    base_delay_seconds: float,
+    sleep: Callable[[float], None],
+    backoff: SharedBackoff | None,
+) -> Any:
     if attempts < 1:
         raise ValueError("attempts must be at least 1")
     for attempt in range(1, attempts + 1):
+        if backoff is not None and (pause := backoff.remaining()) > 0:
+            sleep(pause)
         try:
-            return worksheet.get_all_values()
+            return request()
         except Exception as exc:
             status = _google_api_status_code(exc)
             is_transient = status in TRANSIENT_GOOGLE_STATUS_CODES
@@ -84,7 +152,120 @@ def read_worksheet_values_with_retry(
                     f"Google Sheets read failed ({status_text}){retry_text}. "
                     "Please wait 30 seconds and try again."
                 ) from exc
-            sleep(base_delay_seconds * (2 ** (attempt - 1)))
+            delay = base_delay_seconds * (2 ** (attempt - 1))
+            if backoff is None:
+                sleep(delay)
+            else:
+                backoff.defer(delay)
+
+
+def cached_worksheets(spreadsheet, *, refresh: bool = False) -> dict[str, Any]:
+    """Worksheets by title from one ``spreadsheet.worksheets()`` call, kept for the process lifetime."""
+    key = getattr(spreadsheet, "id", None)
+    with _WORKSHEET_CACHE_LOCK:
+        if key is not None and not refresh and key in _WORKSHEET_CACHE:
+            return _WORKSHEET_CACHE[key]
+    worksheets = {worksheet.title: worksheet for worksheet in spreadsheet.worksheets()}
+    if key is not None:
+        with _WORKSHEET_CACHE_LOCK:
+            _WORKSHEET_CACHE[key] = worksheets
+    return worksheets
+
+
+def cached_worksheet(spreadsheet, title: str):
+    """One worksheet from the metadata cache; unknown titles refresh it once before ``spreadsheet.worksheet``."""
+    if not hasattr(spreadsheet, "worksheets"):
+        return spreadsheet.worksheet(title)
+    worksheets = cached_worksheets(spreadsheet)
+    if title not in worksheets:
+        worksheets = cached_worksheets(spreadsheet, refresh=True)
+    # spreadsheet.worksheet raises the usual WorksheetNotFound for a missing title.
+    return worksheets[title] if title in worksheets else spreadsheet.worksheet(title)
+
+
+def _sheet_range(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+
+def read_worksheets_values(
+    spreadsheet,
+    sheet_names: Iterable[str],
+    *,
+    attempts: int = 4,
+    base_delay_seconds: float = 1.0,
+    sleep: Callable[[float], None] = time.sleep,
+    backoff: SharedBackoff | None = None,
+    max_workers: int = IMPORT_MAX_WORKERS,
+) -> dict[str, list[list[Any]]]:
+    """Read many worksheets with one ``values_batch_get`` request, retried like a single read.
+
+    Titles are checked against ``cached_worksheets`` first, so a missing sheet
+    raises the usual ``WorksheetNotFound`` before any values are requested.
+    Rows are padded to a rectangle,
+    matching ``get_all_values``.  Spreadsheets without ``values_batch_get``
+    fall back to concurrent ``read_worksheet_values_with_retry`` calls.
+    """
+    names = list(dict.fromkeys(sheet_names))
+    if not names:
+        return {}
+    if not hasattr(spreadsheet, "values_batch_get"):
+        backoff = backoff or SharedBackoff()
+        futures = run_per_sheet(
+            names,
+            lambda name: read_worksheet_values_with_retry(
+                spreadsheet.worksheet(name),
+                attempts=attempts, base_delay_seconds=base_delay_seconds, sleep=sleep, backoff=backoff,
+            ),
+            max_workers=max_workers,
+        )
+        return {name: futures[name].result() for name in names}
+    for name in names:
+        cached_worksheet(spreadsheet, name)
+    response = _call_with_retry(
+        lambda: spreadsheet.values_batch_get([_sheet_range(name) for name in names]),
+        attempts=attempts, base_delay_seconds=base_delay_seconds, sleep=sleep, backoff=backoff,
+    )
+    value_ranges = response.get("valueRanges", [])
+    if len(value_ranges) != len(names):
+        raise SheetReadError(
+            f"Google Sheets batch read returned {len(value_ranges)} ranges for {len(names)} worksheets."
+        )
+    results = {}
+    for name, value_range in zip(names, value_ranges):
+        rows = value_range.get("values", [])
+        width = max(map(len, rows), default=0)
+        results[name] = [list(row) + [""] * (width - len(row)) for row in rows]
+    return results
+
+
+def import_order(sheet_names: Iterable[str]) -> list[str]:
+    """Selected sheets ordered so each comes after the selected sheets it references."""
+    names = list(dict.fromkeys(sheet_names))
+    ordered: list[str] = []
+    while len(ordered) < len(names):
+        ready = [
+            name for name in names
+            if name not in ordered
+            and all(dependency in ordered or dependency not in names for dependency in SHEET_DEPENDENCIES.get(name, ()))
+        ]
+        if not ready:
+            raise ValueError(f"Circular worksheet dependencies: {', '.join(n for n in names if n not in ordered)}")
+        ordered.extend(ready)
+    return ordered
+
+
+def run_per_sheet(
+    sheet_names: Iterable[str],
+    task: Callable[[str], Any],
+    *,
+    max_workers: int = IMPORT_MAX_WORKERS,
+) -> dict[str, concurrent.futures.Future]:
+    """Run ``task(sheet_name)`` for every sheet on a bounded pool; returns the finished futures."""
+    names = list(dict.fromkeys(sheet_names))
+    if not names:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names)))) as pool:
+        return {name: pool.submit(task, name) for name in names}
 
 
 @dataclass
@@ -102,6 +283,14 @@ class ImportResult:
     errors: list[str] = field(default_factory=list)
     duplicate_ids: list[str] = field(default_factory=list)
     warnings: list[str] = field(default_factory=list)
+    # Planner reads issued against the database (apply-phase writes excluded)
+    # and wall-clock seconds spent in each import phase.
+    round_trips: int = 0
+    phase_seconds: dict[str, float] = field(default_factory=dict)
+    # Chunked apply: transactions committed by this run and the checkpointed
+    # row index (0-based, below the header) a resumed run started after.
+    chunks_committed: int = 0
+    resumed_after_row: int | None = None
 
     @property
     def ok(self) -> bool:
@@ -160,6 +349,139 @@ def _records_from_values(values: list[list[Any]]) -> list[dict[str, str]]:
     return records
 
 
+# Characters json.dumps(ensure_ascii=False) escapes inside a string value.
+_JSON_ESCAPED = re.compile(r'[\x00-\x1f\\"]')
+
+
+@dataclass
+class SheetDiff:
+    """Columnar classification of worksheet rows against ``sheet_rows`` baselines.
+
+    Row keys and hashes match ``_row_key`` and ``_row_hash`` of the per-row
+    records exactly; indices are 0-based positions below the header row.
+    """
+
+    headers: list[str]
+    columns: list[list[str]]
+    row_keys: list[str]
+    row_hashes: list[str]
+    missing_keys: list[int] = field(default_factory=list)
+    duplicate_ids: list[str] = field(default_factory=list)
+    inserts: list[int] = field(default_factory=list)
+    updates: list[int] = field(default_factory=list)
+    unchanged: int = 0
+    has_updated_at: bool = False
+
+    @property
+    def row_count(self) -> int:
+        return len(self.row_keys)
+
+    @property
+    def fingerprint(self) -> str:
+        """SHA-256 over the ordered row hashes; changes whenever any cell, header or row order does."""
+        return hashlib.sha256("\n".join(self.row_hashes).encode("utf-8")).hexdigest()
+
+    @property
+    def changed(self) -> list[int]:
+        return sorted(self.inserts + self.updates)
+
+    def records(self, indices: Iterable[int]) -> list[dict[str, str]]:
+        return [dict(zip(self.headers, (column[index] for column in self.columns))) for index in indices]
+
+
+def _clean_columns(values: list[list[Any]]) -> tuple[list[str], list[list[str]]]:
+    """Stripped string cells, one column per distinct header (the last duplicate wins, like a dict)."""
+    header_positions: dict[str, int] = {}
+    for position, header in enumerate(str(h).strip() for h in values[0]):
+        if header:
+            header_positions[header] = position
+    body = values[1:]
+    width = max(header_positions.values(), default=-1) + 1
+    if any(len(row) < width for row in body):
+        body = [row if len(row) >= width else list(row) + [""] * (width - len(row)) for row in body]
+    columns = []
+    for position in header_positions.values():
+        cells = list(map(operator.itemgetter(position), body))
+        try:
+            columns.append(list(map(str.strip, cells)))
+        except TypeError:
+            columns.append([str(cell).strip() for cell in cells])
+    return list(header_positions), columns
+
+
+def _json_string_bodies(column: list[str]) -> list[str]:
+    """JSON-escaped contents (without quotes) of every cell in the column.
+
+    Columns without a quote, backslash or control character are used as is.
+    Otherwise one json.dumps call encodes the whole column: inside the encoded
+    list every quote of a value is escaped, so ``", "`` only ever occurs
+    between two elements and splitting on it is exact.
+    """
+    if not column or not _JSON_ESCAPED.search("".join(column)):
+        return column
+    return json.dumps(column, ensure_ascii=False)[2:-2].split('", "')
+
+
+def _column_row_hashes(headers: list[str], columns: list[list[str]], row_count: int) -> list[str]:
+    """SHA-256 of each row's sorted-key JSON (``_row_hash``), formatted from escaped columns."""
+    ordered = sorted(zip(headers, columns))
+    template = "{" + ", ".join(
+        json.dumps(header, ensure_ascii=False).replace("%", "%%") + ': "%s"' for header, _ in ordered
+    ) + "}"
+    if not ordered:
+        return [hashlib.sha256(template.encode("utf-8")).hexdigest()] * row_count
+    documents = map(template.__mod__, zip(*(_json_string_bodies(column) for _, column in ordered)))
+    return [hashlib.sha256(document.encode("utf-8")).hexdigest() for document in documents]
+
+
+def _column_row_keys(sheet_name: str, headers: list[str], columns: list[list[str]], row_count: int) -> list[str]:
+    by_header = dict(zip(headers, columns))
+    key_column = SHEET_KEY_COLUMNS.get(sheet_name)
+    keys = by_header.get(key_column, [""] * row_count)
+    if sheet_name == "供應商管理":
+        for column in SUPPLIER_ID_COLUMNS:
+            if column in by_header:
+                keys = [key or fallback for key, fallback in zip(keys, by_header[column])]
+    if sheet_name == "庫存記錄":
+        return list(keys)
+    return [key or f"row-{index + 2}" for index, key in enumerate(keys)]
+
+
+def diff_sheet_values(sheet_name: str, values: list[list[Any]], baseline_hashes: dict[str, str]) -> SheetDiff:
+    """Classify worksheet rows as insert/update/unchanged/duplicate/missing-key in bulk.
+
+    Produces the same counts, duplicate IDs and hashes as walking
+    ``_records_from_values`` row by row, but transposes the sheet once and
+    escapes, formats and compares whole columns instead of building a dict
+    and a JSON document per row.
+    """
+    if not values:
+        return SheetDiff(headers=[], columns=[], row_keys=[], row_hashes=[])
+    headers, columns = _clean_columns(values)
+    row_count = len(values) - 1
+    keys = pd.Series(_column_row_keys(sheet_name, headers, columns, row_count), dtype=object)
+    hashes = _column_row_hashes(headers, columns, row_count)
+    missing = keys == ""
+    duplicate = keys.duplicated(keep="first") & ~missing
+    baseline = keys.map(baseline_hashes)
+    candidate = ~missing & ~duplicate
+    existed = candidate & baseline.notna()
+    changed = candidate & (baseline != pd.Series(hashes, dtype=object))
+    by_header = dict(zip(headers, columns))
+    return SheetDiff(
+        headers=headers,
+        columns=columns,
+        row_keys=keys.tolist(),
+        row_hashes=hashes,
+        missing_keys=np.flatnonzero(missing).tolist(),
+        duplicate_ids=keys[duplicate].tolist(),
+        inserts=np.flatnonzero(changed & ~existed).tolist(),
+        updates=np.flatnonzero(changed & existed).tolist(),
+        unchanged=int((existed & ~changed).sum()),
+        has_updated_at=any(any(by_header[column]) for column in UPDATED_AT_COLUMNS if column in by_header),
+    )
+
+
 def _first_value(row: dict[str, Any], columns: list[str]) -> str:
     for col in columns:
         value = str(row.get(col, "")).strip()
@@ -237,6 +559,47 @@ def _fetchall_mappings(cursor) -> list[dict[str, Any]]:
     return [dict(zip(columns, row)) for row in rows]
 
 
+def _entity_key(sheet_name: str, row: dict[str, Any], row_key: str) -> str:
+    if sheet_name == "供應商管理":
+        return _supplier_id(row, row_key)
+    if sheet_name == "庫存記錄":
+        return _inventory_movement_key(sheet_name, row_key)
+    key_column = {"色粉管理": "色粉編號", "配方管理": "配方編號", "生產單": "生產單號"}.get(sheet_name)
+    return row.get(key_column, "").strip() if key_column else ""
+
+
+def _referenced_ids(sheet_name: str, rows: Iterable[dict[str, Any]]) -> dict[str, set[str]]:
+    """Foreign keys the changed rows point at, grouped by the table that must contain them."""
+    powder_ids: set[str] = set()
+    supplier_ids: set[str] = set()
+    recipe_ids: set[str] = set()
+    for row in rows:
+        if sheet_name == "配方管理":
+            powder_ids |= {row.get(f"色粉編號{position}", "").strip() for position in RECIPE_COMPONENT_POSITIONS}
+        elif sheet_name == "庫存記錄":
+            powder_ids.add(row.get("色粉編號", "").strip())
+            supplier_ids.add(row.get("廠商編號", "").strip())
+        elif sheet_name == "生產單":
+            recipe_ids.add(row.get("配方編號", "").strip())
+    references = {"color_powders": powder_ids, "suppliers": supplier_ids, "recipes": recipe_ids}
+    return {table: ids - {""} for table, ids in references.items() if ids - {""}}
+
+
+def _prefetch_by_key(conn, table: str, column: str, keys: Iterable[str], *, columns: str = "*") -> tuple[dict[str, dict[str, Any]], int]:
+    """Load the rows matching ``keys`` with chunked ``IN (...)`` queries; returns rows by key and query count."""
+    wanted = list(dict.fromkeys(keys))
+    found: dict[str, dict[str, Any]] = {}
+    queries = 0
+    for start in range(0, len(wanted), PREFETCH_CHUNK_SIZE):
+        chunk = wanted[start:start + PREFETCH_CHUNK_SIZE]
+        rows = _fetchall_mappings(conn.execute(
+            f"SELECT {columns} FROM {table} WHERE {column} IN ({', '.join('?' for _ in chunk)})", chunk,
+        ))
+        queries += 1
+        found.update({str(row[column]): row for row in rows})
+    return found, queries
+
+
 def _row_changed_in_sqlite(conn, sheet_name: str, row_key: str, row_hash: str) -> tuple[bool, bool]:
     existing = _fetchone_mapping(conn.execute(
         "SELECT row_hash FROM sheet_rows WHERE sheet_name = ? AND row_key = ?",
@@ -247,6 +610,28 @@ def _row_changed_in_sqlite(conn, sheet_name: str, row_key: str, row_hash: str) -
     return existing["row_hash"] != row_hash, True
 
 
+def _read_import_checkpoint(conn, state_name: str) -> tuple[str, int] | None:
+    """Return ``(values fingerprint, last row index)`` of an unfinished chunked import."""
+    state = _fetchone_mapping(conn.execute(
+        "SELECT status, message, high_watermark FROM sync_state WHERE sync_name = ?", (state_name,)
+    ))
+    if state is None or state["status"] != "in_progress" or not state["high_watermark"]:
+        return None
+    return str(state["message"] or ""), int(state["high_watermark"])
+
+
+def _write_import_checkpoint(conn, state_name: str, fingerprint: str, last_index: int, status: str) -> None:
+    now = utc_now_iso()
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, last_success_at, last_attempt_at, status, message, high_watermark)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(sync_name) DO UPDATE SET
+               last_success_at=excluded.last_success_at, last_attempt_at=excluded.last_attempt_at,
+               status=excluded.status, message=excluded.message, high_watermark=excluded.high_watermark""",
+        (state_name, now, now, status, fingerprint, str(last_index)),
+    )
+
+
 def _entity_changed_since_sync(entity_row) -> bool:
     if entity_row is None:
         return False
@@ -264,6 +649,7 @@ def import_sheet_values(
     dry_run: bool = False,
     initialize_schema: bool = True,
     abort_on_issues: bool = False,
+    chunk_size: int | None = None,
 ) -> ImportResult:
     """Validate/copy worksheet values into local SQLite or configured Turso.
 
@@ -274,18 +660,38 @@ def import_sheet_values(
     to keep an interactive dry-run free of schema-maintenance statements. Set
     ``abort_on_issues=True`` for a formal import that must roll back completely
     when any validation error, duplicate, or conflict is found.
+
+    Rows are first planned against the ``sheet_rows`` baselines in memory;
+    the entities and referenced IDs of the changed rows are then prefetched
+    with chunked ``IN (...)`` queries, so conflict checks cost no per-row
+    reads.  ``round_trips`` and ``phase_seconds`` on the result report both.
+
+    ``chunk_size`` commits a formal import every that many planned rows and
+    records ``IMPORT_CHECKPOINT_STATE`` (values fingerprint and last row
+    index) in ``sync_state`` with each commit.  A rerun over the same values
+    resumes after the checkpoint; different values discard it.  Chunking
+    cannot be combined with the all-or-nothing ``abort_on_issues``.
     """
     if db_config is not None and db_path is not None:
         raise ValueError("Pass either db_config or db_path, not both.")
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    if chunk_size is not None and abort_on_issues:
+        raise ValueError("chunk_size commits partial imports; it cannot be combined with abort_on_issues")
     config = db_config or DatabaseConfig(backend="sqlite", path=db_path)
     if initialize_schema:
         initialize_database_from_config(config)
     result = ImportResult(sheet_name=sheet_name, dry_run=dry_run)
-    rows = _records_from_values(values)
-    result.sheet_rows = len(rows)
-    seen: set[str] = set()
+    phase_started = time.perf_counter()
+    stock_powder_ids: set[str] = set()
     started_at = utc_now_iso()
 
+    def end_phase(name: str) -> None:
+        nonlocal phase_started
+        now = time.perf_counter()
+        result.phase_seconds[name] = round(now - phase_started, 6)
+        phase_started = now
+
     with connect_from_config(config) as conn:
         baseline_hashes = {
             str(db_row["row_key"]): str(db_row["row_hash"])
@@ -294,59 +700,106 @@ def import_sheet_values(
                 (sheet_name,),
             ))
         }
-        known_inventory_powder_ids: set[str] | None = None
-        known_inventory_supplier_ids: set[str] | None = None
-        if sheet_name == "庫存記錄":
-            known_inventory_powder_ids = {
-                str(db_row[0]).strip()
-                for db_row in conn.execute("SELECT colorpowder_id FROM color_powders").fetchall()
-            }
-            known_inventory_supplier_ids = {
-                str(db_row[0]).strip()
-                for db_row in conn.execute("SELECT supplier_id FROM suppliers").fetchall()
-            }
-        known_recipe_powder_ids: set[str] | None = None
-        if sheet_name == "配方管理":
-            known_recipe_powder_ids = {
-                str(db_row[0]).strip()
-                for db_row in conn.execute("SELECT colorpowder_id FROM color_powders").fetchall()
-            }
-        known_production_recipe_ids: set[str] | None = None
-        if sheet_name == "生產單":
-            known_production_recipe_ids = {
-                str(db_row[0]).strip()
-                for db_row in conn.execute("SELECT recipe_id FROM recipes").fetchall()
-            }
-        for index, row in enumerate(rows):
-            row_key = _row_key(sheet_name, row, index)
-            if not row_key:
-                missing_column = "_sync_id" if sheet_name == "庫存記錄" else "required ID"
-                result.errors.append(f"row {index + 2}: missing {missing_column}")
-                continue
-            if row_key in seen:
-                result.duplicate_ids.append(row_key)
-                continue
-            seen.add(row_key)
+        result.round_trips += 1
 
-            row_hash = _row_hash(row)
-            existed = row_key in baseline_hashes
-            changed = not existed or baseline_hashes[row_key] != row_hash
-            if not changed:
-                result.unchanged += 1
+        # Plan: classify every row against the baselines in memory, column by
+        # column.  Missing keys stay in row order with the changed rows so
+        # errors keep their order.
+        diff = diff_sheet_values(sheet_name, values, baseline_hashes)
+        result.sheet_rows = diff.row_count
+        result.duplicate_ids.extend(diff.duplicate_ids)
+        result.unchanged = diff.unchanged
+        result.to_insert = len(diff.inserts)
+        result.to_update = len(diff.updates)
+        missing_column = "_sync_id" if sheet_name == "庫存記錄" else "required ID"
+        missing = {index: f"row {index + 2}: missing {missing_column}" for index in diff.missing_keys}
+        chunked = chunk_size is not None and not dry_run
+        checkpoint_name = IMPORT_CHECKPOINT_STATE.format(sheet_name=sheet_name)
+        fingerprint = diff.fingerprint if chunked else ""
+        plan_indices = sorted([*missing, *diff.changed])
+        if chunked:
+            checkpoint = _read_import_checkpoint(conn, checkpoint_name)
+            result.round_trips += 1
+            if checkpoint is not None and checkpoint[0] == fingerprint:
+                # Rows up to the checkpoint were committed (or reported) by
+                # the interrupted run; their baselines already match.
+                result.resumed_after_row = checkpoint[1]
+                plan_indices = [index for index in plan_indices if index > checkpoint[1]]
+                result.warnings.append(
+                    f"Resumed chunked import after row {checkpoint[1] + 2}; "
+                    "issues before it were reported by the interrupted run."
+                )
+            elif checkpoint is not None:
+                result.warnings.append("Discarded import checkpoint: worksheet values changed since it was written.")
+        changed_indices = [index for index in plan_indices if index not in missing]
+        records = dict(zip(changed_indices, diff.records(changed_indices)))
+        plan: list[tuple[int, dict[str, str], str, str, bool] | str] = []
+        for index in plan_indices:
+            if index in missing:
+                plan.append(missing[index])
                 continue
-            if existed:
-                result.to_update += 1
-            else:
-                result.to_insert += 1
+            row_key = diff.row_keys[index]
+            plan.append((index, records[index], row_key, diff.row_hashes[index], row_key in baseline_hashes))
+        changed_rows = [step for step in plan if not isinstance(step, str)]
+        end_phase("plan")
+
+        # Prefetch: every entity and referenced ID the changed rows need, in
+        # chunked IN (...) queries, so conflict checks run in memory.
+        entities: dict[str, dict[str, Any]] = {}
+        entity_table, entity_column = ENTITY_LOOKUPS.get(sheet_name, ("", ""))
+        if entity_table and changed_rows:
+            entities, queries = _prefetch_by_key(
+                conn, entity_table, entity_column,
+                (_entity_key(sheet_name, row, row_key) for _, row, row_key, _, _ in changed_rows),
+            )
+            result.round_trips += queries
+        known_ids: dict[str, set[str]] = {}
+        for table, ids in _referenced_ids(sheet_name, (step[1] for step in changed_rows)).items():
+            column = {"color_powders": "colorpowder_id", "suppliers": "supplier_id", "recipes": "recipe_id"}[table]
+            found, queries = _prefetch_by_key(conn, table, column, ids, columns=column)
+            known_ids[table] = set(found)
+            result.round_trips += queries
+        known_inventory_powder_ids = known_recipe_powder_ids = known_ids.get("color_powders", set())
+        known_inventory_supplier_ids = known_ids.get("suppliers", set())
+        known_production_recipe_ids = known_ids.get("recipes", set())
+        written: set[str] = set()
+
+        def lookup_entity(key: str) -> dict[str, Any] | None:
+            # A key this run already wrote (e.g. two rows sharing an ID) is
+            # re-read so later rows see the row exactly as before batching.
+            if key in written:
+                result.round_trips += 1
+                return _fetchone_mapping(conn.execute(
+                    f"SELECT * FROM {entity_table} WHERE {entity_column} = ?", (key,)
+                ))
+            return entities.get(key)
 
+        def commit_chunk(last_index: int, status: str) -> None:
+            # Stock balances and the checkpoint commit together with the rows.
+            if stock_powder_ids:
+                refresh_powder_stock_balances(conn, stock_powder_ids)
+                stock_powder_ids.clear()
+            _write_import_checkpoint(conn, checkpoint_name, fingerprint, last_index, status)
+            if status == "in_progress":
+                conn.commit()
+            result.chunks_committed += 1
+
+        end_phase("prefetch")
+
+        for position, step in enumerate(plan):
+            if chunked and position and position % chunk_size == 0:
+                commit_chunk(plan_indices[position - 1], "in_progress")
+            if isinstance(step, str):
+                result.errors.append(step)
+                continue
+            index, row, row_key, row_hash, existed = step
+            changed = True
             if sheet_name == "色粉管理":
                 powder_id = row.get("色粉編號", "").strip()
                 if not powder_id:
                     result.errors.append(f"row {index + 2}: missing 色粉編號")
                     continue
-                entity = _fetchone_mapping(
-                    conn.execute("SELECT * FROM color_powders WHERE colorpowder_id = ?", (powder_id,))
-                )
+                entity = lookup_entity(powder_id)
                 if not existed and entity is not None:
                     result.conflicts += 1
                     if not dry_run:
@@ -383,6 +836,7 @@ def import_sheet_values(
                         (powder_id, row.get("國際色號", ""), row.get("名稱", ""), row.get("色粉類別", ""),
                          row.get("包裝", ""), row.get("備註", ""), synced_at, _sheet_updated_at(row) or (entity["updated_at"] if entity else synced_at), synced_at),
                     )
+                    written.add(powder_id)
                     result.inserted_or_updated += 1
 
             elif sheet_name == "供應商管理":
@@ -391,9 +845,7 @@ def import_sheet_values(
                     result.errors.append(f"row {index + 2}: missing 供應商名稱")
                     continue
                 supplier_id = _supplier_id(row, row_key)
-                entity = _fetchone_mapping(
-                    conn.execute("SELECT * FROM suppliers WHERE supplier_id = ?", (supplier_id,))
-                )
+                entity = lookup_entity(supplier_id)
                 if not existed and entity is not None:
                     result.conflicts += 1
                     if not dry_run:
@@ -431,6 +883,7 @@ def import_sheet_values(
                         "INSERT OR IGNORE INTO supplier_aliases(alias, supplier_id, created_at) VALUES (?, ?, ?)",
                         (name, supplier_id, synced_at),
                     )
+                    written.add(supplier_id)
                     result.inserted_or_updated += 1
 
             elif sheet_name == "配方管理":
@@ -459,9 +912,7 @@ def import_sheet_values(
                     components.append((position, powder_id, _safe_float(weight_text)))
                 if component_error:
                     continue
-                entity = _fetchone_mapping(
-                    conn.execute("SELECT * FROM recipes WHERE recipe_id = ?", (recipe_id,))
-                )
+                entity = lookup_entity(recipe_id)
                 if not existed and entity is not None:
                     result.conflicts += 1
                     if not dry_run:
@@ -557,6 +1008,10 @@ def import_sheet_values(
                                ) VALUES (?, ?, ?, ?, ?, ?)""",
                             (recipe_id, position, powder_id, weight, synced_at, synced_at),
                         )
+                    refresh_recipe_usage_vectors(conn, {
+                        recipe_id, row.get("原始配方"), (entity or {}).get("original_recipe"),
+                    })
+                    written.add(recipe_id)
                     result.inserted_or_updated += 1
 
             elif sheet_name == "生產單":
@@ -565,9 +1020,7 @@ def import_sheet_values(
                 if recipe_id and known_production_recipe_ids is not None and recipe_id not in known_production_recipe_ids:
                     result.errors.append(f"row {index + 2}: unknown 配方編號 {recipe_id}; import 配方管理 first")
                     continue
-                entity = _fetchone_mapping(conn.execute(
-                    "SELECT * FROM production_orders WHERE production_order_id=?", (order_id,)
-                ))
+                entity = lookup_entity(order_id)
                 if not existed and entity is not None:
                     result.conflicts += 1
                     if not dry_run:
@@ -588,17 +1041,18 @@ def import_sheet_values(
                     upsert_sheet_row(conn, sheet_name, row_key, row, row_hash, _sheet_updated_at(row))
                     conn.execute(
                         """INSERT INTO production_orders(
-                               production_order_id, production_date, recipe_id, color, customer_name,
-                               payload_json, source, created_at, updated_at, last_synced_at)
-                           VALUES (?, ?, ?, ?, ?, ?, 'google_sheets_import', ?, ?, ?)
+                               production_order_id, production_date, production_day, recipe_id, color,
+                               customer_name, payload_json, source, created_at, updated_at, last_synced_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, 'google_sheets_import', ?, ?, ?)
                            ON CONFLICT(production_order_id) DO UPDATE SET
-                               production_date=excluded.production_date, recipe_id=excluded.recipe_id,
+                               production_date=excluded.production_date,
+                               production_day=excluded.production_day, recipe_id=excluded.recipe_id,
                                color=excluded.color, customer_name=excluded.customer_name,
                                payload_json=excluded.payload_json, source=excluded.source,
                                version=production_orders.version+1, updated_at=excluded.updated_at,
                                last_synced_at=excluded.last_synced_at""",
                         (
-                            order_id, row.get("生產日期", ""), recipe_id or None,
+                            order_id, row.get("生產日期", ""), iso_day(row.get("生產日期")), recipe_id or None,
                             row.get("顏色", ""), row.get("客戶名稱", ""),
                             json.dumps(row, ensure_ascii=False), synced_at,
                             _sheet_updated_at(row) or synced_at, synced_at,
@@ -615,6 +1069,8 @@ def import_sheet_values(
                                        created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)""",
                                 (order_id, position, weight, count, synced_at, synced_at),
                             )
+                    stock_powder_ids |= write_order_powder_consumption(conn, order_id)
+                    written.add(order_id)
                     result.inserted_or_updated += 1
 
             elif sheet_name == "庫存記錄":
@@ -638,11 +1094,7 @@ def import_sheet_values(
                     )
                     continue
                 movement_key = _inventory_movement_key(sheet_name, row_key)
-                existing_movement = _fetchone_mapping(
-                    conn.execute(
-                        "SELECT * FROM inventory_movements WHERE movement_key = ?", (movement_key,)
-                    )
-                )
+                existing_movement = lookup_entity(movement_key)
                 if existing_movement and changed:
                     result.inventory_duplicate_risk += 1
                 if not existed and existing_movement is not None:
@@ -669,13 +1121,14 @@ def import_sheet_values(
                     upsert_sheet_row(conn, sheet_name, row_key, row, row_hash, _sheet_updated_at(row))
                     conn.execute(
                         """INSERT INTO inventory_movements(movement_key, sheet_name, sheet_row_key, movement_type,
-                               colorpowder_id, movement_date, quantity, unit, notes, supplier_id, supplier_name,
-                               source, created_at, updated_at, last_synced_at)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'google_sheets_import', ?, ?, ?)
+                               colorpowder_id, movement_date, movement_day, quantity, unit, notes, supplier_id,
+                               supplier_name, source, created_at, updated_at, last_synced_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'google_sheets_import', ?, ?, ?)
                            ON CONFLICT(movement_key) DO UPDATE SET
                                movement_type=excluded.movement_type,
                                colorpowder_id=excluded.colorpowder_id,
                                movement_date=excluded.movement_date,
+                               movement_day=excluded.movement_day,
                                quantity=excluded.quantity,
                                unit=excluded.unit,
                                notes=excluded.notes,
@@ -683,10 +1136,15 @@ def import_sheet_values(
                                supplier_name=excluded.supplier_name,
                                last_synced_at=excluded.last_synced_at""",
                         (movement_key, sheet_name, row_key, row.get("類型", ""), powder_id, row.get("日期", ""),
+                         iso_day(row.get("日期")),
                          _safe_float(row.get("數量", 0)), row.get("單位", "g") or "g", row.get("備註", ""),
                          supplier_id, row.get("廠商名稱", ""),
                          synced_at, _sheet_updated_at(row) or (existing_movement["updated_at"] if existing_movement else synced_at), synced_at),
                     )
+                    stock_powder_ids.add(powder_id)
+                    if existing_movement:
+                        stock_powder_ids.add(str(existing_movement["colorpowder_id"] or ""))
+                    written.add(movement_key)
                     result.inserted_or_updated += 1
 
             else:
@@ -697,8 +1155,14 @@ def import_sheet_values(
         result.sqlite_rows = conn.execute(
             "SELECT COUNT(*) FROM sheet_rows WHERE sheet_name = ?", (sheet_name,)
         ).fetchone()[0]
+        result.round_trips += 1
+        end_phase("apply")
         if not dry_run and abort_on_issues and not result.ok:
             raise ImportAbortedError(result)
+        if chunked:
+            commit_chunk(plan_indices[-1] if plan_indices else diff.row_count - 1, "completed")
+        if not dry_run and stock_powder_ids:
+            refresh_powder_stock_balances(conn, stock_powder_ids)
         if dry_run:
             conn.rollback()
         else:
@@ -708,7 +1172,8 @@ def import_sheet_values(
                             read_count=result.sheet_rows, written_count=result.inserted_or_updated,
                             error_count=len(result.errors) + len(result.duplicate_ids) + result.conflicts,
                             message="; ".join((result.errors + result.warnings)[:5]))
-    if not any(_sheet_updated_at(row) for row in rows):
+    end_phase("commit")
+    if not diff.has_updated_at:
         result.warnings.append(
             "Sheet has no explicit updated_at/更新時間 column; row_hash is used for change detection, "
             "and conflicts protect database edits, including Turso."
@@ -723,19 +1188,33 @@ def import_worksheets(
     *,
     db_config: DatabaseConfig | None = None,
     dry_run: bool = False,
+    chunk_size: int | None = None,
+    max_workers: int = IMPORT_MAX_WORKERS,
 ) -> list[ImportResult]:
-    """Read selected worksheets and validate/copy them into SQLite or Turso."""
-    names = list(sheet_names or SHEET_KEY_COLUMNS.keys())
-    results = []
-    for name in names:
-        ws = spreadsheet.worksheet(name)
-        results.append(
-            import_sheet_values(
-                name,
-                read_worksheet_values_with_retry(ws),
-                db_path=db_path,
-                db_config=db_config,
-                dry_run=dry_run,
-            )
+    """Read selected worksheets and validate/copy them into SQLite or Turso.
+
+    All worksheets are fetched by ``read_worksheets_values`` in one batched
+    request and dry-run preflights run in parallel, so a pass takes about as
+    long as the slowest sheet.  Writes only start once every read succeeded and follow
+    ``import_order``.  Results keep the order of ``sheet_names``.
+    """
+    if db_config is not None and db_path is not None:
+        raise ValueError("Pass either db_config or db_path, not both.")
+    names = list(dict.fromkeys(sheet_names or SHEET_KEY_COLUMNS.keys()))
+    config = db_config or DatabaseConfig(backend="sqlite", path=db_path)
+    initialize_database_from_config(config)
+    values = read_worksheets_values(spreadsheet, names, max_workers=max_workers)
+
+    def preflight(name: str) -> ImportResult:
+        return import_sheet_values(name, values[name], db_config=config, dry_run=True, initialize_schema=False)
+
+    if dry_run:
+        futures = run_per_sheet(names, preflight, max_workers=max_workers)
+        return [futures[name].result() for name in names]
+    results = {
+        name: import_sheet_values(
+            name, values[name], db_config=config, initialize_schema=False, chunk_size=chunk_size,
         )
-    return results
+        for name in import_order(names)
+    }
+    return [results[name] for name in names]
@@ -0,0 +1,259 @@
+"""Vectorized stock summary for every powder in one pass.
+
+``summarize_stock`` reproduces the 庫存區 per-powder loop with grouped pandas
+operations: the latest 初始 row per powder, the calculation start (the end of
+the initial day, else the earliest movement day, never before the query start),
+purchases and usage in ``(start, end]``, and the closing balance.  Usage rows
+are already flat (one row per powder and order time), as read from the
+``order_powder_consumption`` ledger.
+
+``stock_summary`` memoizes the whole pipeline in this module on a content
+fingerprint of its inputs, so every Streamlit session asking about the same
+data shares one result instead of recomputing it.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Callable, Iterable
+
+import pandas as pd
+
+PURCHASE_TYPES = ("進貨", "新增庫存")
+INITIAL_TYPE = "初始"
+SUMMARY_COLUMNS = ["色粉編號", "期初庫存_g", "期初時間", "有期初", "區間進貨_g", "區間用量_g", "期末庫存_g"]
+_END_OF_DAY = pd.Timedelta(hours=23, minutes=59, seconds=59)
+_CACHE_LIMIT = 32
+_cache: OrderedDict[tuple, pd.DataFrame] = OrderedDict()
+_cache_lock = threading.Lock()
+_EXCEL_EPOCH = pd.Timestamp("1899-12-30")
+_YMD_PATTERN = re.compile(r"^(\d{4})([-/.])(\d{1,2})\2(\d{1,2})(?:[ T](\d{1,2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?))?$")
+_SERIAL_PATTERN = re.compile(r"^\d{5}(?:\.\d+)?$")
+_PARSED_TEXT: dict[str, pd.Timestamp] = {}
+_PARSED_TEXT_LIMIT = 100_000
+_FALLBACK_FORMATS = (
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d",
+    "%Y-%m-%d",
+)
+
+
+def _parse_one(value) -> pd.Timestamp:
+    if pd.isna(value):
+        return pd.NaT
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return pd.to_datetime(value, errors="coerce")
+    if isinstance(value, date):
+        return pd.Timestamp(value)
+    text = str(value).strip()
+    if not text:
+        return pd.NaT
+    parsed = pd.to_datetime(text, errors="coerce")
+    if pd.notna(parsed):
+        return parsed
+    serial = pd.to_numeric(text, errors="coerce")
+    if pd.notna(serial):
+        return _EXCEL_EPOCH + pd.to_timedelta(serial, unit="D")
+    for fmt in _FALLBACK_FORMATS:
+        try:
+            return pd.to_datetime(datetime.strptime(text, fmt))
+        except ValueError:
+            continue
+    return pd.NaT
+
+
+def _iso_text(match: re.Match) -> str:
+    year, _, month, day, clock = match.groups()
+    return f"{year}-{int(month):02d}-{int(day):02d}" + (f" {clock}" if clock else "")
+
+
+def _parse_texts(texts: pd.Series) -> pd.Series:
+    """Parse stripped strings by format class; unknown shapes fall back to ``_parse_one``."""
+    parsed = pd.Series(pd.NaT, index=texts.index, dtype=object)
+    ymd = texts.str.match(_YMD_PATTERN)
+    if ymd.any():
+        iso = texts[ymd].str.replace(_YMD_PATTERN, _iso_text, regex=True)
+        parsed[ymd] = pd.to_datetime(iso.str.replace(" ", "T", regex=False), format="ISO8601", errors="coerce")
+    serial = texts.str.match(_SERIAL_PATTERN)
+    if serial.any():
+        days = pd.to_numeric(texts[serial], errors="coerce")
+        parsed[serial] = _EXCEL_EPOCH + pd.to_timedelta(days, unit="D")
+    other = ~(ymd | serial) & (texts != "")
+    if other.any():
+        parsed[other] = texts[other].map(_parse_one)
+    return parsed
+
+
+def parse_datetime_values(values: Iterable) -> list[pd.Timestamp]:
+    """Parse raw date cells the way ``_parse_one`` does, one vectorized call per format.
+
+    ``YYYY-M-D`` (``-``, ``/`` or ``.``, optional ``H:M[:S]``) and five-digit
+    Excel serials are parsed in bulk; other shapes and non-string cells go
+    through ``_parse_one``.  String results are cached on the raw text.
+    """
+    values = list(values)
+    results: list = [pd.NaT] * len(values)
+    pending: dict[str, list[int]] = {}
+    for position, value in enumerate(values):
+        if isinstance(value, str):
+            cached = _PARSED_TEXT.get(value)
+            if cached is None:
+                pending.setdefault(value, []).append(position)
+            else:
+                results[position] = cached
+        else:
+            results[position] = _parse_one(value)
+    if pending:
+        raw = list(pending)
+        parsed = _parse_texts(pd.Series(raw, dtype=object).str.strip())
+        if len(_PARSED_TEXT) + len(raw) > _PARSED_TEXT_LIMIT:
+            _PARSED_TEXT.clear()
+        for text, timestamp in zip(raw, parsed.tolist()):
+            timestamp = pd.NaT if pd.isna(timestamp) else pd.Timestamp(timestamp)
+            _PARSED_TEXT[text] = timestamp
+            for position in pending[text]:
+                results[position] = timestamp
+    return results
+
+
+def parse_datetime_series(series: pd.Series | None, index: pd.Index | None = None) -> pd.Series:
+    """Parse Sheet date cells, converting each distinct raw value once."""
+    if series is None:
+        return pd.Series(pd.NaT, index=index, dtype="datetime64[ns]")
+    values = series.astype(object)
+    uniques = pd.Index(pd.unique(values))
+    parsed = pd.Series(parse_datetime_values(uniques), dtype=object)
+    mapped = parsed.take(uniques.get_indexer(values)) if len(values) else parsed
+    return pd.to_datetime(pd.Series(mapped.to_numpy(), index=series.index), errors="coerce")
+
+
+def _grams(movements: pd.DataFrame) -> pd.Series:
+    quantity = pd.to_numeric(movements["數量"].astype(str).str.strip(), errors="coerce").fillna(0.0)
+    is_kg = movements["單位"].astype(str).str.lower() == "kg"
+    return quantity.where(~is_kg, quantity * 1000)
+
+
+def prepare_movements(movements: pd.DataFrame) -> pd.DataFrame:
+    """Add parsed 日期時間/日期, 數量_g and stripped IDs/types to an inventory frame."""
+    frame = movements.copy()
+    raw_date = parse_datetime_series(frame.get("日期"), frame.index)
+    raw_datetime = parse_datetime_series(frame.get("日期時間"), frame.index)
+    frame["日期時間"] = raw_datetime.combine_first(raw_date)
+    frame["日期"] = raw_date.dt.normalize()
+    frame["數量_g"] = _grams(frame) if not frame.empty else pd.Series(dtype=float)
+    frame["色粉編號"] = frame["色粉編號"].astype(str).str.strip()
+    frame["類型"] = frame["類型"].astype(str).str.strip()
+    return frame
+
+
+def summarize_stock(
+    movements: pd.DataFrame,
+    usage: pd.DataFrame,
+    powder_ids: Iterable[str],
+    *,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp,
+) -> pd.DataFrame:
+    """Initial, period purchases, period usage and closing stock (grams) per powder.
+
+    ``movements`` must come from ``prepare_movements``; ``usage`` has 色粉編號,
+    生產時間 and 用量_g columns.  Rows follow the order of ``powder_ids``.
+    """
+    powder_ids = list(powder_ids)
+    start = pd.Timestamp.min if start is None else pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    result = pd.DataFrame({"色粉編號": powder_ids})
+    stock = movements[movements["色粉編號"].isin(powder_ids)]
+
+    initial = stock[stock["類型"] == INITIAL_TYPE].sort_values(
+        "日期時間", ascending=False, kind="mergesort", na_position="last"
+    ).drop_duplicates("色粉編號", keep="first").set_index("色粉編號")
+    initial_dt = initial["日期時間"].combine_first(initial["日期"])
+    earliest_dt = stock.groupby("色粉編號")["日期時間"].min()
+
+    result["有期初"] = result["色粉編號"].isin(initial.index)
+    result["期初庫存_g"] = result["色粉編號"].map(initial["數量_g"]).fillna(0.0).astype(float)
+    result["期初時間"] = pd.to_datetime(result["色粉編號"].map(initial_dt))
+    effective_start = (result["期初時間"].dt.normalize() + _END_OF_DAY).combine_first(
+        pd.to_datetime(result["色粉編號"].map(earliest_dt)).dt.normalize()
+    )
+    calc_start = effective_start.where(effective_start.isna() | (effective_start > start), start)
+    calc_start = calc_start.fillna(start)
+    calc_start.index = result["色粉編號"]
+
+    def period_total(frame: pd.DataFrame, time_column: str, value_column: str) -> pd.Series:
+        if frame.empty:
+            return pd.Series(dtype=float)
+        frame_start = frame["色粉編號"].map(calc_start)
+        in_period = (frame[time_column] > frame_start) & (frame[time_column] <= end)
+        return frame.loc[in_period, value_column].groupby(frame.loc[in_period, "色粉編號"]).sum()
+
+    purchases = stock[stock["類型"].isin(PURCHASE_TYPES)]
+    period_usage = usage[usage["色粉編號"].isin(powder_ids)] if not usage.empty else usage
+    result["區間進貨_g"] = result["色粉編號"].map(period_total(purchases, "日期時間", "數量_g")).fillna(0.0)
+    result["區間用量_g"] = result["色粉編號"].map(period_total(period_usage, "生產時間", "用量_g")).fillna(0.0)
+    result["期末庫存_g"] = result["期初庫存_g"] + result["區間進貨_g"] - result["區間用量_g"]
+    return result[SUMMARY_COLUMNS]
+
+
+def frame_fingerprint(frame: pd.DataFrame | None) -> str:
+    """Content hash of a frame's columns and values (row order included)."""
+    if frame is None:
+        return "none"
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((list(frame.columns), frame.shape)).encode("utf-8"))
+    if not frame.empty:
+        digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _memoize(key: tuple, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = compute()
+    with _cache_lock:
+        _cache[key] = value
+        while len(_cache) > _CACHE_LIMIT:
+            _cache.popitem(last=False)
+    return value
+
+
+def clear_stock_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def stock_summary(
+    movements: pd.DataFrame,
+    usage: pd.DataFrame,
+    powder_ids: Iterable[str],
+    *,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp,
+    version_key: tuple | None = None,
+) -> pd.DataFrame:
+    """Memoized ``prepare_movements`` + ``summarize_stock`` over raw inventory rows.
+
+    Results are keyed on the content of ``movements`` and ``usage`` plus the
+    query, so an unchanged sheet reuses the parsed movements and the summary.
+    A ``version_key`` built from the source tables' data versions replaces the
+    content hashes, so a hit skips hashing the frames altogether.
+    """
+    powder_ids = tuple(powder_ids)
+    if version_key is not None:
+        movements_key, usage_key = ("version", version_key[0]), ("version", version_key)
+    else:
+        movements_key, usage_key = frame_fingerprint(movements), frame_fingerprint(usage)
+    prepared = _memoize(("movements", movements_key), lambda: prepare_movements(movements))
+    key = ("summary", movements_key, usage_key, powder_ids, start, end)
+    summary = _memoize(key, lambda: summarize_stock(prepared, usage, powder_ids, start=start, end=end))
+    return summary.copy()
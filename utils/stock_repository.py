@@ -0,0 +1,589 @@
+"""Production consumption ledger and materialized per-powder stock balances.
+
+``order_powder_consumption`` records the grams each production order uses of
+every powder.  It is written when the order is saved, from the recipe
+snapshot the order captured (main recipe, its active 附加配方 and the 合計類別
+remainder), and deleted when the order is cancelled, so any date-range usage
+is an indexed ``SUM ... GROUP BY`` rather than a re-expansion of every recipe.
+Each row keeps one column per page rule (``USAGE_BASES``): ``grams`` for the
+庫存區, ``balance_grams`` for the 生產單 balance and ``ranking_grams`` for the
+用量排行榜.
+
+``powder_stock_balances`` holds, for every powder that has an initial stock or
+a purchase, the latest initial quantity and date, the purchases and the
+consumption since that date, and the resulting balance as of today.
+Repositories refresh the affected powders inside the same transaction as the
+write, so the 生產單 page reads stock with one indexed query.  Rebuilds a
+schema upgrade queues run in ``complete_stock_upgrades`` at startup; reads
+never write.
+
+The balance follows the 生產單 page's stock rules at day granularity: the
+latest 初始 row wins, powders without one start at their earliest 進貨 date,
+purchases and orders count from the start date up to today, and powders
+ending in 01/001/0001 are not deducted.  Reversed movements are excluded.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Iterable
+
+import pandas as pd
+
+from .database import (
+    DatabaseConfig,
+    JournalConnection,
+    SqlExecutor,
+    Statement,
+    connect_from_config,
+    execute_batch,
+    register_replay_hook,
+    utc_now_iso,
+)
+from .recipe_repository import (
+    RECIPE_USAGE_VECTOR_STATE,
+    USAGE_BASES,
+    ensure_recipe_usage_vectors,
+    expand_recipe_usage_bases,
+    recipe_usage_vector,
+)
+from .stock_engine import parse_datetime_values
+
+STOCK_BALANCE_STATE = "powder_stock_balances"
+CONSUMPTION_LEDGER_STATE = "order_powder_consumption"
+RECORD_DAY_STATE = "record_days"
+DEFAULT_INITIAL_DATE = date(2000, 1, 1)
+EXCLUDED_POWDER_SUFFIXES = ("01", "001", "0001")
+BALANCE_CHUNK_SIZE = 500
+_YMD_PATTERN = re.compile(r"(\d{4})[/\-.](\d{1,2})[/\-.](\d{1,2})")
+_NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+_USAGE_COLUMNS = dict(zip(USAGE_BASES, ("grams", "balance_grams", "ranking_grams")))
+
+
+@dataclass(frozen=True)
+class StockBalanceMismatch:
+    colorpowder_id: str
+    stored: dict[str, Any] | None
+    expected: dict[str, Any] | None
+
+
+def _mapping(cursor) -> dict[str, Any] | None:
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    if hasattr(row, "keys"):
+        return {key: row[key] for key in row.keys()}
+    return dict(zip((column[0] for column in cursor.description), row))
+
+
+def _mappings(cursor) -> list[dict[str, Any]]:
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    if hasattr(rows[0], "keys"):
+        return [{key: row[key] for key in row.keys()} for row in rows]
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def parse_stock_date(value: Any) -> date | None:
+    """Parse a Sheet/Turso date cell to a calendar day, or None when blank/invalid.
+
+    Plain ``YYYY-M-D`` text is parsed directly; every other shape goes through
+    ``stock_engine.parse_datetime_values`` so the ledger and the 生產單 page
+    agree on which rows are dated.
+    """
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    match = _YMD_PATTERN.fullmatch(text)
+    if match:
+        try:
+            return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        except ValueError:
+            return None
+    parsed = parse_datetime_values([text])[0]
+    if pd.isna(parsed):
+        return None
+    return parsed.date()
+
+
+def iso_day(value: Any) -> str | None:
+    """``parse_stock_date`` as ``YYYY-MM-DD`` text, the form the indexed day columns store."""
+    day = parse_stock_date(value)
+    return None if day is None else day.isoformat()
+
+
+def _pack_value(value: Any) -> float:
+    match = _NUMBER_PATTERN.search(str(value or "").replace(",", ""))
+    return float(match.group(0)) if match else 0.0
+
+
+def order_packs_total_kg(payload: dict[str, Any]) -> float:
+    """Total packed kilograms of an order payload (包裝重量 × 包裝份數, slots 1-4)."""
+    return sum(
+        _pack_value(payload.get(f"包裝重量{position}")) * _pack_value(payload.get(f"包裝份數{position}"))
+        for position in range(1, 5)
+    )
+
+
+def _grams(quantity: Any, unit: Any) -> float:
+    try:
+        grams = float(quantity or 0)
+    except (TypeError, ValueError):
+        grams = 0.0
+    return grams * 1000 if str(unit or "g").strip().lower() == "kg" else grams
+
+
+def order_consumption_date(order: dict[str, Any]) -> date | None:
+    """生產日期, falling back to the payload's 生產時間/建立時間 like the stock pages."""
+    day = parse_stock_date(order.get("production_date"))
+    if day is not None:
+        return day
+    payload = json.loads(order.get("payload_json") or "{}")
+    for key in ("生產時間", "建立時間"):
+        day = parse_stock_date(payload.get(key))
+        if day is not None:
+            return day
+    return None
+
+
+def _order_consumption(
+    conn: SqlExecutor, order: dict[str, Any], vector_cache: dict[str, dict[str, tuple[float, ...]]] | None = None,
+) -> dict[str, tuple[float, ...]]:
+    packs_total_kg = order_packs_total_kg(json.loads(order.get("payload_json") or "{}"))
+    if packs_total_kg <= 0:
+        return {}
+    snapshot = json.loads(order.get("recipe_snapshot_json") or "null")
+    if snapshot and "add_ons" in snapshot:
+        usage = expand_recipe_usage_bases([snapshot, *snapshot["add_ons"]])
+    else:
+        # Imported orders and snapshots from older releases fall back to the
+        # recipe's current usage vector, which is what the stock pages replayed.
+        recipe_id = str(order.get("recipe_id") or "")
+        if vector_cache is None:
+            ensure_recipe_usage_vectors(conn)
+            usage = recipe_usage_vector(conn, recipe_id)
+        else:
+            if recipe_id not in vector_cache:
+                vector_cache[recipe_id] = recipe_usage_vector(conn, recipe_id)
+            usage = vector_cache[recipe_id]
+    return {powder_id: tuple(value * packs_total_kg for value in grams) for powder_id, grams in usage.items()}
+
+
+def _insert_consumption(
+    conn: SqlExecutor, order: dict[str, Any], vector_cache: dict[str, dict[str, tuple[float, ...]]] | None = None,
+) -> set[str]:
+    if order.get("cancelled_at"):
+        return set()
+    consumption = _order_consumption(conn, order, vector_cache)
+    day = order_consumption_date(order)
+    execute_batch(conn, [
+        (
+            """INSERT INTO order_powder_consumption(
+                   production_order_id, colorpowder_id, grams, balance_grams, ranking_grams, production_date)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (order["production_order_id"], powder_id, *grams, day.isoformat() if day else None),
+        )
+        for powder_id, grams in consumption.items()
+    ])
+    return set(consumption)
+
+
+def write_order_powder_consumption(conn: SqlExecutor, order_id: str) -> set[str]:
+    """Replace one order's ledger rows inside the caller's transaction.
+
+    Returns every powder whose consumption may have changed, old and new.
+    """
+    previous = {
+        str(row["colorpowder_id"])
+        for row in _mappings(conn.execute(
+            "SELECT colorpowder_id FROM order_powder_consumption WHERE production_order_id=?", (order_id,)
+        ))
+    }
+    conn.execute("DELETE FROM order_powder_consumption WHERE production_order_id=?", (order_id,))
+    order = _mapping(conn.execute("SELECT * FROM production_orders WHERE production_order_id=?", (order_id,)))
+    if order is None:
+        return previous
+    return previous | _insert_consumption(conn, order)
+
+
+def _backfill_consumption(conn: SqlExecutor) -> int:
+    ensure_recipe_usage_vectors(conn)
+    conn.execute("DELETE FROM order_powder_consumption")
+    orders = _mappings(conn.execute(
+        "SELECT * FROM production_orders WHERE cancelled_at IS NULL ORDER BY production_order_id"
+    ))
+    vector_cache: dict[str, dict[str, tuple[float, ...]]] = {}
+    for row in _mappings(conn.execute(
+        """SELECT v.recipe_id, v.colorpowder_id, v.grams_per_kg, v.balance_grams_per_kg, v.ranking_grams_per_kg
+           FROM recipe_usage_vectors AS v
+           WHERE v.recipe_id IN (SELECT recipe_id FROM production_orders WHERE cancelled_at IS NULL)"""
+    )):
+        vector_cache.setdefault(str(row["recipe_id"]), {})[str(row["colorpowder_id"])] = (
+            float(row["grams_per_kg"]), float(row["balance_grams_per_kg"]), float(row["ranking_grams_per_kg"]),
+        )
+    for order in orders:
+        _insert_consumption(conn, order, vector_cache)
+    _mark_state(conn, CONSUMPTION_LEDGER_STATE, f"backfilled {len(orders)} orders")
+    return len(orders)
+
+
+def _mark_state(conn: SqlExecutor, state_name: str, message: str) -> None:
+    now = utc_now_iso()
+    conn.execute(
+        """INSERT INTO sync_state(sync_name, last_success_at, last_attempt_at, status, message)
+           VALUES (?, ?, ?, 'ok', ?)
+           ON CONFLICT(sync_name) DO UPDATE SET
+               last_success_at=excluded.last_success_at, last_attempt_at=excluded.last_attempt_at,
+               status='ok', message=excluded.message""",
+        (state_name, now, now, message),
+    )
+
+
+def _state_status(conn: SqlExecutor, state_name: str) -> str | None:
+    state = _mapping(conn.execute("SELECT status FROM sync_state WHERE sync_name=?", (state_name,)))
+    return None if state is None else str(state["status"])
+
+
+def _balance_from_rows(
+    powder_id: str,
+    movements: list[dict[str, Any]],
+    consumption: list[dict[str, Any]],
+    today: date,
+) -> dict[str, Any] | None:
+    initial: tuple[date, float] | None = None
+    purchases: list[tuple[date | None, float]] = []
+    for movement in movements:
+        movement_type = str(movement["movement_type"] or "").strip()
+        day = parse_stock_date(movement["movement_date"])
+        grams = _grams(movement["quantity"], movement["unit"])
+        if movement_type == "初始":
+            day = day or DEFAULT_INITIAL_DATE
+            if initial is None or day > initial[0]:
+                initial = (day, grams)
+        elif movement_type == "進貨":
+            purchases.append((day, grams))
+    if initial is None and not purchases:
+        return None
+
+    if initial is not None:
+        start, initial_quantity = initial
+    else:
+        dated = [day for day, _ in purchases if day is not None]
+        start, initial_quantity = (min(dated) if dated else None), 0.0
+    pending: list[date] = []
+
+    def counts(day: date) -> bool:
+        if start is not None and day < start:
+            return False
+        if day > today:
+            pending.append(day)
+            return False
+        return True
+
+    purchased = sum(grams for day, grams in purchases if day is None or counts(day))
+
+    consumed = 0.0
+    if not powder_id.endswith(EXCLUDED_POWDER_SUFFIXES):
+        for row in consumption:
+            day = parse_stock_date(row["production_date"])
+            if day is not None and counts(day):
+                consumed += float(row["grams"] or 0)
+
+    return {
+        "colorpowder_id": powder_id,
+        "initial_quantity_g": initial_quantity,
+        "initial_date": start.isoformat() if start else None,
+        "purchased_g": purchased,
+        "consumed_g": consumed,
+        "balance_g": initial_quantity + purchased - consumed,
+        "as_of_date": today.isoformat(),
+        "pending_from": min(pending).isoformat() if pending else None,
+    }
+
+
+def compute_powder_stock_balances(
+    conn: SqlExecutor, powder_ids: Iterable[str], *, today: date | None = None,
+) -> dict[str, dict[str, Any] | None]:
+    """Recompute many powders' balances from the ledger; None for those without stock.
+
+    Movements and per-day consumption are read with one grouped ``IN (...)``
+    query each per chunk of powders, not two queries per powder.
+    """
+    today = today or date.today()
+    wanted = sorted({str(value).strip() for value in powder_ids if str(value or "").strip()})
+    movements: dict[str, list[dict[str, Any]]] = {}
+    consumption: dict[str, list[dict[str, Any]]] = {}
+    for start in range(0, len(wanted), BALANCE_CHUNK_SIZE):
+        chunk = wanted[start:start + BALANCE_CHUNK_SIZE]
+        placeholders = ", ".join("?" for _ in chunk)
+        for row in _mappings(conn.execute(
+            f"""SELECT colorpowder_id, movement_type, movement_date, quantity, unit FROM inventory_movements
+                WHERE colorpowder_id IN ({placeholders}) AND sheet_name='庫存記錄'
+                  AND reversed_at IS NULL AND reversal_of_movement_key IS NULL
+                ORDER BY colorpowder_id, movement_date, movement_id""",
+            chunk,
+        )):
+            movements.setdefault(str(row["colorpowder_id"]), []).append(row)
+        for row in _mappings(conn.execute(
+            f"""SELECT colorpowder_id, production_date, SUM(balance_grams) AS grams
+                FROM order_powder_consumption
+                WHERE colorpowder_id IN ({placeholders})
+                GROUP BY colorpowder_id, production_date""",
+            chunk,
+        )):
+            consumption.setdefault(str(row["colorpowder_id"]), []).append(row)
+    return {
+        powder_id: _balance_from_rows(
+            powder_id, movements.get(powder_id, []), consumption.get(powder_id, []), today,
+        )
+        for powder_id in wanted
+    }
+
+
+def compute_powder_stock_balance(
+    conn: SqlExecutor, powder_id: str, *, today: date | None = None,
+) -> dict[str, Any] | None:
+    """Recompute one powder's balance from the ledger; None when it has no stock."""
+    return compute_powder_stock_balances(conn, [powder_id], today=today).get(str(powder_id or "").strip())
+
+
+def refresh_powder_stock_balances(
+    conn: SqlExecutor, powder_ids: Iterable[str], *, today: date | None = None,
+) -> None:
+    """Recompute the given powders inside the caller's transaction; the writes go out as one batch.
+
+    Under write-behind the rows stay in the replica and replay recomputes the
+    same powders on the remote, over the movements and orders it holds.
+    """
+    today = today or date.today()
+    now = utc_now_iso()
+    powder_ids = sorted({str(value).strip() for value in powder_ids if str(value or "").strip()})
+    statements: list[Statement] = []
+    for powder_id, balance in compute_powder_stock_balances(conn, powder_ids, today=today).items():
+        if balance is None:
+            statements.append(("DELETE FROM powder_stock_balances WHERE colorpowder_id=?", (powder_id,)))
+            continue
+        statements.append((
+            """INSERT INTO powder_stock_balances(
+                   colorpowder_id, initial_quantity_g, initial_date, purchased_g, consumed_g,
+                   balance_g, as_of_date, pending_from, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(colorpowder_id) DO UPDATE SET
+                   initial_quantity_g=excluded.initial_quantity_g,
+                   initial_date=excluded.initial_date, purchased_g=excluded.purchased_g,
+                   consumed_g=excluded.consumed_g, balance_g=excluded.balance_g,
+                   as_of_date=excluded.as_of_date, pending_from=excluded.pending_from,
+                   updated_at=excluded.updated_at""",
+            (
+                powder_id, balance["initial_quantity_g"], balance["initial_date"],
+                balance["purchased_g"], balance["consumed_g"], balance["balance_g"],
+                balance["as_of_date"], balance["pending_from"], now,
+            ),
+        ))
+    execute_batch(conn, statements)
+    if isinstance(conn, JournalConnection):
+        conn.recompute_on_replay("powder_stock_balances", powder_ids)
+
+
+register_replay_hook("powder_stock_balances", refresh_powder_stock_balances)
+
+
+def _stocked_powder_ids(conn: SqlExecutor) -> set[str]:
+    rows = _mappings(conn.execute(
+        """SELECT DISTINCT colorpowder_id FROM inventory_movements
+           WHERE sheet_name='庫存記錄' AND TRIM(movement_type) IN ('初始', '進貨')"""
+    ))
+    return {str(row["colorpowder_id"]) for row in rows if row["colorpowder_id"]}
+
+
+def _rebuild(conn: SqlExecutor, today: date) -> int:
+    powder_ids = _stocked_powder_ids(conn)
+    conn.execute("DELETE FROM powder_stock_balances")
+    refresh_powder_stock_balances(conn, powder_ids, today=today)
+    _mark_state(conn, STOCK_BALANCE_STATE, f"rebuilt {len(powder_ids)} powders")
+    return len(powder_ids)
+
+
+def _backfill_record_days(conn: SqlExecutor) -> None:
+    """Fill the ISO day columns from the raw date text, one UPDATE per distinct date."""
+    statements: list[Statement] = []
+    for table, raw, day in (
+        ("production_orders", "production_date", "production_day"),
+        ("inventory_movements", "movement_date", "movement_day"),
+    ):
+        for row in _mappings(conn.execute(f"SELECT DISTINCT {raw} AS raw FROM {table} WHERE {raw} IS NOT NULL")):
+            statements.append((
+                f"UPDATE {table} SET {day}=? WHERE {raw}=? AND {day} IS NOT ?",
+                (iso_day(row["raw"]), row["raw"], iso_day(row["raw"])),
+            ))
+    execute_batch(conn, statements)
+    _mark_state(conn, RECORD_DAY_STATE, f"backfilled {len(statements)} distinct dates")
+
+
+def complete_stock_upgrades(config: DatabaseConfig, *, today: date | None = None) -> list[str]:
+    """Run the one-off backfills and rebuilds a schema upgrade queued; returns what was done.
+
+    The app calls this once at startup and ``scripts/rebuild_stock_balances.py``
+    before its own work, so reads never write.  Balances whose future-dated
+    entries have come due are rolled forward here as well.
+    """
+    today = today or date.today()
+    completed = []
+    with connect_from_config(config) as conn:
+        if _state_status(conn, RECORD_DAY_STATE) == "backfill_required":
+            _backfill_record_days(conn)
+            completed.append(RECORD_DAY_STATE)
+        rebuild = False
+        if _state_status(conn, RECIPE_USAGE_VECTOR_STATE) == "rebuild_required":
+            ensure_recipe_usage_vectors(conn)
+            completed.append(RECIPE_USAGE_VECTOR_STATE)
+            rebuild = True
+        if _state_status(conn, CONSUMPTION_LEDGER_STATE) == "backfill_required":
+            _backfill_consumption(conn)
+            completed.append(CONSUMPTION_LEDGER_STATE)
+            rebuild = True
+        if rebuild or _state_status(conn, STOCK_BALANCE_STATE) == "rebuild_required":
+            _rebuild(conn, today)
+            completed.append(STOCK_BALANCE_STATE)
+            return completed
+        due = _mappings(conn.execute(
+            """SELECT colorpowder_id FROM powder_stock_balances
+               WHERE pending_from IS NOT NULL AND pending_from<=?""",
+            (today.isoformat(),),
+        ))
+        if due:
+            refresh_powder_stock_balances(conn, (row["colorpowder_id"] for row in due), today=today)
+    return completed
+
+
+def _served_balances(conn: SqlExecutor, rows: list[dict[str, Any]], today: date) -> list[dict[str, Any]]:
+    """Recompute, without writing, stored balances whose future-dated entries have come due."""
+    due = compute_powder_stock_balances(conn, (
+        row["colorpowder_id"] for row in rows
+        if row.get("pending_from") and str(row["pending_from"]) <= today.isoformat()
+    ), today=today)
+    served = []
+    for row in rows:
+        if str(row["colorpowder_id"]) in due:
+            balance = due[str(row["colorpowder_id"])]
+            if balance is None:
+                continue
+            row = {**row, **balance}
+        served.append(row)
+    return served
+
+
+def get_powder_stock_balance(
+    config: DatabaseConfig, powder_id: str, *, today: date | None = None,
+) -> dict[str, Any] | None:
+    today = today or date.today()
+    with connect_from_config(config) as conn:
+        rows = _served_balances(conn, _mappings(conn.execute(
+            "SELECT * FROM powder_stock_balances WHERE colorpowder_id=?", (str(powder_id or "").strip(),)
+        )), today)
+    return rows[0] if rows else None
+
+
+def list_powder_stock_balances(
+    config: DatabaseConfig, *, today: date | None = None,
+) -> list[dict[str, Any]]:
+    today = today or date.today()
+    with connect_from_config(config) as conn:
+        return _served_balances(
+            conn, _mappings(conn.execute("SELECT * FROM powder_stock_balances ORDER BY colorpowder_id")), today,
+        )
+
+
+def rebuild_powder_stock_balances(config: DatabaseConfig, *, today: date | None = None) -> int:
+    """Recompute every balance from scratch; returns the number of stocked powders."""
+    with connect_from_config(config) as conn:
+        return _rebuild(conn, today or date.today())
+
+
+def backfill_order_powder_consumption(config: DatabaseConfig, *, today: date | None = None) -> int:
+    """Rewrite the consumption ledger for every active order, then rebuild balances."""
+    with connect_from_config(config) as conn:
+        count = _backfill_consumption(conn)
+        _rebuild(conn, today or date.today())
+        return count
+
+
+def list_powder_usage(
+    config: DatabaseConfig,
+    start: date | None = None,
+    end: date | None = None,
+    *,
+    powder_ids: Iterable[str] | None = None,
+    by_date: bool = False,
+    basis: str = "stock",
+) -> list[dict[str, Any]]:
+    """Sum ledger grams per powder (and per day when ``by_date``) for an inclusive date range.
+
+    ``basis`` picks the page rule the grams follow (see ``USAGE_BASES``).
+    """
+    if basis not in _USAGE_COLUMNS:
+        raise ValueError(f"basis must be one of {USAGE_BASES}")
+    column = _USAGE_COLUMNS[basis]
+    clauses = ["production_date IS NOT NULL", f"{column}>0"]
+    params: list[Any] = []
+    if start is not None:
+        clauses.append("production_date>=?")
+        params.append(start.isoformat())
+    if end is not None:
+        clauses.append("production_date<=?")
+        params.append(end.isoformat())
+    if powder_ids is not None:
+        powder_ids = sorted({str(value).strip() for value in powder_ids})
+        if not powder_ids:
+            return []
+        clauses.append(f"colorpowder_id IN ({', '.join('?' for _ in powder_ids)})")
+        params.extend(powder_ids)
+    group = "colorpowder_id, production_date" if by_date else "colorpowder_id"
+    with connect_from_config(config) as conn:
+        return _mappings(conn.execute(
+            f"""SELECT {group}, SUM({column}) AS grams FROM order_powder_consumption
+                WHERE {' AND '.join(clauses)}
+                GROUP BY {group} ORDER BY {group}""",
+            tuple(params),
+        ))
+
+
+def check_powder_stock_balances(
+    config: DatabaseConfig, *, today: date | None = None, tolerance: float = 1e-6,
+) -> list[StockBalanceMismatch]:
+    """Compare stored balances with a from-scratch recompute without writing."""
+    today = today or date.today()
+    fields = ("initial_quantity_g", "initial_date", "purchased_g", "consumed_g", "balance_g", "pending_from")
+    mismatches = []
+    with connect_from_config(config) as conn:
+        stored = {
+            str(row["colorpowder_id"]): row
+            for row in _mappings(conn.execute("SELECT * FROM powder_stock_balances"))
+        }
+        for powder_id, expected in compute_powder_stock_balances(
+            conn, _stocked_powder_ids(conn) | set(stored), today=today,
+        ).items():
+            actual = stored.get(powder_id)
+            if expected is None or actual is None:
+                if expected is not None or actual is not None:
+                    mismatches.append(StockBalanceMismatch(powder_id, actual, expected))
+                continue
+            for field in fields:
+                left, right = actual.get(field), expected[field]
+                if isinstance(right, float):
+                    differs = left is None or abs(float(left) - right) > tolerance
+                else:
+                    differs = left != right
+                if differs:
+                    mismatches.append(StockBalanceMismatch(powder_id, actual, expected))
+                    break
+    return mismatches
@@ -3,9 +3,24 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Iterable
 
-from .database import DatabaseConfig, connect_from_config, enqueue_sheet_sync, utc_now_iso
+from .database import (
+    ChangeSet,
+    DatabaseConfig,
+    connect_from_config,
+    enqueue_sheet_sync,
+    keyset_after,
+    page_limit,
+    change_watermark,
+    utc_now_iso,
+)
+
+
+SUPPLIER_LIST_COLUMNS = (
+    "supplier_id", "name", "notes", "lifecycle_status", "deleted_at", "delete_reason",
+    "version", "updated_at", "last_synced_at",
+)
 
 
 class SupplierError(RuntimeError):
@@ -64,16 +79,65 @@ def supplier_sheet_payload(entity: dict[str, Any]) -> dict[str, str]:
     }
 
 
-def list_suppliers(config: DatabaseConfig, *, include_inactive: bool = False) -> list[dict[str, Any]]:
+def list_suppliers(
+    config: DatabaseConfig,
+    *,
+    include_inactive: bool = False,
+    supplier_id: str | None = None,
+    lifecycle: str | None = None,
+    changed_after: int | None = None,
+    columns: Iterable[str] | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+) -> list[dict[str, Any]]:
+    """Suppliers ordered by ID; ``after``/``limit`` page by the last ``supplier_id``."""
+    selected = list(columns or SUPPLIER_LIST_COLUMNS)
+    unknown = set(selected) - set(SUPPLIER_LIST_COLUMNS)
+    if unknown:
+        raise SupplierError(f"不支援的欄位：{', '.join(sorted(unknown))}")
+    clauses: list[str] = []
+    params: list[Any] = []
+    if lifecycle:
+        clauses.append("lifecycle_status=?")
+        params.append(lifecycle)
+    elif not include_inactive:
+        clauses.append("lifecycle_status='active'")
+    if supplier_id:
+        clauses.append("supplier_id=?")
+        params.append(str(supplier_id).strip())
+    if changed_after is not None:
+        clauses.append("change_seq>?")
+        params.append(changed_after)
+    if after is not None:
+        clauses.append(keyset_after(["supplier_id"], "?"))
+        params.append(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    limit_sql, limit_params = page_limit(limit)
     with connect_from_config(config) as conn:
-        where = "" if include_inactive else "WHERE lifecycle_status='active'"
         return _mappings(conn.execute(
-            f"""SELECT supplier_id, name, notes, lifecycle_status, deleted_at, delete_reason,
-                       version, updated_at, last_synced_at
-                FROM suppliers {where} ORDER BY supplier_id"""
+            f"""SELECT {', '.join(selected)}
+                FROM suppliers {where} ORDER BY supplier_id {limit_sql}""",
+            (*params, *limit_params),
         ))
 
 
+def list_suppliers_changed_since(
+    config: DatabaseConfig, watermark: int | None, *, include_inactive: bool = False,
+) -> ChangeSet:
+    """Suppliers written after ``watermark``; disabled ones are tombstones unless included."""
+    with connect_from_config(config) as conn:
+        next_watermark = change_watermark(conn, "suppliers")
+    rows = list_suppliers(config, include_inactive=True, changed_after=watermark)
+    return ChangeSet(
+        upserted=[row for row in rows if include_inactive or row["lifecycle_status"] == "active"],
+        tombstoned=[
+            row["supplier_id"] for row in rows
+            if not include_inactive and row["lifecycle_status"] != "active"
+        ],
+        watermark=watermark if next_watermark is None else next_watermark,
+    )
+
+
 def set_supplier_active(config: DatabaseConfig, supplier_id: str, *, active: bool, reason: str = "") -> dict[str, Any]:
     """Soft-disable or restore a supplier while preserving historical references."""
     supplier_id = str(supplier_id or "").strip()
@@ -7,7 +7,7 @@ from datetime import datetime, timedelta, timezone
 from typing import Any, Callable
 from uuid import uuid4
 
-from .database import DatabaseConfig, connect_from_config, initialize_database_from_config
+from .database import DatabaseConfig, connect_from_config, initialize_database_from_config, write_behind_remote_config
 from .sheet_export import (
     ExportResult,
     sync_color_powder_outbox,
@@ -16,7 +16,7 @@ from .sheet_export import (
     sync_recipe_outbox,
     sync_supplier_outbox,
 )
-from .sheet_import import read_worksheet_values_with_retry
+from .sheet_import import cached_worksheet, read_worksheets_values
 
 
 SAFE_SHEETS: tuple[tuple[str, Callable[..., ExportResult]], ...] = (
@@ -27,6 +27,18 @@ SAFE_SHEETS: tuple[tuple[str, Callable[..., ExportResult]], ...] = (
     ("生產單", sync_production_order_outbox),
 )
 SYNC_WORKER_LOCK_NAME = "turso-sheets-worker"
+OUTBOX_RETENTION_DAYS = 30
+_OUTBOX_COLUMNS = (
+    "id, sheet_name, row_key, operation, payload_json, entity_version, status, "
+    "attempt_count, last_error, created_at, processed_at"
+)
+# A pending or failed event that a newer open event of the same row replaces.
+_SUPERSEDED_EVENT = """status IN ('pending', 'failed') AND EXISTS (
+    SELECT 1 FROM sync_outbox AS newer
+    WHERE newer.sheet_name = sync_outbox.sheet_name AND newer.row_key = sync_outbox.row_key
+      AND newer.status IN ('pending', 'failed', 'processing')
+      AND newer.entity_version > sync_outbox.entity_version)"""
+_EXPIRED_EVENT = "status IN ('completed', 'conflict') AND COALESCE(processed_at, created_at) < ?"
 
 
 @dataclass
@@ -44,6 +56,12 @@ class SafeWorkerResult:
         )
 
 
+@dataclass
+class OutboxCompactionResult:
+    superseded: int = 0
+    archived: int = 0
+
+
 def _utc_iso(value: datetime) -> str:
     return value.astimezone(timezone.utc).isoformat()
 
@@ -55,7 +73,8 @@ def acquire_worker_lock(
     if ttl_seconds < 1:
         raise ValueError("ttl_seconds must be at least 1")
     now = datetime.now(timezone.utc)
-    with connect_from_config(config) as conn:
+    # Locks are shared with other processes, so they always live on the remote.
+    with connect_from_config(write_behind_remote_config(config)) as conn:
         claimed = conn.execute(
             """INSERT INTO sync_worker_locks(lock_name, owner_id, acquired_at, expires_at)
                VALUES (?, ?, ?, ?)
@@ -78,7 +97,7 @@ def acquire_worker_lock(
 
 
 def release_worker_lock(config: DatabaseConfig, *, lock_name: str, owner_id: str) -> None:
-    with connect_from_config(config) as conn:
+    with connect_from_config(write_behind_remote_config(config)) as conn:
         conn.execute(
             "DELETE FROM sync_worker_locks WHERE lock_name=? AND owner_id=?",
             (lock_name, owner_id),
@@ -110,15 +129,21 @@ def run_safe_worker(
 
     remaining = batch_size
     try:
-        for sheet_name, sync_function in SAFE_SHEETS:
+        sheet_names = [sheet_name for sheet_name, _ in SAFE_SHEETS]
+        snapshots: dict[str, list[list[Any]]] = {}
+        for position, (sheet_name, sync_function) in enumerate(SAFE_SHEETS):
             if remaining <= 0:
                 break
             try:
-                worksheet = spreadsheet.worksheet(sheet_name)
-                values = read_worksheet_values_with_retry(worksheet)
+                if sheet_name not in snapshots:
+                    # One batched request covers the remaining sheets when the client supports it.
+                    batched = hasattr(spreadsheet, "values_batch_get")
+                    snapshots.update(read_worksheets_values(
+                        spreadsheet, sheet_names[position:] if batched else [sheet_name]
+                    ))
                 sheet_result = sync_function(
-                    worksheet,
-                    values,
+                    cached_worksheet(spreadsheet, sheet_name),
+                    snapshots[sheet_name],
                     db_config=db_config,
                     dry_run=dry_run,
                     initialize_schema=False,
@@ -136,3 +161,40 @@ def run_safe_worker(
         if not dry_run and result.lock_acquired:
             release_worker_lock(db_config, lock_name=lock_name, owner_id=owner_id)
     return result
+
+
+def _move_to_archive(conn, condition: str, params: tuple[Any, ...], *, status: str | None, archived_at: str) -> int:
+    status_column = "?" if status else "status"
+    conn.execute(
+        f"""INSERT INTO sync_outbox_archive({_OUTBOX_COLUMNS}, archived_at)
+            SELECT {_OUTBOX_COLUMNS.replace("status", status_column)}, ?
+            FROM sync_outbox WHERE {condition}""",
+        ((status,) if status else ()) + (archived_at,) + params,
+    )
+    return len(conn.execute(f"DELETE FROM sync_outbox WHERE {condition} RETURNING id", params).fetchall())
+
+
+def compact_outbox(
+    config: DatabaseConfig,
+    *,
+    retention_days: int = OUTBOX_RETENTION_DAYS,
+    now: datetime | None = None,
+) -> OutboxCompactionResult:
+    """Collapse superseded open events and archive finished events older than the retention window.
+
+    Delivery only ever sends the newest open version of a row, so older
+    pending/failed versions are archived as ``superseded``.  Completed and
+    conflict events leave ``sync_outbox`` once they are ``retention_days`` old,
+    keeping the live table (and every pending lookup) proportional to open work.
+    """
+    if retention_days < 0:
+        raise ValueError("retention_days must not be negative")
+    now = (now or datetime.now(timezone.utc)).replace(microsecond=0)
+    cutoff = _utc_iso(now - timedelta(days=retention_days))
+    archived_at = _utc_iso(now)
+    # The outbox is compacted where it is delivered from: the remote.
+    with connect_from_config(write_behind_remote_config(config)) as conn:
+        return OutboxCompactionResult(
+            superseded=_move_to_archive(conn, _SUPERSEDED_EVENT, (), status="superseded", archived_at=archived_at),
+            archived=_move_to_archive(conn, _EXPIRED_EVENT, (cutoff,), status=None, archived_at=archived_at),
+        )